@@ -1,4 +1,4 @@
-from locust import HttpUser, task, between
+from locust import HttpUser, task, between, tag
 from random import randint
 
 
@@ -24,7 +24,8 @@ class WebsiteUser(HttpUser):
         product_pk = randint(1, 1000)
         self.client.get(f"/store/products/{product_pk}/", name="/store/products/:pk")
 
-    # Add product to cart
+    # Add product to cart. Run only these with --tags cart to compare the cart stores (see store/carts.py)
+    @tag("cart")
     @task(1)  # task with a weight of 1
     def add_to_cart(self):
         product_pk = randint(1, 10)
@@ -56,8 +56,9 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     "django.middleware.security.SecurityMiddleware",
-    "django.contrib.sessions.middleware.SessionMiddleware",
+    # serves STATIC_ROOT before the other middleware runs, see STORAGES in prod.py
     "whitenoise.middleware.WhiteNoiseMiddleware",
+    "django.contrib.sessions.middleware.SessionMiddleware",
     "corsheaders.middleware.CorsMiddleware",
     "django.middleware.common.CommonMiddleware",
     "django.middleware.csrf.CsrfViewMiddleware",
@@ -129,6 +130,24 @@ STATIC_ROOT = BASE_DIR / "assets"
 
 STATICFILES_DIRS = [BASE_DIR / "static"]
 
+STORAGES = {
+    "default": {"BACKEND": "django.core.files.storage.FileSystemStorage"},
+    "staticfiles": {
+        "BACKEND": "django.contrib.staticfiles.storage.StaticFilesStorage"
+    },
+    # product images are stored once per content, see store/storage.py
+    "product_images": {"BACKEND": "store.storage.ContentAddressedStorage"},
+}
+
+# Cache-Control of files whose url changes with their content
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+# how /media/ and /static/ are served, see core/views.py.
+# "django" (development), "sendfile", "x-accel-redirect" (nginx) or "x-sendfile" (apache, lighttpd)
+FILE_SERVE_MODE = "django"
+# the internal nginx location for "x-accel-redirect", followed by media/ or static/
+FILE_SERVE_ACCEL_PREFIX = "/protected/"
+
 
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.0/ref/settings/#default-auto-field
@@ -161,6 +180,26 @@ DJOSER = {
 
 ADMINS = [("JanusQA", "admin@home.test")]
 
+# how long (in seconds) a cached product page lives. Pages are invalidated by the catalog version
+# long before this whenever the catalog changes, so this only bounds how long unused pages linger
+CATALOG_CACHE_TIMEOUT = 60 * 60
+
+# where carts are kept, see store/carts.py. "store.carts.RedisCartStore" keeps them in redis at
+# CART_REDIS_URL and writes them to the db behind the client's back (see flush_carts)
+CART_STORE = "store.carts.DatabaseCartStore"
+# With CART_LAZY_CREATE clients may skip POST /store/carts/ and make up the uuid of their cart: the
+# first item added creates it, and until then it reads as an empty cart
+CART_LAZY_CREATE = False
+# how long (in seconds) a cart lives in redis after its last change
+CART_TTL = 7 * 24 * 60 * 60
+# carts created longer ago than this (in seconds) are deleted by the abandoned carts task, that many
+# carts per transaction
+ABANDONED_CART_AGE = 30 * 24 * 60 * 60
+ABANDONED_CART_BATCH_SIZE = 500
+# how many items an empty reservation bucket of a sharded product takes from its stock row on top
+# of what the checkout needs, see store/inventory.py
+STOCK_BUCKET_REFILL = 20
+
 
 CELERY_BEAT_SCHEDULE = {
     "notify_customers": {
@@ -176,7 +215,20 @@ CELERY_BEAT_SCHEDULE = {
         # pass arguments to task via args or kwargs
         "args": ["Hello World"],
         # 'kwargs': { }
-    }
+    },
+    # only has work to do with the RedisCartStore
+    "flush_carts": {
+        "task": "store.tasks.flush_carts",
+        "schedule": 60,
+    },
+    "delete_abandoned_carts": {
+        "task": "store.tasks.delete_abandoned_carts_task",
+        "schedule": 60 * 60,  # every hour
+    },
+    "sync_product_inventory": {
+        "task": "store.tasks.sync_product_inventory_task",
+        "schedule": 60,
+    },
 }
 
 LOGGING = {
@@ -1,3 +1,4 @@
+import dj_database_url
 from .common import *
 
 # SECURITY WARNING: don't run with debug turned on in production!
@@ -12,11 +13,10 @@ MIDDLEWARE += ["silk.middleware.SilkyMiddleware"]
 # Database
 # https://docs.djangoproject.com/en/5.0/ref/settings/#databases
 
+# sqlite unless DATABASE_URL is set, eg. DATABASE_URL=postgres://user@localhost/store to run
+# benchmark_checkout against postgres
 DATABASES = {
-    "default": {
-        "ENGINE": "django.db.backends.sqlite3",
-        "NAME": BASE_DIR / "db.sqlite3",
-    }
+    "default": dj_database_url.config(default=f"sqlite:///{BASE_DIR / 'db.sqlite3'}"),
 }
 
 CACHES = {
@@ -32,6 +32,8 @@ CACHES = {
 
 CELERY_BROKER_URL = "redis://localhost:6379/1"
 
+CART_REDIS_URL = "redis://localhost:6379/3"
+
 EMAIL_BACKEND = "django.core.mail.backends.smtp.EmailBackend"
 EMAIL_HOST = ""
 EMAIL_PORT = 0
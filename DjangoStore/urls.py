@@ -19,17 +19,18 @@ from django.contrib import admin
 from django.urls import path, include, re_path
 from django.conf.urls.static import static
 from django.conf import settings
-from django.views.static import serve
 import debug_toolbar
 
+from core.views import serve_media, serve_static
+
 admin.site.site_header = "DjangoStore Admin"
 admin.site.index_title = "Admin"
 
 DEBUG = True
 
 urlpatterns = [
-    re_path(r"^media/(?P<path>.*)$", serve, {"document_root": settings.MEDIA_ROOT}),
-    re_path(r"^static/(?P<path>.*)$", serve, {"document_root": settings.STATIC_ROOT}),
+    re_path(r"^media/(?P<path>.*)$", serve_media),
+    re_path(r"^static/(?P<path>.*)$", serve_static),
     re_path(r"^auth/", include("djoser.urls")),
     re_path(r"^auth/", include("djoser.urls.jwt")),
     path("", include("core.urls")),
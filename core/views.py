@@ -1,3 +1,167 @@
-from django.shortcuts import render
+import mimetypes
+import os
+import re
+from urllib.parse import quote
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.http import FileResponse, Http404, HttpResponse
+from django.utils._os import safe_join
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, parse_http_date_safe
+from django.views.static import serve
 
-# Create your views here.
+from store.storage import select_product_image_storage
+
+# bytes=0-499, bytes=500-, bytes=-500
+RANGE_PATTERN = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+# Serves media and static files according to settings.FILE_SERVE_MODE:
+# - "django": django.views.static.serve. Reads the file in python, only for development.
+# - "sendfile": a FileResponse of the open file. Servers with a wsgi.file_wrapper (gunicorn) hand it
+#   to os.sendfile so the bytes never pass through python. Answers Range requests itself.
+# - "x-accel-redirect": nginx serves the file from an internal location, eg.
+#       location /protected/media/ { internal; alias /app/media/; }
+#       location /protected/static/ { internal; alias /app/assets/; }
+# - "x-sendfile": apache (mod_xsendfile) or lighttpd serve the file at the path we send.
+# The proxies answer Range requests themselves. Conditional requests are answered here in every
+# mode but "django", from a stat of the file.
+def serve_file(request, path, document_root, url_prefix, cache_control=None):
+    mode = settings.FILE_SERVE_MODE
+    if mode == "django":
+        response = serve(request, path, document_root=document_root)
+        if cache_control:
+            response["Cache-Control"] = cache_control
+        return response
+
+    try:
+        full_path = safe_join(document_root, path)
+        stat = os.stat(full_path)
+    except (SuspiciousFileOperation, OSError):
+        raise Http404(f"{path} does not exist")
+    if not os.path.isfile(full_path):
+        raise Http404(f"{path} does not exist")
+
+    etag = f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+    response = get_conditional_response(
+        request, etag=etag, last_modified=int(stat.st_mtime)
+    )
+    if response is None:
+        if mode == "sendfile":
+            response = sendfile_response(request, full_path, stat, etag)
+        elif mode == "x-accel-redirect":
+            response = HttpResponse()
+            response["X-Accel-Redirect"] = quote(
+                f"{settings.FILE_SERVE_ACCEL_PREFIX}{url_prefix}{path}"
+            )
+        elif mode == "x-sendfile":
+            response = HttpResponse()
+            response["X-Sendfile"] = full_path
+        else:
+            raise ValueError(f"Unknown FILE_SERVE_MODE {mode!r}")
+        set_content_type(response, full_path)
+
+    response["ETag"] = etag
+    response["Last-Modified"] = http_date(stat.st_mtime)
+    if cache_control:
+        response["Cache-Control"] = cache_control
+    return response
+
+
+# Returns (start, end) of the single byte range asked for, end included. None for the whole file,
+# including when the client asked for several ranges, which we are allowed to ignore.
+# Raises ValueError when the range is not satisfiable.
+def parse_range(header, size):
+    match = RANGE_PATTERN.match(header.replace(" ", ""))
+    if match is None:
+        return None
+    start, end = match.groups()
+    if start == "" and end == "":
+        return None
+    if start == "":
+        # the last n bytes
+        length = int(end)
+        if length == 0:
+            raise ValueError("empty suffix range")
+        return max(size - length, 0), size - 1
+    start = int(start)
+    end = size - 1 if end == "" else min(int(end), size - 1)
+    if start > end or start >= size:
+        raise ValueError("range outside the file")
+    return start, end
+
+
+# If-Range: only send the range if the file is still the one the client has part of
+def if_range_matches(request, etag, mtime) -> bool:
+    if_range = request.headers.get("If-Range")
+    if if_range is None:
+        return True
+    if if_range.startswith('"') or if_range.startswith("W/"):
+        return if_range == etag
+    return parse_http_date_safe(if_range) == int(mtime)
+
+
+# Limits reads of an open file to a byte range. fileno() is the file's own, servers that sendfile
+# start at the file's offset and send Content-Length bytes.
+class RangeFile:
+    def __init__(self, file, start, length):
+        file.seek(start)
+        self.file = file
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def close(self):
+        self.file.close()
+
+
+def sendfile_response(request, full_path, stat, etag):
+    size = stat.st_size
+    byte_range = None
+    range_header = request.headers.get("Range")
+    if range_header and request.method in ("GET", "HEAD"):
+        if if_range_matches(request, etag, stat.st_mtime):
+            try:
+                byte_range = parse_range(range_header, size)
+            except ValueError:
+                response = HttpResponse(status=416)
+                response["Content-Range"] = f"bytes */{size}"
+                return response
+
+    file = open(full_path, "rb")
+    if byte_range is None:
+        response = FileResponse(file)
+    else:
+        start, end = byte_range
+        response = FileResponse(RangeFile(file, start, end - start + 1), status=206)
+        response["Content-Range"] = f"bytes {start}-{end}/{size}"
+        response["Content-Length"] = end - start + 1
+    response["Accept-Ranges"] = "bytes"
+    return response
+
+
+def set_content_type(response, full_path):
+    content_type, encoding = mimetypes.guess_type(full_path)
+    response["Content-Type"] = content_type or "application/octet-stream"
+    if encoding:
+        response["Content-Encoding"] = encoding
+
+
+# the files of a content addressed storage never change under the same url
+def serve_media(request, path):
+    cache_control = None
+    if select_product_image_storage().is_immutable(path):
+        cache_control = settings.IMMUTABLE_CACHE_CONTROL
+    return serve_file(request, path, settings.MEDIA_ROOT, "media/", cache_control)
+
+
+def serve_static(request, path):
+    return serve_file(request, path, settings.STATIC_ROOT, "static/")
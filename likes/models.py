@@ -17,5 +17,10 @@ class LikedItem(models.Model):
     object_id = models.PositiveIntegerField()
     content_object = GenericForeignKey()
 
+    class Meta:
+        # the likes of an object (eg. a product) are looked up by its content type and id, see
+        # "likes of a product" in explain_store_queries
+        indexes = [models.Index(fields=["content_type", "object_id"])]
+
     def __str__(self) -> str:
         return f"{self.content_object} liked by {self.user}"
@@ -7,6 +7,8 @@ from django.utils.html import format_html  # implement links for list in admin u
 from django.utils.http import urlencode  # implement links for list in admin ui
 from django.urls import reverse  # implement links for list in admin ui
 from . import models
+from .images import get_smallest_size
+from .inventory import restock
 
 
 # This is a custom filter. To enable it add it to list_filters list
@@ -30,10 +32,20 @@ class ProductImageInline(admin.TabularInline):
     model = models.ProductImage
     readonly_fields = ["thumbnail"]
 
+    # the smallest of the resized copies (see images.py), the original until they are generated
     def thumbnail(self, instance):
-        if instance.image.name != "":
-            return format_html(f"<image src='{instance.image.url}' class='thumbnail'/>")
-        return ""
+        if instance.image.name == "":
+            return ""
+        smallest = get_smallest_size(instance.sizes)
+        if smallest is None:
+            return format_html("<img src='{}' class='thumbnail'/>", instance.image.url)
+        storage = instance.image.storage
+        return format_html(
+            "<picture><source srcset='{}' type='image/webp'/>"
+            "<img src='{}' class='thumbnail' loading='lazy'/></picture>",
+            storage.url(smallest["webp"]),
+            storage.url(smallest["jpeg"]),
+        )
 
 
 # the relation between product and tag is a generic one so we use
@@ -100,7 +112,10 @@ class ProductAdmin(admin.ModelAdmin):
     # queryset is the items in the list that are selected by the user
     @admin.action(description="clear inventory for selected items")
     def clear_inventory(self, request, queryset):
+        product_ids = list(queryset.values_list("pk", flat=True))
         updated_count = queryset.update(inventory=0)
+        # queryset.update() skips the signal handlers, see inventory.restock
+        restock(dict.fromkeys(product_ids, 0))
         # the below "message_user" is a admin feature that allows sending
         # messages to logged in user
         self.message_user(
@@ -174,14 +189,13 @@ class OrderAdmin(admin.ModelAdmin):
         return order.customer.email
 
 
-# we want to display product count in list, but no products_count field in collection
-# so we must override the basquery for this list using (get_queryset) then we can use
-# it. This is example of overridng the base query for a list in the admin UI
+# we want to display product count in list. It used to be annotated by overriding the base query
+# for this list using (get_queryset), now it is stored on the collection (see counters.py)
 class CollectionAdmin(admin.ModelAdmin):
     search_fields = ["title"]
     list_display = ["title", "products_count"]
 
-    @admin.display(ordering="products_count")
+    @admin.display(ordering="product_count")
     def products_count(self, collection):
         # return collection.products_count
         #!!!NOTE!!! how to link a related column to its list page
@@ -192,10 +206,7 @@ class CollectionAdmin(admin.ModelAdmin):
         query_string = urlencode({"collection__pk": collection.pk})
         # combine both into final url and return the resultant formatted url
         url = f"{url_string}?{query_string}"  # page is called "changelist"
-        return format_html(f"<a href='{url}'>{collection.products_count}</a>")
-
-    def get_queryset(self, request: HttpRequest) -> QuerySet[Any]:
-        return super().get_queryset(request).annotate(products_count=Count("product"))
+        return format_html(f"<a href='{url}'>{collection.product_count}</a>")
 
 
 # Register your models here.
@@ -0,0 +1,98 @@
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.http import urlencode
+from rest_framework.response import Response
+
+
+# Versioned caching for the catalog (products, collections, images, promotions)
+# Instead of deleting cached pages when the catalog changes (which would mean scanning redis
+# for every key that could contain a product), every cache key embeds the current catalog
+# version. Writes to the catalog simply bump the version (see signals/handlers.py) so all
+# the old keys become unreachable at once and are left to expire on their own.
+CATALOG_VERSION_KEY = "store:catalog:version"
+CATALOG_HITS_KEY = "store:catalog:hits"
+CATALOG_MISSES_KEY = "store:catalog:misses"
+
+
+def get_catalog_version() -> int:
+    version = cache.get(CATALOG_VERSION_KEY)
+    if version is None:
+        # !!!NOTE!!! seed from the clock instead of starting at 1. If redis evicts the version key
+        # we must never come back to a number that older (now stale) pages were cached under.
+        cache.add(CATALOG_VERSION_KEY, time.time_ns(), timeout=None)
+        version = cache.get(CATALOG_VERSION_KEY)
+    return version
+
+
+def bump_catalog_version() -> None:
+    try:
+        cache.incr(CATALOG_VERSION_KEY)
+    except ValueError:
+        # incr raises ValueError when the key does not exist, seeding it is just as good as a bump
+        get_catalog_version()
+
+
+def _increment_counter(key: str) -> None:
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.add(key, 0, timeout=None)
+        cache.incr(key)
+
+
+def get_catalog_cache_stats() -> dict:
+    hits = cache.get(CATALOG_HITS_KEY, 0)
+    misses = cache.get(CATALOG_MISSES_KEY, 0)
+    lookups = hits + misses
+    return {
+        "version": get_catalog_version(),
+        "hits": hits,
+        "misses": misses,
+        "hit_ratio": round(hits / lookups, 4) if lookups else None,
+    }
+
+
+def build_catalog_cache_key(request, prefix: str, exclude=()) -> str:
+    # normalize the query string so that ?b=2&a=1 and ?a=1&b=2 share a cache entry.
+    # exclude lets callers drop params that do not change the result (eg. the page for a count)
+    params = sorted(
+        (key, value)
+        for key in request.query_params
+        if key not in exclude
+        for value in request.query_params.getlist(key)
+    )
+    # the absolute url is part of the key because the serializers render hyperlinks with
+    # the scheme and host of the request
+    signature = hashlib.md5(
+        f"{request.build_absolute_uri(request.path)}?{urlencode(params)}".encode()
+    ).hexdigest()
+    return f"store:catalog:{prefix}:{get_catalog_version()}:{signature}"
+
+
+# Add this mixin before ModelViewSet/GenericViewSet to serve list and retrieve from the cache.
+# We cache response.data rather than the rendered response so that the same entry can be
+# rendered as json or by the browsable api depending on what the client asks for.
+class CatalogCacheMixin:
+    def list(self, request, *args, **kwargs):
+        return self.cached_response("list", super().list, request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.cached_response(
+            "retrieve", super().retrieve, request, *args, **kwargs
+        )
+
+    def cached_response(self, action, handler, request, *args, **kwargs):
+        key = build_catalog_cache_key(request, f"{self.basename}:{action}")
+        data = cache.get(key)
+        if data is not None:
+            _increment_counter(CATALOG_HITS_KEY)
+            return Response(data)
+
+        _increment_counter(CATALOG_MISSES_KEY)
+        response = handler(request, *args, **kwargs)
+        if response.status_code == 200:
+            cache.set(key, response.data, timeout=settings.CATALOG_CACHE_TIMEOUT)
+        return response
@@ -0,0 +1,595 @@
+import logging
+from datetime import datetime, timezone as dt_timezone
+from decimal import Decimal
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import (
+    Count,
+    DecimalField,
+    Exists,
+    ExpressionWrapper,
+    F,
+    OuterRef,
+    Prefetch,
+    Sum,
+    Value,
+)
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+from django.utils.module_loading import import_string
+from redis import Redis
+from store.models import Cart, CartItem, Product
+
+logger = logging.getLogger(__name__)
+
+
+# Where carts are kept, settings.CART_STORE picks one:
+# - DatabaseCartStore: every change is written to the Cart/CartItem rows.
+# - RedisCartStore: carts live in redis and are written to the rows behind the client's back,
+#   at checkout and by the flush_carts task (see tasks.py).
+# The cart views (see views.py) only talk to the store. Both stores return Cart and CartItem
+# instances ready for the serializers: the items of a cart are in its cartitem_set (prefetched) and
+# each item has its product, so the api looks the same whichever store is used.
+def get_cart_store():
+    return import_string(settings.CART_STORE)()
+
+
+# CartItem.quantity is a PositiveSmallIntegerField
+MAX_QUANTITY = 32767
+
+
+# Raised by add_item and add_items when an item would end up with more than MAX_QUANTITY. Nothing
+# is written
+class QuantityTooLarge(Exception):
+    def __init__(self, product_ids):
+        super().__init__(product_ids)
+        self.product_ids = product_ids
+
+
+# quantity * unit price of the lines of a cart, prefix is the path from the queried model to CartItem
+def get_line_total(prefix=""):
+    return ExpressionWrapper(
+        F(f"{prefix}quantity") * F(f"{prefix}product__unit_price"),
+        output_field=DecimalField(max_digits=12, decimal_places=2),
+    )
+
+
+# the items of a cart with their product and their total_price
+def annotate_cart_items(queryset):
+    return queryset.select_related("product").annotate(total_price=get_line_total())
+
+
+def set_cart_items(cart, items):
+    # cart.cartitem_set.all() returns these without a query, as after prefetch_related
+    cart._prefetched_objects_cache = {"cartitem_set": items}
+
+
+# a cart without items, as the stores return it
+def set_empty_cart(cart):
+    set_cart_items(cart, [])
+    cart.item_count = 0
+    cart.total_price = Decimal(0)
+    return cart
+
+
+# the carts created before cutoff that have no item added or changed since
+def get_abandoned_carts(cutoff):
+    return Cart.objects.filter(created_at__lt=cutoff).exclude(
+        Exists(CartItem.objects.filter(cart=OuterRef("pk"), updated_at__gte=cutoff))
+    )
+
+
+# Deletes the carts that were not used for max_age (timedelta) and their items, batch_size carts at
+# a time: created before the cutoff and none of their items added or changed since (see
+# CartItem.updated_at). Each batch is found through the created_at index and deleted in its own
+# short transaction, so no lock is held for long and checkouts keep going while the sweep runs.
+# Returns (carts, items) deleted.
+# !!!NOTE!!! removing an item does not count as using the cart with the DatabaseCartStore. The
+# RedisCartStore writes the items of a changed cart again when it flushes them, keep max_age well
+# above CART_TTL so a cart that is still used in redis is not swept from under it.
+def delete_abandoned_carts(max_age, batch_size=500):
+    abandoned = get_abandoned_carts(timezone.now() - max_age)
+    carts = items = 0
+    while True:
+        cart_ids = list(
+            abandoned.order_by("created_at").values_list("pk", flat=True)[:batch_size]
+        )
+        if not cart_ids:
+            break
+        with transaction.atomic():
+            # Three statements per batch: the carts are selected again (skipping those changed
+            # since the first select), then their items and the carts are deleted
+            # (on_delete=CASCADE)
+            _, deleted = abandoned.filter(pk__in=cart_ids).delete()
+        carts += deleted.get("store.Cart", 0)
+        items += deleted.get("store.CartItem", 0)
+    return carts, items
+
+
+class DatabaseCartStore:
+    # fields are the sparse fields of CartModelSerializer (see get_sparse_fields), None for all.
+    # The items, their count and the total price are only loaded when they are rendered. The totals
+    # are computed by the db, the count and the total price in the same query as the cart
+    def get_cart(self, cart_id, fields=None):
+        queryset = Cart.objects.all()
+        if fields is None or "items" in fields:
+            queryset = queryset.prefetch_related(
+                Prefetch("cartitem_set", annotate_cart_items(CartItem.objects.all()))
+            )
+        if fields is None or "item_count" in fields:
+            queryset = queryset.annotate(item_count=Count("cartitem"))
+        if fields is None or "total_price" in fields:
+            queryset = queryset.annotate(
+                total_price=Coalesce(
+                    Sum(get_line_total("cartitem__")),
+                    Value(Decimal(0)),
+                    output_field=DecimalField(max_digits=12, decimal_places=2),
+                )
+            )
+        cart = queryset.filter(pk=cart_id).first()
+        if cart is None and settings.CART_LAZY_CREATE:
+            # the client made up the id and has not added anything yet, nothing is written
+            return set_empty_cart(Cart(id=cart_id))
+        return cart
+
+    # With CART_LAZY_CREATE clients make up the id of their cart and the first add creates it, see
+    # add_item and add_items. One statement that does nothing when the cart is already there
+    def create_missing_cart(self, cart_id):
+        Cart.objects.bulk_create([Cart(id=cart_id)], ignore_conflicts=True)
+
+    def create_cart(self):
+        return set_empty_cart(Cart.objects.create())
+
+    def delete_cart(self, cart_id) -> bool:
+        deleted, _ = Cart.objects.filter(pk=cart_id).delete()
+        return deleted > 0
+
+    def get_items(self, cart_id):
+        return list(annotate_cart_items(CartItem.objects.filter(cart__pk=cart_id)))
+
+    def get_item(self, cart_id, item_id):
+        return annotate_cart_items(
+            CartItem.objects.filter(cart__pk=cart_id, pk=item_id)
+        ).first()
+
+    # A product that is already in the cart gets its quantity increased. One statement checks that the
+    # cart and the product exist and inserts the item or adds to its quantity, so parallel adds to the
+    # same cart never lose an increment (or trip over unique_cart_product).
+    # Returns None when the cart does not exist, raises Product.DoesNotExist for a missing product
+    # and QuantityTooLarge when the item would go over MAX_QUANTITY. The sum is checked as an
+    # integer, a smallint sum over MAX_QUANTITY is an error in postgres
+    def add_item(self, cart_id, product_id, quantity):
+        if settings.CART_LAZY_CREATE:
+            # the cart is only kept if the item is added
+            with transaction.atomic():
+                self.create_missing_cart(cart_id)
+                return self.upsert_item(cart_id, product_id, quantity)
+        return self.upsert_item(cart_id, product_id, quantity)
+
+    def upsert_item(self, cart_id, product_id, quantity):
+        if connection.vendor not in ("sqlite", "postgresql"):
+            return self.add_item_without_upsert(cart_id, product_id, quantity)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                """
+                INSERT INTO store_cartitem (cart_id, product_id, quantity, updated_at)
+                SELECT c.id, p.id, %s, %s FROM store_cart c, store_product p
+                WHERE c.id = %s AND p.id = %s
+                ON CONFLICT (cart_id, product_id)
+                DO UPDATE SET quantity = store_cartitem.quantity + excluded.quantity,
+                    updated_at = excluded.updated_at
+                WHERE CAST(store_cartitem.quantity AS integer) + excluded.quantity <= %s
+                RETURNING id, quantity
+                """,
+                [
+                    quantity,
+                    CartItem._meta.get_field("updated_at").get_db_prep_value(
+                        timezone.now(), connection
+                    ),
+                    Cart._meta.pk.get_db_prep_value(cart_id, connection),
+                    product_id,
+                    MAX_QUANTITY,
+                ],
+            )
+            row = cursor.fetchone()
+        if row is None:
+            return self.missing_cart_or_product(cart_id, product_id)
+        pk, quantity = row
+        return CartItem(
+            pk=pk, cart_id=cart_id, product_id=product_id, quantity=quantity
+        )
+
+    # the same with two statements, the increment is still done by the db
+    def add_item_without_upsert(self, cart_id, product_id, quantity):
+        if not Product.objects.filter(pk=product_id).exists():
+            raise Product.DoesNotExist
+        if not Cart.objects.filter(pk=cart_id).exists():
+            return None
+        with transaction.atomic():
+            updated = CartItem.objects.filter(
+                cart_id=cart_id,
+                product_id=product_id,
+                quantity__lte=MAX_QUANTITY - quantity,
+            ).update(quantity=F("quantity") + quantity, updated_at=timezone.now())
+            if not updated:
+                if CartItem.objects.filter(
+                    cart_id=cart_id, product_id=product_id
+                ).exists():
+                    raise QuantityTooLarge([product_id])
+                return CartItem.objects.create(
+                    cart_id=cart_id, product_id=product_id, quantity=quantity
+                )
+        return CartItem.objects.get(cart_id=cart_id, product_id=product_id)
+
+    # only runs when nothing was added, to tell the client why
+    def missing_cart_or_product(self, cart_id, product_id):
+        if not Cart.objects.filter(pk=cart_id).exists():
+            return None
+        # the item is there, the upsert skipped it because the sum went over MAX_QUANTITY
+        if CartItem.objects.filter(cart_id=cart_id, product_id=product_id).exists():
+            raise QuantityTooLarge([product_id])
+        raise Product.DoesNotExist
+
+    # Adds many products at once, quantities is {product id: quantity}. With replace the cart ends
+    # up with exactly these items. The products must exist (see BatchCartItemsSerializer).
+    # All the lines are written with one bulk upsert. Returns the cart, None when it does not exist
+    def add_items(self, cart_id, quantities, replace=False):
+        with transaction.atomic():
+            if settings.CART_LAZY_CREATE:
+                self.create_missing_cart(cart_id)
+            # locking the cart holds back the other changes to it until we are done
+            if Cart.objects.select_for_update().filter(pk=cart_id).first() is None:
+                return None
+            items = CartItem.objects.filter(cart_id=cart_id)
+            if replace:
+                items.exclude(product_id__in=quantities).delete()
+            else:
+                in_cart = dict(
+                    items.filter(product_id__in=quantities)
+                    .select_for_update()
+                    .values_list("product_id", "quantity")
+                )
+                quantities = {
+                    product_id: quantity + in_cart.get(product_id, 0)
+                    for product_id, quantity in quantities.items()
+                }
+            too_large = sorted(
+                product_id
+                for product_id, quantity in quantities.items()
+                if quantity > MAX_QUANTITY
+            )
+            if too_large:
+                raise QuantityTooLarge(too_large)
+            CartItem.objects.bulk_create(
+                [
+                    CartItem(cart_id=cart_id, product_id=product_id, quantity=quantity)
+                    for product_id, quantity in quantities.items()
+                ],
+                update_conflicts=True,
+                unique_fields=["cart", "product"],
+                update_fields=["quantity", "updated_at"],
+            )
+        return self.get_cart(cart_id)
+
+    def update_item(self, cart_id, item_id, quantity):
+        cart_item = self.get_item(cart_id, item_id)
+        if cart_item is not None:
+            cart_item.quantity = quantity
+            cart_item.save(update_fields=["quantity", "updated_at"])
+        return cart_item
+
+    def remove_item(self, cart_id, item_id) -> bool:
+        deleted, _ = CartItem.objects.filter(cart__pk=cart_id, pk=item_id).delete()
+        return deleted > 0
+
+    # makes sure the Cart/CartItem rows are up to date, eg. before checking out
+    def persist(self, cart_id):
+        pass
+
+    # writes the carts changed since the last flush to the db, returns how many
+    def flush(self) -> int:
+        return 0
+
+
+# One redis hash per cart, "cart:<uuid>", expiring settings.CART_TTL seconds after its last change:
+#   created_at  -> timestamp
+#   p:<product> -> quantity
+# An item is identified by its product, so the pk of an item is its product id.
+# Changed carts are added to the "carts:dirty" set, flush() writes them to the rows. A cart that is
+# not in redis (it expired after being written to the db, or it was created before the store was
+# switched) is loaded from the rows.
+class RedisCartStore:
+    key_prefix = "cart:"
+    dirty_key = "carts:dirty"
+    product_prefix = "p:"
+
+    # KEYS: cart, dirty set. ARGV: field, quantity, ttl, cart id, mode, max quantity
+    # Changes one item of a cart that exists, in one round trip.
+    # mode "add" adds to the quantity, "set" only replaces the quantity of an item in the cart.
+    # Returns the new quantity, false when the cart (or item) is not there, or -1 (changing
+    # nothing) when the quantity would go over the max quantity
+    change_item_script = """
+    if redis.call('EXISTS', KEYS[1]) == 0 then return false end
+    local quantity
+    if ARGV[5] == 'add' then
+        local total = tonumber(ARGV[2]) + tonumber(redis.call('HGET', KEYS[1], ARGV[1]) or 0)
+        if total > tonumber(ARGV[6]) then return -1 end
+        quantity = redis.call('HINCRBY', KEYS[1], ARGV[1], ARGV[2])
+    elseif redis.call('HEXISTS', KEYS[1], ARGV[1]) == 1 then
+        redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+        quantity = tonumber(ARGV[2])
+    else
+        return false
+    end
+    redis.call('EXPIRE', KEYS[1], ARGV[3])
+    redis.call('SADD', KEYS[2], ARGV[4])
+    return quantity
+    """
+
+    # KEYS: cart, dirty set. ARGV: ttl, cart id, mode, max quantity, then field, quantity pairs
+    # The same for many items at once. mode "replace" first removes the items not in ARGV.
+    # Returns false when the cart is not there, and the fields that would go over the max quantity
+    # (changing nothing) when there are some
+    change_items_script = """
+    if redis.call('EXISTS', KEYS[1]) == 0 then return false end
+    local too_large = {}
+    for i = 5, #ARGV, 2 do
+        local quantity = tonumber(ARGV[i + 1])
+        if ARGV[3] == 'add' then
+            quantity = quantity + tonumber(redis.call('HGET', KEYS[1], ARGV[i]) or 0)
+        end
+        if quantity > tonumber(ARGV[4]) then table.insert(too_large, ARGV[i]) end
+    end
+    if #too_large > 0 then return too_large end
+    if ARGV[3] == 'replace' then
+        local keep = {}
+        for i = 5, #ARGV, 2 do keep[ARGV[i]] = true end
+        for _, field in ipairs(redis.call('HKEYS', KEYS[1])) do
+            if string.sub(field, 1, 2) == 'p:' and not keep[field] then
+                redis.call('HDEL', KEYS[1], field)
+            end
+        end
+    end
+    for i = 5, #ARGV, 2 do
+        if ARGV[3] == 'add' then
+            redis.call('HINCRBY', KEYS[1], ARGV[i], ARGV[i + 1])
+        else
+            redis.call('HSET', KEYS[1], ARGV[i], ARGV[i + 1])
+        end
+    end
+    redis.call('EXPIRE', KEYS[1], ARGV[1])
+    redis.call('SADD', KEYS[2], ARGV[2])
+    return 1
+    """
+
+    _redis = None
+
+    def __init__(self):
+        # one connection pool per process
+        if RedisCartStore._redis is None:
+            RedisCartStore._redis = Redis.from_url(settings.CART_REDIS_URL)
+        self.redis = RedisCartStore._redis
+        self.change_item = self.redis.register_script(self.change_item_script)
+        self.change_items = self.redis.register_script(self.change_items_script)
+
+    def get_key(self, cart_id):
+        return f"{self.key_prefix}{cart_id}"
+
+    def get_cart(self, cart_id, fields=None):
+        values = self.redis.hgetall(self.get_key(cart_id))
+        if not values:
+            values = self.load(cart_id)
+            if values is None and settings.CART_LAZY_CREATE:
+                # the client made up the id and has not added anything yet, nothing is written
+                return set_empty_cart(Cart(id=cart_id))
+            if values is None:
+                return None
+        created_at, quantities = self.parse(values)
+        cart = Cart(id=cart_id, created_at=created_at)
+        # the products are only needed to render the items and the total price
+        if fields is None or fields & {"items", "total_price"}:
+            items = self.make_items(cart, quantities)
+            set_cart_items(cart, items)
+            cart.total_price = sum((item.total_price for item in items), Decimal(0))
+        cart.item_count = len(quantities)
+        return cart
+
+    # hgetall of a cart -> (created_at, {product id: quantity})
+    def parse(self, values):
+        created_at = datetime.fromtimestamp(
+            float(values[b"created_at"]), tz=dt_timezone.utc
+        )
+        prefix = self.product_prefix.encode()
+        quantities = {
+            int(field[len(prefix) :]): int(quantity)
+            for field, quantity in values.items()
+            if field.startswith(prefix)
+        }
+        return created_at, quantities
+
+    # CartItems, in product order, for the products that still exist. Their total_price is set
+    # here, as annotate_cart_items does for the db store
+    def make_items(self, cart, quantities):
+        products = Product.objects.only("pk", "title", "unit_price").in_bulk(quantities)
+        items = []
+        for product_id, quantity in sorted(quantities.items()):
+            product = products.get(product_id)
+            if product is not None:
+                item = CartItem(
+                    pk=product_id, cart=cart, product=product, quantity=quantity
+                )
+                item.total_price = quantity * product.unit_price
+                items.append(item)
+        return items
+
+    # copies a cart from the db into redis, returns its hash (like hgetall) or None
+    def load(self, cart_id):
+        cart = Cart.objects.filter(pk=cart_id).first()
+        if cart is None:
+            return None
+        values = {"created_at": cart.created_at.timestamp()}
+        for product_id, quantity in CartItem.objects.filter(cart=cart).values_list(
+            "product_id", "quantity"
+        ):
+            values[f"{self.product_prefix}{product_id}"] = quantity
+        key = self.get_key(cart_id)
+        with self.redis.pipeline() as pipeline:
+            pipeline.hset(key, mapping=values)
+            pipeline.expire(key, settings.CART_TTL)
+            pipeline.execute()
+        return {field.encode(): str(value).encode() for field, value in values.items()}
+
+    def create_cart(self):
+        # not written to the db until it has items (see flush)
+        cart = Cart(created_at=timezone.now())
+        self.start_cart(cart.pk, cart.created_at)
+        return set_empty_cart(cart)
+
+    # a cart without items, keeps the created_at of a cart that is already there
+    def start_cart(self, cart_id, created_at):
+        key = self.get_key(cart_id)
+        with self.redis.pipeline() as pipeline:
+            pipeline.hsetnx(key, "created_at", created_at.timestamp())
+            pipeline.expire(key, settings.CART_TTL)
+            pipeline.execute()
+
+    # Called when a cart is not in redis. Loads it from the db, or with CART_LAZY_CREATE and create
+    # starts it (see DatabaseCartStore.create_missing_cart). False when there is no such cart
+    def restore(self, cart_id, create=False) -> bool:
+        if self.load(cart_id) is not None:
+            return True
+        if create and settings.CART_LAZY_CREATE:
+            self.start_cart(cart_id, timezone.now())
+            return True
+        return False
+
+    def delete_cart(self, cart_id) -> bool:
+        with self.redis.pipeline() as pipeline:
+            pipeline.delete(self.get_key(cart_id))
+            pipeline.srem(self.dirty_key, str(cart_id))
+            in_redis, _ = pipeline.execute()
+        deleted, _ = Cart.objects.filter(pk=cart_id).delete()
+        return bool(in_redis or deleted)
+
+    def get_items(self, cart_id):
+        cart = self.get_cart(cart_id)
+        return [] if cart is None else cart.cartitem_set.all()
+
+    def get_item(self, cart_id, item_id):
+        cart = self.get_cart(cart_id)
+        if cart is None:
+            return None
+        return next(
+            (item for item in cart.cartitem_set.all() if item.pk == item_id), None
+        )
+
+    def run_change_item(self, cart_id, product_id, quantity, mode):
+        args = [
+            f"{self.product_prefix}{product_id}",
+            quantity,
+            settings.CART_TTL,
+            str(cart_id),
+            mode,
+            MAX_QUANTITY,
+        ]
+        keys = [self.get_key(cart_id), self.dirty_key]
+        new_quantity = self.change_item(keys=keys, args=args)
+        # the cart may only be in the db (or not exist yet), restore it and try again
+        if new_quantity is None and self.restore(cart_id, create=mode == "add"):
+            new_quantity = self.change_item(keys=keys, args=args)
+        if new_quantity == -1:
+            raise QuantityTooLarge([product_id])
+        return new_quantity
+
+    def add_item(self, cart_id, product_id, quantity):
+        if not Product.objects.filter(pk=product_id).exists():
+            raise Product.DoesNotExist
+        new_quantity = self.run_change_item(cart_id, product_id, quantity, "add")
+        if new_quantity is None:
+            return None
+        return CartItem(
+            pk=product_id, cart_id=cart_id, product_id=product_id, quantity=new_quantity
+        )
+
+    def add_items(self, cart_id, quantities, replace=False):
+        args = [
+            settings.CART_TTL,
+            str(cart_id),
+            "replace" if replace else "add",
+            MAX_QUANTITY,
+        ]
+        for product_id, quantity in quantities.items():
+            args += [f"{self.product_prefix}{product_id}", quantity]
+        keys = [self.get_key(cart_id), self.dirty_key]
+        changed = self.change_items(keys=keys, args=args)
+        # the cart may only be in the db (or not exist yet), restore it and try again
+        if changed is None and self.restore(cart_id, create=True):
+            changed = self.change_items(keys=keys, args=args)
+        if changed is None:
+            return None
+        if isinstance(changed, list):
+            prefix = len(self.product_prefix)
+            raise QuantityTooLarge(sorted(int(field[prefix:]) for field in changed))
+        return self.get_cart(cart_id)
+
+    def update_item(self, cart_id, item_id, quantity):
+        if self.run_change_item(cart_id, item_id, quantity, "set") is None:
+            return None
+        return CartItem(
+            pk=item_id, cart_id=cart_id, product_id=item_id, quantity=quantity
+        )
+
+    def remove_item(self, cart_id, item_id) -> bool:
+        key = self.get_key(cart_id)
+        if not self.redis.exists(key):
+            self.load(cart_id)
+        with self.redis.pipeline() as pipeline:
+            pipeline.hdel(key, f"{self.product_prefix}{item_id}")
+            pipeline.sadd(self.dirty_key, str(cart_id))
+            removed, _ = pipeline.execute()
+        return removed > 0
+
+    # Replaces the rows of a cart with what is in redis
+    def persist(self, cart_id):
+        values = self.redis.hgetall(self.get_key(cart_id))
+        if not values:
+            # expired (the rows are already up to date) or deleted
+            return
+        created_at, quantities = self.parse(values)
+        product_ids = Product.objects.filter(pk__in=quantities).values_list(
+            "pk", flat=True
+        )
+        with transaction.atomic():
+            if not Cart.objects.filter(pk=cart_id).exists():
+                Cart.objects.create(id=cart_id)
+                # created_at is auto_now_add, keep the time the client created the cart
+                Cart.objects.filter(pk=cart_id).update(created_at=created_at)
+            CartItem.objects.filter(cart_id=cart_id).delete()
+            CartItem.objects.bulk_create(
+                [
+                    CartItem(
+                        cart_id=cart_id,
+                        product_id=product_id,
+                        quantity=quantities[product_id],
+                    )
+                    for product_id in product_ids
+                ]
+            )
+
+    def flush(self, batch_size=100) -> int:
+        flushed = 0
+        failed = []
+        while cart_ids := self.redis.spop(self.dirty_key, batch_size):
+            for cart_id in cart_ids:
+                cart_id = cart_id.decode()
+                try:
+                    self.persist(cart_id)
+                except Exception:
+                    failed.append(cart_id)
+                    logger.exception("Could not write cart %s to the db", cart_id)
+                else:
+                    flushed += 1
+        # tried again on the next flush
+        if failed:
+            self.redis.sadd(self.dirty_key, *failed)
+        return flushed
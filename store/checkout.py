@@ -0,0 +1,71 @@
+from django.db import transaction
+from rest_framework.exceptions import ValidationError
+
+from .carts import get_cart_store
+from .inventory import take_stock
+from .models import Cart, CartItem, Customer, Order, OrderItem
+from .signals import order_created
+
+
+# Turns a cart into an order in a fixed number of queries, whatever the size of the cart:
+# 1. the customer of the user
+# 2. the items of the cart with their products and stock, locking the item rows. A second checkout
+#    of the same cart waits on its items and then finds the cart gone
+# 3-4. the items are taken off the stock (see inventory.take_stock), only if there are enough.
+#    The product rows are not locked or written, checkouts of a product only wait on each other
+#    for its stock row, or for one of its buckets when it has some
+# 5. the order, 6. its items (bulk insert), 7-9. the cart and its items are deleted
+# Everything runs in one transaction: when a product does not have enough stock nothing is
+# written (the client gets a 400). order_created is sent once the order is committed.
+# !!!NOTE!!! Product.inventory and Product.last_update are left alone, so selling a product does
+# not change its etag or evict it from the catalog cache. The inventory shown in the catalog is
+# refreshed by the sync_product_inventory task, the stock is what prevents oversells.
+def place_order(cart_id, user_id) -> Order:
+    # carts kept outside the db (see carts.py) are written to it first
+    get_cart_store().persist(cart_id)
+
+    customer_id = (
+        Customer.objects.filter(user__pk=user_id).values_list("pk", flat=True).first()
+    )
+    if customer_id is None:
+        raise ValidationError({"non_field_errors": ["No customer for this user."]})
+
+    with transaction.atomic():
+        cart_items = list(
+            CartItem.objects.select_related("product", "product__stock")
+            .select_for_update(of=("self",))
+            .filter(cart__pk=cart_id)
+            .order_by("product_id")
+        )
+        if not cart_items:
+            if not Cart.objects.filter(pk=cart_id).exists():
+                raise ValidationError(
+                    {"cart_id": ["No cart with the given Id was found."]}
+                )
+            raise ValidationError({"cart_id": ["The cart is empty."]})
+
+        take_stock(cart_items)
+
+        order = Order.objects.create(customer_id=customer_id)
+        order_items = OrderItem.objects.bulk_create(
+            [
+                OrderItem(
+                    order=order,
+                    product=item.product,
+                    unit_price=item.product.unit_price,
+                    quantity=item.quantity,
+                )
+                for item in cart_items
+            ]
+        )
+        # rendered by OrderModelSerializer without querying them again
+        order._prefetched_objects_cache = {"orderitem_set": order_items}
+
+        # remove Cart and cart items (deleted by cascade)
+        get_cart_store().delete_cart(cart_id)
+
+        # fire signal. parameters are the class firing the signal and some kwargs.
+        # handlers run once the order is committed, not while its rows are locked
+        transaction.on_commit(lambda: order_created.send_robust(Order, order=order))
+
+    return order
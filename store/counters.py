@@ -0,0 +1,46 @@
+from django.db import transaction
+from django.db.models import Count, F, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+from .models import Collection, Product
+
+
+# Collection.product_count is stored instead of annotated with Count("product") on every read.
+# The product signal handlers (see signals/handlers.py) adjust it with F() expressions so the
+# db does the arithmetic and concurrent writes never overwrite each other's counts.
+def add_to_product_count(collection_id, delta: int) -> None:
+    Collection.objects.filter(pk=collection_id).update(
+        product_count=F("product_count") + delta
+    )
+
+
+def move_product(from_collection_id, to_collection_id) -> None:
+    with transaction.atomic():
+        add_to_product_count(from_collection_id, -1)
+        add_to_product_count(to_collection_id, 1)
+
+
+# queryset.update(), bulk_create() and raw sql skip the signal handlers. This recounts every
+# collection in two statements and fixes the ones that drifted.
+# Returns the number of collections that were repaired.
+def reconcile_product_counts() -> int:
+    actual_count = Coalesce(
+        Subquery(
+            Product.objects.filter(collection=OuterRef("pk"))
+            .order_by()
+            .values("collection")
+            .annotate(count=Count("pk"))
+            .values("count")
+        ),
+        0,
+    )
+    with transaction.atomic():
+        drifted = (
+            Collection.objects.select_for_update()
+            .annotate(actual_count=actual_count)
+            .exclude(product_count=F("actual_count"))
+            .values_list("pk", flat=True)
+        )
+        return Collection.objects.filter(pk__in=list(drifted)).update(
+            product_count=actual_count
+        )
@@ -0,0 +1,42 @@
+import csv
+import json
+from itertools import islice
+
+from rest_framework.utils.encoders import JSONEncoder
+
+
+# Streaming catalog export
+# Products are read with .values() and iterator(chunk_size) so the db hands them over a chunk at
+# a time, and every chunk is rendered by ProductValuesSerializer, which fetches the images of the
+# chunk in one query. Only one chunk is ever held in memory, however big the catalog is.
+def iter_products(serializer, queryset, chunk_size):
+    rows = queryset.iterator(chunk_size=chunk_size)
+    while chunk := list(islice(rows, chunk_size)):
+        yield from serializer.to_representation(chunk)
+
+
+# one json object per line
+def iter_ndjson(products):
+    encoder = JSONEncoder()
+    for product in products:
+        yield encoder.encode(product) + "\n"
+
+
+# csv.writer wants a file, this one hands back what is written so it can be streamed
+class Echo:
+    def write(self, value):
+        return value
+
+
+# nested fields are flattened: collection_object is already covered by collection and
+# collection_str, and the images become a space separated list of urls
+def iter_csv(products, field_names):
+    columns = [name for name in field_names if name != "collection_object"]
+    writer = csv.writer(Echo())
+    yield writer.writerow(columns)
+    for product in products:
+        if "productimage_set" in product:
+            product["productimage_set"] = " ".join(
+                image["image"] or "" for image in product["productimage_set"]
+            )
+        yield writer.writerow([product[column] for column in columns])
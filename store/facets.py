@@ -0,0 +1,41 @@
+from decimal import Decimal
+
+from django.db.models import Count, F, Value
+from django.db.models.functions import Floor
+
+
+# Facets for the storefront sidebar: how many of the filtered products are in each collection
+# and in each unit_price bucket. Both come from one GROUP BY (collection, price bucket) query, the
+# rows are then summed up per collection and per bucket here. There are at most
+# collections x buckets rows so this stays small however many products match.
+def get_product_facets(queryset, bucket_size: Decimal) -> dict:
+    rows = (
+        queryset.order_by()
+        .annotate(price_bucket=Floor(F("unit_price") / Value(bucket_size)))
+        .values("collection_id", "collection__title", "price_bucket")
+        .annotate(count=Count("pk"))
+    )
+
+    collections = {}
+    buckets = {}
+    for row in rows:
+        collection = collections.setdefault(
+            row["collection_id"],
+            {"pk": row["collection_id"], "title": row["collection__title"], "count": 0},
+        )
+        collection["count"] += row["count"]
+        bucket = int(row["price_bucket"])
+        buckets[bucket] = buckets.get(bucket, 0) + row["count"]
+
+    return {
+        "count": sum(buckets.values()),
+        "collections": sorted(collections.values(), key=lambda c: c["title"]),
+        "unit_price": [
+            {
+                "min": bucket * bucket_size,
+                "max": (bucket + 1) * bucket_size,
+                "count": count,
+            }
+            for bucket, count in sorted(buckets.items())
+        ],
+    }
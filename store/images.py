@@ -0,0 +1,75 @@
+from io import BytesIO
+from pathlib import PurePosixPath
+from django.core.files.base import ContentFile
+from PIL import Image, ImageOps
+
+# Resized copies of every ProductImage, generated in the background by tasks.generate_image_sizes.
+# name -> longest side in px. The admin thumbnails are 100px (see static/store/css/styles.css),
+# "thumbnail" is twice that for high density screens.
+IMAGE_SIZES = {
+    "thumbnail": 200,
+    "medium": 600,
+    "large": 1200,
+}
+# format -> (extension, save options). Browsers without webp fall back to the jpeg
+IMAGE_FORMATS = {
+    "webp": ("webp", {"quality": 80, "method": 4}),
+    "jpeg": ("jpg", {"quality": 85, "optimize": True, "progressive": True}),
+}
+
+
+# store/images/dog.jpg -> store/images/dog_thumbnail.webp, next to the original
+def get_derivative_name(name, size, format) -> str:
+    path = PurePosixPath(name)
+    extension, _ = IMAGE_FORMATS[format]
+    return str(path.with_name(f"{path.stem}_{size}.{extension}"))
+
+
+def make_derivatives(image_file) -> dict:
+    """
+    Writes every size and format of image_file (a FieldFile) to its storage.
+    Returns {size: {format: name}}, the value of ProductImage.sizes.
+    """
+    storage = image_file.storage
+    with image_file.open("rb"):
+        original = Image.open(image_file)
+        # phone photos are stored sideways with an exif rotation
+        original = ImageOps.exif_transpose(original)
+        original.load()
+
+    sizes = {}
+    for size, pixels in IMAGE_SIZES.items():
+        resized = original.copy()
+        # never scales up, a small original is only re-encoded
+        resized.thumbnail((pixels, pixels), Image.Resampling.LANCZOS)
+        sizes[size] = {}
+        for format, (_, options) in IMAGE_FORMATS.items():
+            converted = resized
+            if format == "jpeg" and resized.mode != "RGB":
+                converted = resized.convert("RGB")
+            elif resized.mode not in ("RGB", "RGBA"):
+                converted = resized.convert("RGBA")
+            content = BytesIO()
+            converted.save(content, format=format.upper(), **options)
+            name = get_derivative_name(image_file.name, size, format)
+            # storage.save would pick a new name instead of replacing an older derivative
+            if storage.exists(name):
+                storage.delete(name)
+            sizes[size][format] = storage.save(name, ContentFile(content.getvalue()))
+    return sizes
+
+
+# the smallest size there is, for previews. None until the sizes have been generated
+def get_smallest_size(sizes):
+    for size in IMAGE_SIZES:
+        if size in sizes:
+            return sizes[size]
+    return None
+
+
+# {size: {format: name}} -> {size: {format: url}}
+def get_size_urls(sizes, get_url) -> dict:
+    return {
+        size: {format: get_url(name) for format, name in formats.items()}
+        for size, formats in sizes.items()
+    }
@@ -0,0 +1,301 @@
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, F, OuterRef, Subquery, Sum, Value, When
+from django.db.models.functions import Coalesce
+from rest_framework.exceptions import ValidationError
+
+from .cache import bump_catalog_version
+from .models import Product, ProductStock, StockBucket
+
+# Checkouts take their items from ProductStock, not from Product.inventory. Every checkout of a
+# product used to update (and lock until it committed) the product row, so checkouts of a popular
+# product ran one at a time. The stock row is still a single row, so a hot product can be split
+# into buckets (see shard_stock): a checkout takes from a bucket no other checkout holds, so
+# concurrent checkouts do not wait on each other. An empty bucket is refilled from
+# ProductStock.available, STOCK_BUCKET_REFILL items at a time.
+# Product.inventory is a copy of the stock for the catalog and the admin, refreshed by
+# sync_product_inventory for the stock rows and buckets marked changed by the writes here.
+# Editing it (eg. in the admin) adds the difference to the stock, see add_stock: the copy it was
+# edited from can lag the checkouts, setting the stock to it would sell the same items again.
+
+
+# Sets the stock of {product id: level}. Buckets are emptied, the level is what is left to sell
+def restock(levels: dict) -> None:
+    if not levels:
+        return
+    with transaction.atomic():
+        ProductStock.objects.bulk_create(
+            [
+                ProductStock(product_id=product_id, available=level)
+                for product_id, level in levels.items()
+            ],
+            update_conflicts=True,
+            unique_fields=["product"],
+            update_fields=["available", "changed"],
+        )
+        StockBucket.objects.filter(product_id__in=levels).update(
+            available=0, changed=True
+        )
+
+
+# Adds the edits of Product.inventory to the stock, changes is {product id: (inventory before,
+# inventory after)}. A decrease takes from the buckets too (they are gathered back into the stock
+# row) and leaves 0 when there is less left than it takes off. A product without a stock row starts
+# at its inventory before
+def add_stock(changes: dict) -> None:
+    changes = {
+        product_id: (before, after)
+        for product_id, (before, after) in changes.items()
+        if after != before
+    }
+    if not changes:
+        return
+    with transaction.atomic():
+        ProductStock.objects.bulk_create(
+            [
+                ProductStock(product_id=product_id, available=before)
+                for product_id, (before, _) in changes.items()
+            ],
+            ignore_conflicts=True,
+        )
+        available = dict(
+            ProductStock.objects.select_for_update()
+            .filter(pk__in=changes)
+            .order_by("pk")
+            .values_list("pk", "available")
+        )
+        for product_id, (before, after) in changes.items():
+            if after < before:
+                available[product_id] += drain_buckets(product_id)
+            available[product_id] = max(available[product_id] + after - before, 0)
+        levels = Case(
+            *[
+                When(pk=product_id, then=Value(level))
+                for product_id, level in available.items()
+            ]
+        )
+        ProductStock.objects.filter(pk__in=available).update(
+            available=levels, changed=True
+        )
+
+
+# Products created with bulk_create() or raw sql have no stock row yet, it starts at their inventory
+def create_missing_stock(product_ids=None) -> None:
+    products = Product.objects.filter(stock__isnull=True)
+    if product_ids is not None:
+        products = products.filter(pk__in=product_ids)
+    ProductStock.objects.bulk_create(
+        [
+            ProductStock(product_id=product_id, available=inventory)
+            for product_id, inventory in products.values_list("pk", "inventory")
+        ],
+        ignore_conflicts=True,
+    )
+
+
+# Splits the stock of a product into that many buckets, 0 to take checkouts from
+# ProductStock.available again. The stock of the old buckets goes back to available and the new
+# ones are filled with up to STOCK_BUCKET_REFILL items each
+def shard_stock(product_id, buckets: int) -> None:
+    create_missing_stock([product_id])
+    with transaction.atomic():
+        stock = ProductStock.objects.select_for_update().get(pk=product_id)
+        available = stock.available + drain_buckets(product_id)
+        StockBucket.objects.filter(product_id=product_id, index__gte=buckets).delete()
+        filled = []
+        for index in range(buckets):
+            refill = min(available, settings.STOCK_BUCKET_REFILL)
+            filled.append(
+                StockBucket(product_id=product_id, index=index, available=refill)
+            )
+            available -= refill
+        StockBucket.objects.bulk_create(
+            filled,
+            update_conflicts=True,
+            unique_fields=["product", "index"],
+            update_fields=["available", "changed"],
+        )
+        ProductStock.objects.filter(pk=product_id).update(
+            available=available, buckets=buckets, changed=True
+        )
+
+
+# Empties the buckets of a product and returns what they held. The caller has locked the stock row
+def drain_buckets(product_id) -> int:
+    buckets = list(
+        StockBucket.objects.select_for_update()
+        .filter(product_id=product_id, available__gt=0)
+        .order_by("index")
+    )
+    if not buckets:
+        return 0
+    StockBucket.objects.filter(pk__in=[bucket.pk for bucket in buckets]).update(
+        available=0, changed=True
+    )
+    return sum(bucket.available for bucket in buckets)
+
+
+# Takes the items of a checkout off the stock. cart_items are read with select_related("product",
+# "product__stock") and ordered by product. The stock rows of the products without buckets are
+# locked in that order too, so two checkouts sharing products never deadlock, and taken with one
+# UPDATE:
+#   available = available - CASE product_id WHEN <product> THEN <quantity> ... END
+# Sharded products take from a bucket each, see take_from_buckets.
+# Raises a ValidationError naming the products that ran out, the caller's transaction is rolled back
+def take_stock(cart_items) -> None:
+    missing = [item for item in cart_items if not hasattr(item.product, "stock")]
+    if missing:
+        ProductStock.objects.bulk_create(
+            [
+                ProductStock(
+                    product_id=item.product_id, available=item.product.inventory
+                )
+                for item in missing
+            ],
+            ignore_conflicts=True,
+        )
+        for item in missing:
+            item.product.stock = ProductStock(
+                product_id=item.product_id, available=item.product.inventory
+            )
+
+    unsharded = [item for item in cart_items if not item.product.stock.buckets]
+    if unsharded:
+        available = dict(
+            ProductStock.objects.select_for_update()
+            .filter(pk__in=[item.product_id for item in unsharded])
+            .order_by("pk")
+            .values_list("pk", "available")
+        )
+        raise_out_of_stock(
+            [item for item in unsharded if available[item.product_id] < item.quantity]
+        )
+        quantity = Case(
+            *[When(pk=item.product_id, then=Value(item.quantity)) for item in unsharded]
+        )
+        ProductStock.objects.filter(pk__in=available).update(
+            available=F("available") - quantity, changed=True
+        )
+
+    raise_out_of_stock(
+        [
+            item
+            for item in cart_items
+            if item.product.stock.buckets
+            and not take_from_buckets(item.product.stock, item.quantity)
+        ]
+    )
+
+
+def raise_out_of_stock(items):
+    if not items:
+        return
+    titles = ", ".join(item.product.title for item in items)
+    raise ValidationError({"cart_id": [f"Not enough inventory for {titles}."]})
+
+
+# Takes quantity from one of the buckets of the product that has enough and that no concurrent
+# checkout holds: SKIP LOCKED passes over the buckets other checkouts have taken from instead of
+# waiting for them to commit. The bucket stays locked until this checkout commits. When every
+# bucket is empty or taken the checkout takes from the stock row, see take_from_stock.
+# Returns False when the product does not have quantity items left.
+def take_from_buckets(stock: ProductStock, quantity: int) -> bool:
+    bucket = (
+        StockBucket.objects.select_for_update(skip_locked=True)
+        .filter(product_id=stock.pk, available__gte=quantity)
+        .order_by("?")
+        .first()
+    )
+    if bucket is None:
+        return take_from_stock(stock.pk, quantity)
+    StockBucket.objects.filter(pk=bucket.pk).update(
+        available=F("available") - quantity, changed=True
+    )
+    return True
+
+
+# Takes quantity straight from the locked stock row and moves up to STOCK_BUCKET_REFILL more into
+# the emptiest bucket no other checkout holds. What is left in the buckets is gathered back first
+# when the row is short of quantity, eg. 2 buckets holding 1 item each for a checkout of 2.
+def take_from_stock(product_id, quantity: int) -> bool:
+    stock = ProductStock.objects.select_for_update().get(pk=product_id)
+    if stock.available < quantity:
+        stock.available += drain_buckets(product_id)
+        if stock.available < quantity:
+            return False
+    stock.available -= quantity
+    bucket = (
+        StockBucket.objects.select_for_update(skip_locked=True)
+        .filter(product_id=product_id, index__lt=stock.buckets)
+        .order_by("available")
+        .first()
+    )
+    if bucket is not None:
+        refill = min(stock.available, settings.STOCK_BUCKET_REFILL)
+        StockBucket.objects.filter(pk=bucket.pk).update(
+            available=F("available") + refill, changed=True
+        )
+        stock.available -= refill
+    ProductStock.objects.filter(pk=product_id).update(
+        available=stock.available, changed=True
+    )
+    return True
+
+
+# Copies what is left to sell (the stock row and its buckets) into Product.inventory, for the
+# catalog and the admin, for the products whose stock changed since the last run. Like the
+# checkouts it uses queryset.update(): last_update is left alone, the catalog version is bumped
+# when an inventory changed (the product etags include it, see views.py). Products without a stock
+# row have not been sold since, their inventory is the stock.
+# Returns the number of products whose inventory changed.
+def sync_product_inventory() -> int:
+    product_ids = take_changed_stock()
+    if not product_ids:
+        return 0
+    try:
+        available = Subquery(
+            ProductStock.objects.filter(pk=OuterRef("pk")).values("available")
+        ) + Coalesce(
+            Subquery(
+                StockBucket.objects.filter(product=OuterRef("pk"))
+                .order_by()
+                .values("product")
+                .annotate(total=Sum("available"))
+                .values("total")
+            ),
+            0,
+        )
+        with transaction.atomic():
+            updated = (
+                Product.objects.filter(pk__in=product_ids)
+                .annotate(available=available)
+                .exclude(inventory=F("available"))
+                .update(inventory=available)
+            )
+            if updated:
+                transaction.on_commit(bump_catalog_version)
+    except Exception:
+        # left for the next run
+        ProductStock.objects.filter(pk__in=product_ids).update(changed=True)
+        raise
+    return updated
+
+
+# Clears the changed flags and returns the ids of their products. The rows a checkout holds are
+# skipped, its UPDATE has flagged them again for the next run. The flags are cleared before the
+# stock is read, a checkout that commits after that flags its rows again
+def take_changed_stock() -> set:
+    with transaction.atomic():
+        stock = list(
+            ProductStock.objects.select_for_update(skip_locked=True)
+            .filter(changed=True)
+            .values_list("pk", flat=True)
+        )
+        buckets = dict(
+            StockBucket.objects.select_for_update(skip_locked=True)
+            .filter(changed=True)
+            .values_list("pk", "product_id")
+        )
+        ProductStock.objects.filter(pk__in=stock).update(changed=False)
+        StockBucket.objects.filter(pk__in=buckets).update(changed=False)
+    return {*stock, *buckets.values()}
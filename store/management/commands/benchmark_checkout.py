@@ -0,0 +1,164 @@
+import statistics
+import threading
+import time
+import uuid
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import connection, connections
+from django.db.models import Sum
+from rest_framework import status
+from rest_framework.test import APIClient
+
+from store.inventory import shard_stock
+from store.models import (
+    Cart,
+    CartItem,
+    Collection,
+    Order,
+    OrderItem,
+    Product,
+    ProductStock,
+    StockBucket,
+)
+
+
+# Checks out carts that all hold the same product from concurrent threads, through POST
+# /store/orders/ (OrderViewSet.create), once per number of stock buckets (see inventory.py).
+# The carts, users and the product are committed so the threads can see them, and deleted at the
+# end. Run it against postgres (see DATABASES in settings/dev.py): sqlite lets one transaction
+# write at a time whatever the rows.
+# --db-latency adds that many milliseconds to every query the checkouts make, like a db on
+# another host would. A checkout holds its stock row (or bucket) for the round trips that follow
+# the UPDATE, on a local db those are too short for the checkouts to wait on each other.
+# eg. DATABASE_URL=postgres://user@localhost/store \
+#     python manage.py benchmark_checkout --threads 16 --checkouts 2000 --buckets 0 8 --db-latency 1
+class Command(BaseCommand):
+    help = "Measures concurrent checkouts of a single hot product with and without stock buckets"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--threads", type=int, default=16)
+        parser.add_argument("--checkouts", type=int, default=1000)
+        parser.add_argument("--buckets", type=int, nargs="+", default=[0, 8])
+        parser.add_argument("--quantity", type=int, default=1)
+        parser.add_argument("--db-latency", type=float, default=0)
+
+    def handle(self, *args, **options):
+        self.stdout.write(
+            f"{options['checkouts']} checkouts of one product from {options['threads']} "
+            f"threads on {connection.vendor}, {options['db_latency']}ms per query:"
+        )
+        self.stdout.write(
+            f"{'buckets':<10}{'checkouts/s':>14}{'median':>10}{'p95':>10}{'failed':>9}"
+            f"{'left':>7}"
+        )
+        users = self.create_users(options["threads"])
+        try:
+            for buckets in options["buckets"]:
+                self.measure(buckets, users, options)
+        finally:
+            get_user_model().objects.filter(pk__in=[user.pk for user in users]).delete()
+
+    def create_users(self, count):
+        # a Customer is created with each user, see signals/handlers.py
+        prefix = uuid.uuid4().hex[:8]
+        return [
+            get_user_model().objects.create_user(
+                f"checkout_{prefix}_{index}", f"checkout_{prefix}_{index}@home.test"
+            )
+            for index in range(count)
+        ]
+
+    def measure(self, buckets, users, options):
+        checkouts, quantity = options["checkouts"], options["quantity"]
+        collection = Collection.objects.create(title="benchmark checkout")
+        product = Product.objects.create(
+            title="hot product",
+            slug="hot-product",
+            unit_price=1,
+            inventory=checkouts * quantity,
+            collection=collection,
+        )
+        try:
+            carts = Cart.objects.bulk_create(Cart() for _ in range(checkouts))
+            CartItem.objects.bulk_create(
+                CartItem(cart=cart, product=product, quantity=quantity)
+                for cart in carts
+            )
+            if buckets:
+                shard_stock(product.pk, buckets)
+
+            cart_ids = iter([cart.pk for cart in carts])
+            lock = threading.Lock()
+            latencies, failed = [], []
+            threads = [
+                threading.Thread(
+                    target=self.check_out,
+                    args=(
+                        user,
+                        cart_ids,
+                        lock,
+                        latencies,
+                        failed,
+                        options["db_latency"],
+                    ),
+                )
+                for user in users
+            ]
+            start = time.perf_counter()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.perf_counter() - start
+
+            latencies.sort()
+            self.stdout.write(
+                f"{buckets:<10}{len(latencies) / elapsed:>14.1f}"
+                f"{statistics.median(latencies) * 1000:>8.1f}ms"
+                f"{latencies[int(len(latencies) * 0.95)] * 1000:>8.1f}ms"
+                f"{len(failed):>9}{self.get_stock_left(product):>7}"
+            )
+        finally:
+            order_items = OrderItem.objects.filter(product=product)
+            orders = list(order_items.values_list("order_id", flat=True))
+            order_items.delete()
+            Order.objects.filter(pk__in=orders).delete()
+            Cart.objects.filter(cartitem__product=product).delete()
+            product.delete()
+            collection.delete()
+
+    # the stock row and its buckets, 0 when every checkout went through
+    def get_stock_left(self, product):
+        stock = ProductStock.objects.get(product=product)
+        buckets = StockBucket.objects.filter(product=product).aggregate(
+            total=Sum("available")
+        )
+        return stock.available + (buckets["total"] or 0)
+
+    # each thread checks out carts until there are none left, on its own db connection
+    def check_out(self, user, cart_ids, lock, latencies, failed, db_latency):
+        # a request that fails counts as failed instead of stopping the thread
+        client = APIClient(raise_request_exception=False)
+        client.force_authenticate(user=user)
+
+        def delay(execute, sql, params, many, context):
+            time.sleep(db_latency / 1000)
+            return execute(sql, params, many, context)
+
+        try:
+            with connection.execute_wrapper(delay):
+                while True:
+                    with lock:
+                        cart_id = next(cart_ids, None)
+                    if cart_id is None:
+                        return
+                    start = time.perf_counter()
+                    response = client.post("/store/orders/", {"cart_id": cart_id})
+                    elapsed = time.perf_counter() - start
+                    with lock:
+                        latencies.append(elapsed)
+                        if response.status_code != status.HTTP_200_OK:
+                            failed.append(response.status_code)
+        finally:
+            connections.close_all()
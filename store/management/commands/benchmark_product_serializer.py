@@ -0,0 +1,94 @@
+import random
+import time
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from rest_framework.renderers import JSONRenderer
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+
+from store.models import Collection, Product, ProductImage
+from store.serializers import ProductModelSerializer, ProductValuesSerializer
+
+
+# Compares rendering a product listing with ProductModelSerializer and with the read only
+# ProductValuesSerializer fast path. Rows are created inside a transaction that is rolled back,
+# so nothing is left behind. eg. python manage.py benchmark_product_serializer --rows 10000
+class Command(BaseCommand):
+    help = "Benchmarks the product list serializers"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rows", type=int, default=10_000)
+        parser.add_argument("--repeat", type=int, default=5)
+        parser.add_argument("--seed", type=int, default=42)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options["seed"])
+        request = Request(
+            APIRequestFactory().get("/store/products/", HTTP_HOST="localhost")
+        )
+        context = {"request": request}
+        queryset = Product.objects.select_related("collection").prefetch_related(
+            "productimage_set"
+        )
+
+        with transaction.atomic():
+            self.populate(options["rows"], rng)
+
+            def model_serializer():
+                data = ProductModelSerializer(queryset, many=True, context=context).data
+                return JSONRenderer().render(data)
+
+            def values_serializer():
+                serializer = ProductValuesSerializer(context=context)
+                data = serializer.to_representation(serializer.get_queryset(queryset))
+                return JSONRenderer().render(data)
+
+            old = self.best_of(model_serializer, options["repeat"])
+            new = self.best_of(values_serializer, options["repeat"])
+            assert model_serializer() == values_serializer()
+            transaction.set_rollback(True)
+
+        self.stdout.write(
+            f"{options['rows']} products, best of {options['repeat']} runs (query + render):"
+        )
+        self.stdout.write(f"ProductModelSerializer  {old * 1000:>10.1f}ms")
+        self.stdout.write(f"ProductValuesSerializer {new * 1000:>10.1f}ms")
+        self.stdout.write(f"speedup                 {old / new:>10.1f}x")
+
+    def populate(self, rows, rng):
+        collections = Collection.objects.bulk_create(
+            [Collection(title=f"Collection {i}") for i in range(10)]
+        )
+        products = Product.objects.bulk_create(
+            [
+                Product(
+                    title=f"Product {i}",
+                    slug=f"product-{i}",
+                    description="lorem ipsum dolor sit amet",
+                    unit_price=Decimal(rng.randint(100, 99999)) / 100,
+                    inventory=rng.randint(0, 100),
+                    collection=rng.choice(collections),
+                )
+                for i in range(rows)
+            ],
+            batch_size=1000,
+        )
+        ProductImage.objects.bulk_create(
+            [
+                ProductImage(product=product, image=f"store/images/{product.pk}.jpg")
+                for product in products
+                if rng.random() < 0.5
+            ],
+            batch_size=1000,
+        )
+
+    def best_of(self, func, repeat):
+        best = None
+        for _ in range(repeat):
+            started = time.perf_counter()
+            func()
+            elapsed = time.perf_counter() - started
+            best = elapsed if best is None else min(best, elapsed)
+        return best
@@ -0,0 +1,98 @@
+import random
+import time
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from rest_framework.filters import SearchFilter
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+
+from store.models import Collection, Product
+from store.search import ProductSearchFilter, rebuild_search_index
+from store.views import ProductViewSet
+
+WORDS = [
+    "apple", "bread", "butter", "cake", "candle", "cheese", "chicken", "chocolate",
+    "cinnamon", "cleaner", "coffee", "cookie", "cream", "detergent", "flour", "flower",
+    "garlic", "ginger", "honey", "juice", "lemon", "magazine", "marker", "milk",
+    "mint", "muffin", "notebook", "olive", "orange", "paper", "pasta", "pencil",
+    "pepper", "pizza", "rice", "salmon", "salt", "shampoo", "shrimp", "soap",
+    "soda", "spinach", "sugar", "tea", "tomato", "toy", "vanilla", "water",
+    "wine", "yogurt",
+]  # fmt: skip
+COLLECTIONS = ["Grocery", "Beauty", "Cleaning", "Stationary", "Pets", "Baking", "Toys"]
+
+
+# Compares SearchFilter (icontains lookups) with ProductSearchFilter (full text index) on a
+# synthetic catalog. Everything is created inside a transaction that is rolled back at the end,
+# so the command can be run against a dev database without leaving anything behind.
+# eg. python manage.py benchmark_search --products 1000000
+class Command(BaseCommand):
+    help = "Benchmarks product search with and without the full text index"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--products", type=int, default=1_000_000)
+        parser.add_argument("--repeat", type=int, default=5)
+        parser.add_argument("--seed", type=int, default=42)
+        parser.add_argument(
+            "--terms", nargs="+", default=["coffee", "choc cake", "pasta tomato", "zzz"]
+        )
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            self.populate(options["products"], random.Random(options["seed"]))
+            view = ProductViewSet()
+            self.stdout.write(
+                f"{options['products']} products on {connection.vendor}, "
+                f"best of {options['repeat']} runs (count + first page):"
+            )
+            self.stdout.write(f"{'terms':<20}{'SearchFilter':>16}{'full text':>16}")
+            for terms in options["terms"]:
+                old = self.time_search(SearchFilter(), view, terms, options["repeat"])
+                new = self.time_search(
+                    ProductSearchFilter(), view, terms, options["repeat"]
+                )
+                self.stdout.write(
+                    f"{terms:<20}{old * 1000:>14.1f}ms{new * 1000:>14.1f}ms"
+                )
+            transaction.set_rollback(True)
+
+    def populate(self, count, rng):
+        self.stdout.write(f"Creating {count} products...")
+        collections = Collection.objects.bulk_create(
+            [Collection(title=title) for title in COLLECTIONS]
+        )
+        batch_size = 10_000
+        for start in range(0, count, batch_size):
+            Product.objects.bulk_create(
+                [
+                    Product(
+                        title=" ".join(rng.sample(WORDS, 3)).title(),
+                        slug="-",
+                        description=" ".join(rng.choices(WORDS, k=12)),
+                        unit_price=Decimal(rng.randint(100, 99999)) / 100,
+                        inventory=rng.randint(0, 100),
+                        collection=rng.choice(collections),
+                    )
+                    for _ in range(min(batch_size, count - start))
+                ]
+            )
+        # bulk_create skips the signals that keep the index up to date
+        rebuild_search_index()
+
+    def time_search(self, search_filter, view, terms, repeat):
+        request = Request(
+            APIRequestFactory().get("/store/products/", {"search": terms})
+        )
+        best = None
+        for _ in range(repeat):
+            started = time.perf_counter()
+            queryset = search_filter.filter_queryset(
+                request, Product.objects.all(), view
+            )
+            queryset.count()
+            list(queryset[:10])
+            elapsed = time.perf_counter() - started
+            best = elapsed if best is None else min(best, elapsed)
+        return best
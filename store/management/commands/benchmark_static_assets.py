@@ -0,0 +1,77 @@
+import re
+import tempfile
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.test import Client, override_settings
+
+PAGES = [
+    "/admin/login/",
+    "/admin/",
+    "/admin/store/product/",
+    "/admin/store/product/add/",
+]
+STORAGES = {
+    "plain": "django.contrib.staticfiles.storage.StaticFilesStorage",
+    "hashed + compressed": "whitenoise.storage.CompressedManifestStaticFilesStorage",
+}
+STATIC_URL_PATTERN = re.compile(r"""(?:href|src)=["'](/static/[^"'?#]+)""")
+
+
+# Measures the static bytes a browser downloads for the admin pages with the plain static storage
+# and with the hashed, precompressed one (see STORAGES in settings/prod.py). Each storage gets its own
+# collectstatic into a temporary STATIC_ROOT, served by WhiteNoise. The user that logs in to the admin
+# is created inside a transaction that is rolled back at the end.
+# eg. python manage.py benchmark_static_assets
+class Command(BaseCommand):
+    help = "Measures the static bytes sent for the admin pages with and without precompression"
+
+    def handle(self, *args, **options):
+        self.stdout.write(
+            f"{'storage':<22}{'files':>7}{'uncompressed':>15}{'sent':>12}"
+            f"{'revalidated':>15}"
+        )
+        with transaction.atomic():
+            user = get_user_model().objects.create_superuser(
+                "benchmark_static", "benchmark_static@home.test", "x"
+            )
+            for name, backend in STORAGES.items():
+                self.measure(name, backend, user)
+            transaction.set_rollback(True)
+
+    def measure(self, name, backend, user):
+        with tempfile.TemporaryDirectory() as static_root, override_settings(
+            DEBUG=False,
+            ALLOWED_HOSTS=["testserver"],
+            STATIC_ROOT=static_root,
+            STORAGES={**settings.STORAGES, "staticfiles": {"BACKEND": backend}},
+        ):
+            call_command("collectstatic", interactive=False, verbosity=0)
+            client = Client()
+            client.force_login(user)
+
+            urls = set()
+            for page in PAGES:
+                html = client.get(page).content.decode()
+                urls.update(STATIC_URL_PATTERN.findall(html))
+
+            uncompressed = sent = revalidated = 0
+            for url in sorted(urls):
+                uncompressed += self.get(client, url, "identity")[0]
+                length, response = self.get(client, url, "br, gzip")
+                sent += length
+                # a browser asks the server again for everything it may not cache forever
+                if "immutable" not in response.get("Cache-Control", ""):
+                    revalidated += 1
+
+        self.stdout.write(
+            f"{name:<22}{len(urls):>7}{uncompressed:>15,}{sent:>12,}{revalidated:>15}"
+        )
+
+    # (bytes of the body, response)
+    def get(self, client, url, accept_encoding):
+        response = client.get(url, HTTP_ACCEPT_ENCODING=accept_encoding)
+        return len(b"".join(response.streaming_content)), response
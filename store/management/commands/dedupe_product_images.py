@@ -0,0 +1,58 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from store.cache import bump_catalog_version
+from store.models import Product, ProductImage
+
+
+# Moves images uploaded before ProductImage.image was content addressed (see store/storage.py)
+# into the content addressed layout. Copies of the same file end up as one file.
+class Command(BaseCommand):
+    help = (
+        "Stores existing product images once per content and points their rows at them"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--keep", action="store_true", help="keep the old files after moving them"
+        )
+
+    def handle(self, *args, **options):
+        storage = ProductImage._meta.get_field("image").storage
+        names = list(
+            ProductImage.objects.exclude(image="")
+            .values_list("image", flat=True)
+            .distinct()
+        )
+        moved = {}
+        for name in names:
+            if storage.is_immutable(name):
+                continue
+            if not storage.exists(name):
+                self.stderr.write(f"Missing {name}, left as is.")
+                continue
+            with storage.open(name) as file:
+                moved[name] = storage.save(name, file)
+
+        if moved:
+            with transaction.atomic():
+                for name, new_name in moved.items():
+                    ProductImage.objects.filter(image=name).update(image=new_name)
+                # queryset.update() skips the signal handlers. The image urls are part of the
+                # products, a new last_update changes their etags (see views.py) as in
+                # tasks.generate_image_sizes
+                Product.objects.filter(productimage__image__in=moved.values()).update(
+                    last_update=timezone.now()
+                )
+                transaction.on_commit(bump_catalog_version)
+
+        # no row nor cached response points at the old files any more
+        if not options["keep"]:
+            for name in moved:
+                storage.delete(name)
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Moved {len(moved)} images into {len(set(moved.values()))} files."
+            )
+        )
@@ -0,0 +1,152 @@
+from datetime import timedelta
+import re
+
+from django.contrib.auth.models import AnonymousUser
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.utils import timezone
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+
+from store.carts import get_abandoned_carts
+from store.models import Cart, Order, Product
+from store.pagination import ProductCursorPagination
+from store.views import (
+    CartItemViewSet,
+    CollectionViewSet,
+    ProductViewSet,
+    ReviewViewSet,
+)
+from likes.models import LikedItem
+from tags.models import TaggedItem
+
+# plan lines that mean the db reads a whole table or sorts rows it could have read in order
+WARNINGS = {
+    "sqlite": [
+        # "SCAN store_product" is a full scan, "SCAN store_product USING INDEX ..." is an index walk
+        (
+            re.compile(r"\bSCAN (?!.*\b(USING|VIRTUAL TABLE)\b)"),
+            "full scan",
+        ),
+        (re.compile(r"USE TEMP B-TREE"), "temp b-tree sort"),
+    ],
+    "postgresql": [
+        (re.compile(r"\bSeq Scan\b"), "full scan"),
+        (re.compile(r"^\s*(->\s*)?(Incremental )?Sort\b"), "sort"),
+    ],
+}
+PAGE_SIZE = 10
+
+
+# Runs EXPLAIN for the querysets the store viewsets build from their filter, search, ordering
+# and pagination params, and flags full table scans and sorts. Run it against a database with
+# realistic data (see seed_db) after changing models, filters or orderings, eg.
+# python manage.py explain_store_queries --fail
+class Command(BaseCommand):
+    help = "Explains the store viewset queries and flags full scans and sorts"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--plans", action="store_true", help="print every plan, not just warnings"
+        )
+        parser.add_argument(
+            "--fail",
+            action="store_true",
+            help="exit with an error when any query is flagged (for CI)",
+        )
+
+    def handle(self, *args, **options):
+        warnings = WARNINGS.get(connection.vendor)
+        if warnings is None:
+            raise CommandError(f"No plan checks for {connection.vendor}.")
+
+        flagged = 0
+        for label, queryset in self.get_querysets():
+            plan = queryset.explain()
+            found = [
+                f"{reason}: {line.strip()}"
+                for line in plan.splitlines()
+                for pattern, reason in warnings
+                if pattern.search(line)
+            ]
+            flagged += bool(found)
+            style = self.style.WARNING if found else self.style.SUCCESS
+            self.stdout.write(style(f"{'FLAG' if found else 'ok  '} {label}"))
+            for line in found:
+                self.stdout.write(f"       {line}")
+            if options["plans"]:
+                self.stdout.write(plan)
+
+        self.stdout.write(f"{flagged} queries flagged.")
+        if flagged and options["fail"]:
+            raise CommandError(f"{flagged} queries do full scans or sorts.")
+
+    def view_queryset(self, viewset_class, params=None, action="list", **kwargs):
+        request = Request(APIRequestFactory().get("/", params or {}))
+        request.user = AnonymousUser()
+        view = viewset_class(
+            request=request, format_kwarg=None, action=action, kwargs=kwargs
+        )
+        return view, request, view.filter_queryset(view.get_queryset())
+
+    def get_querysets(self):
+        # the filters validate the ids they are given, and plans over empty tables mean little
+        product = Product.objects.order_by("pk").first()
+        if product is None:
+            raise CommandError("There are no products, run seed_db first.")
+        product_pk = product.pk
+        collection_pk = product.collection_id
+
+        # products, page pagination (the page is a LIMIT/OFFSET of the ordered queryset)
+        product_params = [
+            {},
+            {"ordering": "unit_price"},
+            {"ordering": "-unit_price"},
+            {"ordering": "last_update"},
+            {"ordering": "-last_update"},
+            {"ordering": "collection__pk"},
+            {"collection_id": collection_pk},
+            {"collection_id": collection_pk, "ordering": "unit_price"},
+            {"unit_price__gt": 10, "unit_price__lt": 20},
+            {"unit_price__gt": 10, "ordering": "unit_price"},
+            {"search": "coffee"},
+        ]
+        for params in product_params:
+            view, request, queryset = self.view_queryset(ProductViewSet, params)
+            yield f"products {params}", queryset[:PAGE_SIZE]
+
+        # products, cursor pagination orders by the same fields plus the id
+        for params in product_params:
+            if "search" in params:
+                continue
+            params = {**params, "pagination": "cursor"}
+            view, request, queryset = self.view_queryset(ProductViewSet, params)
+            ordering = ProductCursorPagination().get_ordering(request, queryset, view)
+            yield f"products {params}", queryset.order_by(*ordering)[:PAGE_SIZE]
+
+        view, request, queryset = self.view_queryset(
+            ProductViewSet, action="retrieve", pk=product_pk
+        )
+        yield "product detail", queryset.filter(pk=product_pk)
+
+        view, request, queryset = self.view_queryset(CollectionViewSet)
+        yield "collections", queryset
+
+        view, request, queryset = self.view_queryset(
+            ReviewViewSet, product_pk=product_pk
+        )
+        yield "reviews of a product", queryset
+
+        cart = Cart.objects.first()
+        cart_pk = cart.pk if cart else "00000000-0000-0000-0000-000000000000"
+        view, request, queryset = self.view_queryset(CartItemViewSet, cart_pk=cart_pk)
+        yield "items of a cart", queryset
+        yield "old carts", get_abandoned_carts(timezone.now() - timedelta(days=30))
+
+        yield "orders by placed_at", Order.objects.order_by("placed_at")[:PAGE_SIZE]
+        yield "tags of a product", TaggedItem.objects.get_tags_for(Product, product_pk)
+        yield "likes of a product", LikedItem.objects.filter(
+            content_type__app_label="store",
+            content_type__model="product",
+            object_id=product_pk,
+        )
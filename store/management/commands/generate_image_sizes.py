@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from store.models import ProductImage
+from store.tasks import generate_image_sizes
+
+
+class Command(BaseCommand):
+    help = "Queues the resizing of product images that have no resized copies yet"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--all", action="store_true", help="regenerate the sizes of every image"
+        )
+
+    def handle(self, *args, **options):
+        images = ProductImage.objects.exclude(image="")
+        if not options["all"]:
+            images = images.filter(sizes={})
+        queued = 0
+        for pk in images.values_list("pk", flat=True).iterator():
+            generate_image_sizes.delay(pk)
+            queued += 1
+        self.stdout.write(self.style.SUCCESS(f"Queued {queued} images."))
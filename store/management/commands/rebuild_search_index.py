@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from store.search import get_search_backend, rebuild_search_index
+
+
+class Command(BaseCommand):
+    help = "Rebuilds the full text index used to search products"
+
+    def handle(self, *args, **options):
+        if get_search_backend() is None:
+            self.stdout.write(
+                f"No full text index for {connection.vendor}, searches use SearchFilter."
+            )
+            return
+
+        with transaction.atomic():
+            rebuild_search_index()
+        self.stdout.write(self.style.SUCCESS("Search index rebuilt."))
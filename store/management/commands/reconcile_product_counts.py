@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+
+from store.counters import reconcile_product_counts
+
+
+class Command(BaseCommand):
+    help = "Recounts the products of every collection and repairs stored counts that drifted"
+
+    def handle(self, *args, **options):
+        repaired = reconcile_product_counts()
+        self.stdout.write(
+            self.style.SUCCESS(f"Repaired the product count of {repaired} collections.")
+        )
@@ -1,17 +1,466 @@
-from django.core.management.base import BaseCommand
-from django.db import connection
-from pathlib import Path
-import os
+import csv
+import io
+import itertools
+import random
+import time
+import uuid
+from array import array
+from datetime import timedelta
+from decimal import Decimal
 
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import BaseCommand, CommandError
+from django.core.management.color import no_style
+from django.db import connection, transaction
+from django.db.models import Max
+from django.utils import timezone
+from django.utils.text import slugify
 
+from likes.models import LikedItem
+from store.cache import bump_catalog_version
+from store.counters import reconcile_product_counts
+from store.inventory import create_missing_stock, sync_product_inventory
+from store.models import (
+    Cart,
+    CartItem,
+    Collection,
+    Customer,
+    Order,
+    OrderItem,
+    Product,
+    Review,
+)
+from store.search import rebuild_search_index
+from tags.models import Tag, TaggedItem
+
+WORDS = [
+    "apple", "bread", "butter", "cake", "candle", "cheese", "chicken", "chocolate",
+    "cinnamon", "cleaner", "coffee", "cookie", "cream", "detergent", "flour", "flower",
+    "garlic", "ginger", "honey", "juice", "lemon", "magazine", "marker", "milk",
+    "mint", "muffin", "notebook", "olive", "orange", "paper", "pasta", "pencil",
+    "pepper", "pizza", "rice", "salmon", "salt", "shampoo", "shrimp", "soap",
+    "soda", "spinach", "sugar", "tea", "tomato", "toy", "vanilla", "water",
+    "wine", "yogurt",
+]  # fmt: skip
+NAMES = [
+    "Ada", "Alan", "Barbara", "Brian", "Carol", "Dennis", "Edsger", "Frances",
+    "Grace", "Guido", "Joan", "John", "Ken", "Linus", "Margaret", "Niklaus",
+]  # fmt: skip
+PASSWORD = "password"
+# orders, carts and reviews are spread over this many days before now
+HISTORY_DAYS = 365
+
+
+# Fills the database with a synthetic store of any size for load tests and query plan checks.
+# - the same --seed always produces the same rows
+# - rows get explicit ids (continuing after the highest existing id) so children can point at
+#   their parents without reading them back
+# - rows are built as plain tuples (no model instances) and written in batches, with COPY on
+#   postgres and executemany everywhere else, so memory stays flat and 10M rows take minutes
+# - signals do not run: the collection product counts and the search index are rebuilt at the
+#   end, and customers are created here instead of by the user signal
+# Running it again with the same --seed adds the same carts again, use another seed to add more.
+# eg. python manage.py seed_db --products 10000000 --customers 1000000 --orders 2000000
 class Command(BaseCommand):
-    help = "Populates the database with collections and products"
+    help = "Populates the database with a synthetic store"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--collections", type=int, default=10)
+        parser.add_argument("--products", type=int, default=1000)
+        parser.add_argument("--customers", type=int, default=100)
+        parser.add_argument("--carts", type=int, default=100)
+        parser.add_argument(
+            "--items-per-cart", type=int, default=3, help="at most, per cart"
+        )
+        parser.add_argument("--orders", type=int, default=200)
+        parser.add_argument(
+            "--items-per-order", type=int, default=3, help="at most, per order"
+        )
+        parser.add_argument("--reviews", type=int, default=1000)
+        parser.add_argument("--tags", type=int, default=20)
+        parser.add_argument("--tagged-items", type=int, default=1000)
+        parser.add_argument("--likes", type=int, default=1000)
+        parser.add_argument("--seed", type=int, default=1)
+        parser.add_argument("--batch-size", type=int, default=10_000)
 
     def handle(self, *args, **options):
-        print("Populating the database...")
-        current_dir = os.path.dirname(__file__)
-        file_path = os.path.jon(current_dir, "seed.sql")
-        sql = Path(file_path).read_text()
+        self.check_options(options)
+        self.rng = random.Random(options["seed"])
+        self.batch_size = options["batch_size"]
+        self.use_copy = connection.vendor == "postgresql"
+        self.now = timezone.now()
+        self.stdout.write(
+            f"Populating the database ({connection.vendor}, "
+            f"{'COPY' if self.use_copy else 'executemany'})..."
+        )
+        started = time.perf_counter()
+
+        collection_ids = self.create_collections(options["collections"])
+        product_ids = self.create_products(options["products"], collection_ids)
+        customer_ids, user_ids = self.create_customers(options["customers"])
+        self.create_carts(options["carts"], options["items_per_cart"], product_ids)
+        self.create_orders(
+            options["orders"], options["items_per_order"], customer_ids, product_ids
+        )
+        self.create_reviews(options["reviews"], product_ids)
+        self.create_tags(options["tags"], options["tagged_items"], product_ids)
+        self.create_likes(options["likes"], user_ids, product_ids)
+        self.finish()
+
+        self.stdout.write(
+            self.style.SUCCESS(f"Done in {time.perf_counter() - started:.1f}s.")
+        )
+
+    def check_options(self, options):
+        # children are only pointed at parents created by this run
+        parents = {
+            "products": ["collections"],
+            "carts": ["products"],
+            "orders": ["customers", "products"],
+            "reviews": ["products"],
+            "tagged_items": ["tags", "products"],
+            "likes": ["customers", "products"],
+        }
+        for child, required in parents.items():
+            for parent in required:
+                if options[child] > 0 and options[parent] <= 0:
+                    raise CommandError(f"--{child} needs at least one of --{parent}")
+        if options["batch_size"] <= 0:
+            raise CommandError("--batch-size must be positive")
+
+    # ids for count new rows, continuing after the highest existing id
+    def new_ids(self, model, count) -> range:
+        first_id = (model.objects.aggregate(max_pk=Max("pk"))["max_pk"] or 0) + 1
+        return range(first_id, first_id + count)
+
+    # make_row gets the id of the row and returns the values of columns, id first.
+    # Returns the range of ids the rows were given
+    def write(self, model, columns, count, make_row) -> range:
+        ids = self.new_ids(model, count)
+        self.write_rows(model, ["id", *columns], (make_row(pk) for pk in ids))
+        return ids
+
+    # for children with a variable number of rows per parent. make_rows gets each item of
+    # parent_ids (eg. the parent id) and returns a list of rows without their id
+    def write_children(self, model, columns, parent_ids, make_rows) -> int:
+        next_ids = itertools.count(self.new_ids(model, 0).start)
+        rows = (
+            (next(next_ids), *row)
+            for parent_id in parent_ids
+            for row in make_rows(parent_id)
+        )
+        return self.write_rows(model, ["id", *columns], rows)
 
+    # rows is consumed lazily, only one batch is held in memory at a time
+    def write_rows(self, model, columns, rows) -> int:
+        started = time.perf_counter()
+        count = 0
+        rows = iter(rows)
+        while batch := list(itertools.islice(rows, self.batch_size)):
+            with transaction.atomic():
+                if self.use_copy:
+                    self.copy(model, columns, batch)
+                else:
+                    self.insert(model, columns, batch)
+            count += len(batch)
+        if count:
+            self.report(model, count, started)
+        return count
+
+    def insert(self, model, columns, batch):
+        sql = (
+            f"INSERT INTO {connection.ops.quote_name(model._meta.db_table)} "
+            f"({', '.join(connection.ops.quote_name(column) for column in columns)}) "
+            f"VALUES ({', '.join(['%s'] * len(columns))})"
+        )
+        with connection.cursor() as cursor:
+            cursor.executemany(sql, batch)
+
+    # COPY is the fastest way to load rows into postgres, one statement per batch
+    def copy(self, model, columns, batch):
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for row in batch:
+            writer.writerow(["\\N" if value is None else value for value in row])
+        buffer.seek(0)
+        sql = (
+            f"COPY {connection.ops.quote_name(model._meta.db_table)} "
+            f"({', '.join(connection.ops.quote_name(column) for column in columns)}) "
+            "FROM STDIN WITH (FORMAT csv, NULL '\\N')"
+        )
         with connection.cursor() as cursor:
-            cursor.execute(sql)
+            raw_cursor = cursor.cursor
+            if hasattr(raw_cursor, "copy_expert"):  # psycopg2
+                raw_cursor.copy_expert(sql, buffer)
+            else:  # psycopg 3
+                with raw_cursor.copy(sql) as copy:
+                    copy.write(buffer.getvalue())
+
+    def report(self, model, count, started):
+        elapsed = time.perf_counter() - started
+        self.stdout.write(
+            f"  {model._meta.db_table:<24}{count:>12} rows "
+            f"{elapsed:>8.1f}s {count / max(elapsed, 1e-9):>12.0f} rows/s"
+        )
+
+    # rows are written without going through the model fields, these convert the few types
+    # that each database stores in its own way
+    def datetime_value(self, value):
+        return connection.ops.adapt_datetimefield_value(value)
+
+    def date_value(self, value):
+        return connection.ops.adapt_datefield_value(value)
+
+    def uuid_value(self, value):
+        return value if connection.features.has_native_uuid_field else value.hex
+
+    def bool_value(self, value):
+        return ("t" if value else "f") if self.use_copy else value
+
+    def words(self, count) -> str:
+        return " ".join(self.rng.choices(WORDS, k=count))
+
+    def past(self):
+        return self.now - timedelta(seconds=self.rng.randrange(HISTORY_DAYS * 86400))
+
+    def create_collections(self, count) -> range:
+        return self.write(
+            Collection,
+            ["title", "product_count"],
+            count,
+            lambda pk: (pk, self.words(1).title(), 0),
+        )
+
+    def create_products(self, count, collection_ids) -> range:
+        # remember every price so order items can copy it without reading the product back
+        self.prices = array("L")
+        last_update = self.datetime_value(self.now)
+
+        def make_product(pk):
+            title = " ".join(self.rng.sample(WORDS, 3)).title()
+            cents = self.rng.randint(100, 99999)
+            self.prices.append(cents)
+            return (
+                pk,
+                title,
+                slugify(title),
+                self.words(12),
+                Decimal(cents) / 100,
+                self.rng.randint(0, 100),
+                last_update,
+                self.rng.choice(collection_ids),
+            )
+
+        return self.write(
+            Product,
+            [
+                "title",
+                "slug",
+                "description",
+                "unit_price",
+                "inventory",
+                "last_update",
+                "collection_id",
+            ],
+            count,
+            make_product,
+        )
+
+    def price(self, product_ids, product_id) -> Decimal:
+        return Decimal(self.prices[product_id - product_ids.start]) / 100
+
+    def create_customers(self, count):
+        # hashing is slow on purpose, every user gets the same password
+        password = make_password(PASSWORD)
+        user_ids = self.write(
+            get_user_model(),
+            [
+                "password",
+                "is_superuser",
+                "username",
+                "first_name",
+                "last_name",
+                "email",
+                "is_staff",
+                "is_active",
+                "date_joined",
+            ],
+            count,
+            lambda pk: (
+                pk,
+                password,
+                self.bool_value(False),
+                f"user{pk}",
+                self.rng.choice(NAMES),
+                self.rng.choice(NAMES),
+                f"user{pk}@store.test",
+                self.bool_value(False),
+                self.bool_value(True),
+                self.datetime_value(self.past()),
+            ),
+        )
+
+        memberships = [choice for choice, _ in Customer.MEMBERSHIP_CHOICES]
+        customer_ids = self.new_ids(Customer, count)
+        self.write_rows(
+            Customer,
+            ["id", "user_id", "phone", "membership"],
+            (
+                (
+                    pk,
+                    user_id,
+                    f"{self.rng.randint(200, 999)}-{self.rng.randint(1000, 9999)}",
+                    self.rng.choice(memberships),
+                )
+                for pk, user_id in zip(customer_ids, user_ids)
+            ),
+        )
+        return customer_ids, user_ids
+
+    def create_carts(self, count, items_per_cart, product_ids):
+        # carts are keyed by a uuid. The uuids and creation times come from their own generator so
+        # that they can be generated again for the cart items instead of keeping millions of them
+        # in memory. The items were last changed when their cart was created
+        cart_seed = self.rng.getrandbits(64)
+
+        def carts():
+            rng = random.Random(cart_seed)
+            return (
+                (
+                    self.uuid_value(uuid.UUID(int=rng.getrandbits(128), version=4)),
+                    self.datetime_value(
+                        self.now
+                        - timedelta(seconds=rng.randrange(HISTORY_DAYS * 86400))
+                    ),
+                )
+                for _ in range(count)
+            )
+
+        def cart_items(cart):
+            cart_id, created_at = cart
+            return [
+                (cart_id, product_id, self.rng.randint(1, 5), created_at)
+                # a cart holds a product only once (unique_cart_product)
+                for product_id in self.rng.sample(
+                    product_ids,
+                    min(len(product_ids), self.rng.randint(1, items_per_cart)),
+                )
+            ]
+
+        self.write_rows(Cart, ["id", "created_at"], carts())
+        if items_per_cart > 0 and count > 0:
+            self.write_children(
+                CartItem,
+                ["cart_id", "product_id", "quantity", "updated_at"],
+                carts(),
+                cart_items,
+            )
+
+    def create_orders(self, count, items_per_order, customer_ids, product_ids):
+        payment_statuses = [choice for choice, _ in Order.PAYMENT_STATUS_CHOICES]
+        order_ids = self.write(
+            Order,
+            ["customer_id", "payment_status", "placed_at"],
+            count,
+            lambda pk: (
+                pk,
+                self.rng.choice(customer_ids),
+                self.rng.choice(payment_statuses),
+                self.datetime_value(self.past()),
+            ),
+        )
+        if items_per_order > 0:
+            self.write_children(
+                OrderItem,
+                ["order_id", "product_id", "quantity", "unit_price"],
+                order_ids,
+                lambda order_id: [
+                    (
+                        order_id,
+                        product_id,
+                        self.rng.randint(1, 5),
+                        self.price(product_ids, product_id),
+                    )
+                    for product_id in self.rng.sample(
+                        product_ids,
+                        min(len(product_ids), self.rng.randint(1, items_per_order)),
+                    )
+                ],
+            )
+
+    def create_reviews(self, count, product_ids):
+        def make_review(pk):
+            written = self.past()
+            return (
+                pk,
+                self.rng.choice(product_ids),
+                self.rng.choice(NAMES),
+                self.words(20),
+                self.date_value(written.date()),
+                self.datetime_value(written),
+            )
+
+        self.write(
+            Review,
+            ["product_id", "name", "description", "date", "last_update"],
+            count,
+            make_review,
+        )
+
+    def create_tags(self, count, tagged_item_count, product_ids):
+        tag_ids = self.write(Tag, ["label"], count, lambda pk: (pk, self.words(1)))
+        content_type = ContentType.objects.get_for_model(Product)
+        self.write(
+            TaggedItem,
+            ["tag_id", "content_type_id", "object_id"],
+            tagged_item_count,
+            lambda pk: (
+                pk,
+                self.rng.choice(tag_ids),
+                content_type.pk,
+                self.rng.choice(product_ids),
+            ),
+        )
+
+    def create_likes(self, count, user_ids, product_ids):
+        content_type = ContentType.objects.get_for_model(Product)
+        self.write(
+            LikedItem,
+            ["user_id", "content_type_id", "object_id"],
+            count,
+            lambda pk: (
+                pk,
+                self.rng.choice(user_ids),
+                content_type.pk,
+                self.rng.choice(product_ids),
+            ),
+        )
+
+    def finish(self):
+        self.stdout.write("Rebuilding product counts, stock and the search index...")
+        models = [
+            get_user_model(),
+            Collection,
+            Product,
+            Customer,
+            CartItem,
+            Order,
+            OrderItem,
+            Review,
+            Tag,
+            TaggedItem,
+            LikedItem,
+        ]
+        with transaction.atomic():
+            # explicit ids leave the postgres sequences behind, move them past the new rows
+            with connection.cursor() as cursor:
+                for sql in connection.ops.sequence_reset_sql(no_style(), models):
+                    cursor.execute(sql)
+            reconcile_product_counts()
+            # the raw inserts wrote no stock rows, sync_product_inventory only reads existing ones
+            create_missing_stock()
+            sync_product_inventory()
+            rebuild_search_index()
+            transaction.on_commit(bump_catalog_version)
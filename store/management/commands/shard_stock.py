@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from store.inventory import shard_stock
+from store.models import Product
+
+
+# Splits the stock of a hot product into reservation buckets, see inventory.py
+# eg. python manage.py shard_stock 42 8   (0 buckets to undo it)
+class Command(BaseCommand):
+    help = "Splits the stock of a product into buckets so concurrent checkouts do not wait on one row"
+
+    def add_arguments(self, parser):
+        parser.add_argument("product_id", type=int)
+        parser.add_argument("buckets", type=int)
+
+    def handle(self, *args, **options):
+        if not 0 <= options["buckets"] <= 1000:
+            raise CommandError("buckets must be between 0 and 1000.")
+        if not Product.objects.filter(pk=options["product_id"]).exists():
+            raise CommandError("No product with the given ID was found.")
+        shard_stock(options["product_id"], options["buckets"])
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Product {options['product_id']} has {options['buckets']} stock buckets."
+            )
+        )
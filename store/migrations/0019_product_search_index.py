@@ -0,0 +1,61 @@
+from django.db import migrations
+
+
+# creates the full text index used by store.search.ProductSearchFilter and fills it with the
+# products that already exist. Databases other than sqlite and postgres get no index and keep
+# using the plain SearchFilter lookups.
+def create_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == "sqlite":
+        schema_editor.execute(
+            """
+            CREATE VIRTUAL TABLE store_product_search USING fts5(
+                title, description, collection_title, tokenize='unicode61 remove_diacritics 2'
+            )
+            """
+        )
+        schema_editor.execute(
+            """
+            INSERT INTO store_product_search (rowid, title, description, collection_title)
+            SELECT p.id, p.title, COALESCE(p.description, ''), c.title
+            FROM store_product p JOIN store_collection c ON c.id = p.collection_id
+            """
+        )
+    elif vendor == "postgresql":
+        schema_editor.execute(
+            """
+            CREATE TABLE store_product_search (
+                product_id bigint PRIMARY KEY REFERENCES store_product (id) ON DELETE CASCADE,
+                document tsvector NOT NULL
+            )
+            """
+        )
+        schema_editor.execute(
+            "CREATE INDEX store_product_search_document ON store_product_search USING GIN (document)"
+        )
+        schema_editor.execute(
+            """
+            INSERT INTO store_product_search (product_id, document)
+            SELECT p.id,
+                setweight(to_tsvector('simple', p.title), 'A')
+                || setweight(to_tsvector('simple', c.title), 'B')
+                || setweight(to_tsvector('simple', COALESCE(p.description, '')), 'C')
+            FROM store_product p JOIN store_collection c ON c.id = p.collection_id
+            """
+        )
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor in ["sqlite", "postgresql"]:
+        schema_editor.execute("DROP TABLE store_product_search")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0018_alter_productimage_image'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
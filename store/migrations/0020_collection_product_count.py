@@ -0,0 +1,39 @@
+# Generated by Django 5.0.6 on 2026-10-16 22:17
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+# fill product_count for the collections that already exist, from then on the signal handlers keep it up to date
+def count_products(apps, schema_editor):
+    Collection = apps.get_model("store", "Collection")
+    Product = apps.get_model("store", "Product")
+    Collection.objects.update(
+        product_count=Coalesce(
+            Subquery(
+                Product.objects.filter(collection=OuterRef("pk"))
+                .order_by()
+                .values("collection")
+                .annotate(count=Count("pk"))
+                .values("count")
+            ),
+            0,
+        )
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0019_product_search_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='collection',
+            name='product_count',
+            field=models.PositiveIntegerField(db_default=0, default=0, editable=False),
+        ),
+        migrations.RunPython(count_products, migrations.RunPython.noop),
+    ]
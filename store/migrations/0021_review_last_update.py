@@ -0,0 +1,20 @@
+# Generated by Django 5.0.6 on 2026-10-16 22:41
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0020_collection_product_count'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='review',
+            name='last_update',
+            field=models.DateTimeField(auto_now=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+    ]
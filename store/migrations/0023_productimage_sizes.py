@@ -0,0 +1,18 @@
+# Generated by Django 5.0.6 on 2026-10-16 22:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0022_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='productimage',
+            name='sizes',
+            field=models.JSONField(default=dict, editable=False),
+        ),
+    ]
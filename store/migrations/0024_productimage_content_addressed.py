@@ -0,0 +1,20 @@
+# Generated by Django 5.0.6 on 2026-10-16 22:38
+
+import store.storage
+import store.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0023_productimage_sizes'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='productimage',
+            name='image',
+            field=models.ImageField(storage=store.storage.select_product_image_storage, upload_to='store/images', validators=[store.validators.validate_file_size]),
+        ),
+    ]
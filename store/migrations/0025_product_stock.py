@@ -0,0 +1,49 @@
+# Generated by Django 5.0.6 on 2026-10-16 23:15
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+# checkouts take from the stock rows from now on, they start at the inventory of the products
+def create_stock(apps, schema_editor):
+    Product = apps.get_model("store", "Product")
+    ProductStock = apps.get_model("store", "ProductStock")
+    ProductStock.objects.bulk_create(
+        (
+            ProductStock(product_id=product_id, available=inventory)
+            for product_id, inventory in Product.objects.values_list("pk", "inventory")
+        ),
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0024_productimage_content_addressed'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProductStock',
+            fields=[
+                ('product', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='stock', serialize=False, to='store.product')),
+                ('available', models.IntegerField()),
+                ('buckets', models.PositiveSmallIntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='StockBucket',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('index', models.PositiveSmallIntegerField()),
+                ('available', models.IntegerField(default=0)),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='store.product')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='stockbucket',
+            constraint=models.UniqueConstraint(fields=('product', 'index'), name='unique_product_bucket'),
+        ),
+        migrations.RunPython(create_stock, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.0.6 on 2026-10-16 23:40
+
+import django.utils.timezone
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+
+
+# when the items were changed before is not known, they start at the time their cart was created so that the old carts are still swept
+def set_updated_at(apps, schema_editor):
+    Cart = apps.get_model("store", "Cart")
+    CartItem = apps.get_model("store", "CartItem")
+    CartItem.objects.update(
+        updated_at=Subquery(Cart.objects.filter(pk=OuterRef("cart_id")).values("created_at"))
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0025_product_stock'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cartitem',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+        migrations.RunPython(set_updated_at, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.0.6 on 2026-10-16 23:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0026_cartitem_updated_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='productstock',
+            name='changed',
+            field=models.BooleanField(default=True),
+        ),
+        migrations.AddField(
+            model_name='stockbucket',
+            name='changed',
+            field=models.BooleanField(default=True),
+        ),
+        migrations.AddIndex(
+            model_name='productstock',
+            index=models.Index(condition=models.Q(('changed', True)), fields=['changed'], name='stock_changed'),
+        ),
+        migrations.AddIndex(
+            model_name='stockbucket',
+            index=models.Index(condition=models.Q(('changed', True)), fields=['changed'], name='stock_bucket_changed'),
+        ),
+    ]
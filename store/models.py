@@ -1,10 +1,11 @@
 from decimal import Decimal
 from django.db import models
 from django.core.validators import MinValueValidator, FileExtensionValidator
-from django.db.models import UniqueConstraint
+from django.db.models import Q, UniqueConstraint
 from django.conf import settings
 from uuid import uuid4
 
+from store.storage import select_product_image_storage
 from store.validators import validate_file_size
 
 
@@ -72,6 +73,11 @@ class Collection(models.Model):
     featured_product = models.ForeignKey(
         "Product", on_delete=models.SET_NULL, null=True, related_name="+"
     )
+    # number of products in this collection. Stored instead of annotating Count("product") on every
+    # read. Kept up to date by the product signal handlers (see signals/handlers.py), bulk writes
+    # that skip signals are repaired by "manage.py reconcile_product_counts". db_default lets raw sql
+    # inserts (eg. resources/seed.sql) leave it out
+    product_count = models.PositiveIntegerField(default=0, db_default=0, editable=False)
 
     def __str__(self) -> str:
         return f"{self.title}"
@@ -103,13 +109,90 @@ class Product(models.Model):
     def __str__(self) -> str:
         return f"{self.title}"
 
+    # remember the collection and the inventory a product was loaded with so that saving it can tell
+    # if it moved to another collection or was restocked (see signals/handlers.py)
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        if "collection_id" in instance.__dict__:
+            instance._loaded_collection_id = instance.collection_id
+        if "inventory" in instance.__dict__:
+            instance._loaded_inventory = instance.inventory
+        return instance
+
     class Meta:
         ordering = ["title"]
+        # the orderings and filters ProductViewSet allows (see filters.py and ordering_fields).
+        # Run "manage.py explain_store_queries" to check the plans after changing either
+        indexes = [
+            models.Index(fields=["title"]),
+            models.Index(fields=["unit_price"]),
+            models.Index(fields=["last_update"]),
+            models.Index(fields=["collection", "title"]),
+            models.Index(fields=["collection", "unit_price"]),
+        ]
+
+
+# The inventory checkouts take from, in its own row so that selling a product does not lock (or
+# change the last_update of) the product row. Product.inventory is a copy of it for the catalog,
+# see inventory.py
+class ProductStock(models.Model):
+    product = models.OneToOneField(
+        Product, on_delete=models.CASCADE, primary_key=True, related_name="stock"
+    )
+    available = models.IntegerField()
+    # 0: checkouts take from available. More for hot products: checkouts take from that many
+    # StockBuckets which are refilled from available
+    buckets = models.PositiveSmallIntegerField(default=0)
+    # set by the writes to available, cleared by sync_product_inventory
+    changed = models.BooleanField(default=True)
+
+    def __str__(self) -> str:
+        return f"Stock: {self.product_id} -> {self.available}"
+
+    class Meta:
+        # the rows sync_product_inventory has to look at, without scanning the others
+        indexes = [
+            models.Index(
+                fields=["changed"], condition=Q(changed=True), name="stock_changed"
+            )
+        ]
+
+
+# One of the reservation buckets of a hot product, see inventory.py
+class StockBucket(models.Model):
+    product = models.ForeignKey(Product, on_delete=models.CASCADE)
+    index = models.PositiveSmallIntegerField()
+    available = models.IntegerField(default=0)
+    # see ProductStock.changed
+    changed = models.BooleanField(default=True)
+
+    class Meta:
+        constraints = [
+            UniqueConstraint(fields=["product", "index"], name="unique_product_bucket")
+        ]
+        indexes = [
+            models.Index(
+                fields=["changed"],
+                condition=Q(changed=True),
+                name="stock_bucket_changed",
+            )
+        ]
+
+    def __str__(self) -> str:
+        return f"Stock: {self.product_id}[{self.index}] -> {self.available}"
 
 
 class ProductImage(models.Model):
     product = models.ForeignKey(Product, on_delete=models.CASCADE)
-    image = models.ImageField(upload_to="store/images", validators=[validate_file_size])
+    image = models.ImageField(
+        upload_to="store/images",
+        storage=select_product_image_storage,
+        validators=[validate_file_size],
+    )
+    # resized copies of image, {size: {format: name}}. Filled in the background after the image
+    # is saved, see images.py and tasks.generate_image_sizes
+    sizes = models.JSONField(default=dict, editable=False)
     # image = models.FileField(
     #     upload_to="store/images",
     #     validators=[FileExtensionValidator(allowed_extensions=["pdf"])],
@@ -126,11 +209,18 @@ class Cart(models.Model):
     def __str__(self) -> str:
         return f"Cart: {self.pk}"
 
+    class Meta:
+        # finding old carts
+        indexes = [models.Index(fields=["created_at"])]
+
 
 class CartItem(models.Model):
     cart = models.ForeignKey(Cart, on_delete=models.CASCADE)
     product = models.ForeignKey(Product, on_delete=models.CASCADE)
     quantity = models.PositiveSmallIntegerField(validators=[MinValueValidator(1)])
+    # when the item was last added to or changed, a cart is abandoned when none of its items was
+    # changed for a while (see delete_abandoned_carts)
+    updated_at = models.DateTimeField(auto_now=True)
 
     class Meta:
         # set a unique constraint such that comaination of cart + product is a unique key in across cartitem table
@@ -166,6 +256,8 @@ class Order(models.Model):
     class Meta:
         # creates a custom permission to cancel an order
         permissions = [("cancel_order", "Can cancel order")]
+        # OrderAdmin orders by placed_at
+        indexes = [models.Index(fields=["placed_at"])]
 
 
 class OrderItem(models.Model):
@@ -183,6 +275,8 @@ class Review(models.Model):
     name = models.CharField(max_length=255)
     description = models.TextField()
     date = models.DateField(auto_now_add=True)
+    # not rendered, used for the Last-Modified/ETag of review responses (see conditional.py)
+    last_update = models.DateTimeField(auto_now=True)
 
     def __str__(self) -> str:
         return f"Review:{self.pk} -> Product: {self.product.title}"
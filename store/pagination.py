@@ -1,4 +1,13 @@
-from rest_framework.pagination import PageNumberPagination, LimitOffsetPagination
+from django.conf import settings
+from django.core.cache import cache
+from rest_framework.pagination import (
+    PageNumberPagination,
+    LimitOffsetPagination,
+    CursorPagination,
+)
+from rest_framework.response import Response
+
+from .cache import build_catalog_cache_key
 
 
 # page=xxx
@@ -9,3 +18,54 @@ class DefaultPagePagination(PageNumberPagination):
 # offset=xxx&limit=xxx
 class DefaultOffsetPagination(LimitOffsetPagination):
     page_size = 10
+
+
+# pagination=cursor&cursor=xxx
+# Page pagination runs a COUNT(*) over the filtered products on every page and uses OFFSET, so deep
+# pages get slower as the catalog grows. Cursor (keyset) pagination instead remembers the position
+# of the last row of a page and filters from there (eg. WHERE title > 'last title seen') so every page
+# costs the same. The total count is only computed when asked for (count=true) and is then cached
+# until the catalog changes.
+class ProductCursorPagination(CursorPagination):
+    page_size = 10
+    ordering = "title"  # same as Product.Meta.ordering
+    count_query_param = "count"
+    # params that do not change the set of products being counted
+    non_filter_query_params = ["cursor", "pagination", "ordering", "count", "format"]
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.count = None
+        if request.query_params.get(self.count_query_param) in ["1", "true"]:
+            self.count = self.get_count(queryset, request)
+        return super().paginate_queryset(queryset, request, view)
+
+    def get_count(self, queryset, request):
+        cache_key = build_catalog_cache_key(
+            request, "products:count", exclude=self.non_filter_query_params
+        )
+        count = cache.get(cache_key)
+        if count is None:
+            count = queryset.order_by().count()
+            cache.set(cache_key, count, timeout=settings.CATALOG_CACHE_TIMEOUT)
+        return count
+
+    def get_ordering(self, request, queryset, view):
+        ordering = []
+        for field in super().get_ordering(request, queryset, view):
+            # cursors read the position straight off the last row, which does not work across
+            # relations. Ordering by the foreign key column gives the same order without the join.
+            if field.lstrip("-") == "collection__pk":
+                field = field.replace("collection__pk", "collection_id")
+            ordering.append(field)
+
+        # add the id as a tiebreaker so rows that share a value (eg. same price) always come back
+        # in the same order and no row is skipped or repeated between pages
+        if not any(field.lstrip("-") in ["pk", "id"] for field in ordering):
+            ordering.append("-pk" if ordering[0].startswith("-") else "pk")
+        return tuple(ordering)
+
+    def get_paginated_response(self, data):
+        response = super().get_paginated_response(data)
+        if self.count is not None:
+            response.data = {"count": self.count, **response.data}
+        return response
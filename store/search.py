@@ -0,0 +1,183 @@
+import re
+
+from django.db import connection
+from rest_framework.filters import SearchFilter
+
+
+# Full text search for products
+# SearchFilter turns ?search=xxx into title/description/collection title "icontains" lookups OR'ed
+# together, which the db can only answer by scanning the product and collection tables. Instead we
+# keep an inverted index (store_product_search) over those three columns:
+# - sqlite: an FTS5 virtual table whose rowid is the product id
+# - postgres: a tsvector per product with a GIN index on it
+# The table is created by migration 0019, kept in sync by the signal handlers in signals/handlers.py
+# and can be rebuilt from scratch with "python manage.py rebuild_search_index".
+# !!!NOTE!!! bulk_create/update() skip signals, so code that writes products in bulk must call
+# index_products itself (or the rebuild command must be run afterwards).
+class SqliteSearchBackend:
+    def index_products(self, product_ids) -> None:
+        product_ids = list(product_ids)
+        placeholders = ", ".join(["%s"] * len(product_ids))
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"DELETE FROM store_product_search WHERE rowid IN ({placeholders})",
+                product_ids,
+            )
+            cursor.execute(
+                f"""
+                INSERT INTO store_product_search (rowid, title, description, collection_title)
+                SELECT p.id, p.title, COALESCE(p.description, ''), c.title
+                FROM store_product p JOIN store_collection c ON c.id = p.collection_id
+                WHERE p.id IN ({placeholders})
+                """,
+                product_ids,
+            )
+
+    def remove_products(self, product_ids) -> None:
+        product_ids = list(product_ids)
+        placeholders = ", ".join(["%s"] * len(product_ids))
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"DELETE FROM store_product_search WHERE rowid IN ({placeholders})",
+                product_ids,
+            )
+
+    def rebuild(self) -> None:
+        with connection.cursor() as cursor:
+            cursor.execute("DELETE FROM store_product_search")
+            cursor.execute(
+                """
+                INSERT INTO store_product_search (rowid, title, description, collection_title)
+                SELECT p.id, p.title, COALESCE(p.description, ''), c.title
+                FROM store_product p JOIN store_collection c ON c.id = p.collection_id
+                """
+            )
+
+    def search(self, queryset, terms):
+        # every term becomes a quoted prefix query, eg. coffee be -> "coffee"* "be"*
+        # FTS5 ANDs them together which matches how SearchFilter treats multiple terms
+        match = " ".join('"%s"*' % term.replace('"', '""') for term in terms)
+        # !!!NOTE!!! we join the index table with extra() instead of using a subquery per row.
+        # A correlated "MATCH ... AND rowid = store_product.id" subquery re-runs the full text
+        # lookup for every matching product which is quadratic on popular terms.
+        return queryset.extra(
+            # bm25 weights: a match in the title counts more than in the collection title,
+            # which counts more than in the description. Lower bm25 scores are better matches
+            select={"search_rank": "bm25(store_product_search, 10.0, 1.0, 5.0)"},
+            tables=["store_product_search"],
+            where=[
+                "store_product_search.rowid = store_product.id",
+                "store_product_search MATCH %s",
+            ],
+            params=[match],
+        ).order_by("search_rank", "pk")
+
+
+class PostgresSearchBackend:
+    document_sql = """
+        setweight(to_tsvector('simple', p.title), 'A')
+        || setweight(to_tsvector('simple', c.title), 'B')
+        || setweight(to_tsvector('simple', COALESCE(p.description, '')), 'C')
+    """
+
+    def index_products(self, product_ids) -> None:
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"""
+                INSERT INTO store_product_search (product_id, document)
+                SELECT p.id, {self.document_sql}
+                FROM store_product p JOIN store_collection c ON c.id = p.collection_id
+                WHERE p.id = ANY(%s)
+                ON CONFLICT (product_id) DO UPDATE SET document = EXCLUDED.document
+                """,
+                [list(product_ids)],
+            )
+
+    def remove_products(self, product_ids) -> None:
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "DELETE FROM store_product_search WHERE product_id = ANY(%s)",
+                [list(product_ids)],
+            )
+
+    def rebuild(self) -> None:
+        with connection.cursor() as cursor:
+            cursor.execute("TRUNCATE store_product_search")
+            cursor.execute(
+                f"""
+                INSERT INTO store_product_search (product_id, document)
+                SELECT p.id, {self.document_sql}
+                FROM store_product p JOIN store_collection c ON c.id = p.collection_id
+                """
+            )
+
+    def search(self, queryset, terms):
+        # tsquery has its own syntax so keep only the word characters of each term and turn
+        # them into prefix matches, eg. coffee be -> coffee:* & be:*
+        lexemes = [word for term in terms for word in re.findall(r"\w+", term)]
+        if not lexemes:
+            return queryset.none()
+        query = " & ".join(f"{lexeme}:*" for lexeme in lexemes)
+        return queryset.extra(
+            select={"search_rank": "ts_rank(document, to_tsquery('simple', %s))"},
+            select_params=[query],
+            tables=["store_product_search"],
+            where=[
+                "store_product_search.product_id = store_product.id",
+                "document @@ to_tsquery('simple', %s)",
+            ],
+            params=[query],
+        ).order_by("-search_rank", "pk")
+
+
+SEARCH_BACKENDS = {
+    "sqlite": SqliteSearchBackend,
+    "postgresql": PostgresSearchBackend,
+}
+
+
+def get_search_backend():
+    # other databases (eg. mysql) have no index table and fall back to SearchFilter
+    backend_class = SEARCH_BACKENDS.get(connection.vendor)
+    return backend_class() if backend_class is not None else None
+
+
+# ids are sent in batches to stay below the limit of query parameters (sqlite allows 32766)
+INDEX_BATCH_SIZE = 1000
+
+
+def _batches(product_ids):
+    product_ids = list(product_ids)
+    for start in range(0, len(product_ids), INDEX_BATCH_SIZE):
+        yield product_ids[start : start + INDEX_BATCH_SIZE]
+
+
+def index_products(product_ids) -> None:
+    backend = get_search_backend()
+    if backend is not None:
+        for batch in _batches(product_ids):
+            backend.index_products(batch)
+
+
+def remove_products(product_ids) -> None:
+    backend = get_search_backend()
+    if backend is not None:
+        for batch in _batches(product_ids):
+            backend.remove_products(batch)
+
+
+def rebuild_search_index() -> None:
+    backend = get_search_backend()
+    if backend is not None:
+        backend.rebuild()
+
+
+# Drop in replacement for SearchFilter. Results are ranked by relevance unless the client
+# asks for an ordering (OrderingFilter runs after this filter and replaces the order)
+class ProductSearchFilter(SearchFilter):
+    def filter_queryset(self, request, queryset, view):
+        search_terms = self.get_search_terms(request)
+        backend = get_search_backend()
+        if not search_terms or backend is None:
+            return super().filter_queryset(request, queryset, view)
+        return backend.search(queryset, search_terms)
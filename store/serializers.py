@@ -1,6 +1,13 @@
+from collections import Counter
 from decimal import Decimal
+from operator import itemgetter
 from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
 from rest_framework import serializers
+from rest_framework.exceptions import NotFound
+from rest_framework.permissions import SAFE_METHODS
+from rest_framework.reverse import reverse
 from .models import (
     Cart,
     CartItem,
@@ -12,13 +19,59 @@ from .models import (
     ProductImage,
     Review,
 )
-from .signals import order_created
+from .cache import bump_catalog_version
+from .carts import MAX_QUANTITY, QuantityTooLarge, get_cart_store
+from .checkout import place_order
+from .counters import add_to_product_count
+from .images import get_size_urls
+from .inventory import add_stock, restock
+from .search import index_products
 
 
+# !!!NOTE!!! use a string. Decimal(1.1) is built from the float 1.1 which is really
+# 1.100000000000000088817841970012523233890533447265625
+TAX_RATE = Decimal("1.1")
+
 # !!!NOTE!!! There is a more efficent way of serializing a model. That is to use
 # Model serializers
 
 
+# Sparse fieldsets
+# ?fields=pk,title,unit_price only returns the listed fields
+# ?expand=productimage_set adds the serializer's expandable fields (Meta.expandable_fields). These are
+# the nested/related fields that cost extra queries, and once a client asks for fields or expand they
+# are left out unless asked for. Without either param every field is returned as before.
+# Only applies to reads, writes always use every field.
+# Returns the set of field names to render, or None when every field should be rendered.
+def get_sparse_fields(request, serializer_class):
+    if request is None or request.method not in SAFE_METHODS:
+        return None
+    fields = request.query_params.get("fields")
+    expand = request.query_params.get("expand")
+    if fields is None and expand is None:
+        return None
+
+    all_fields = set(serializer_class.Meta.fields)
+    expandable_fields = set(serializer_class.Meta.expandable_fields)
+    if fields is not None:
+        selected = {field.strip() for field in fields.split(",")}
+    else:
+        selected = all_fields - expandable_fields
+    if expand is not None:
+        selected |= {field.strip() for field in expand.split(",")} & expandable_fields
+    return selected & all_fields
+
+
+# add to a ModelSerializer (before serializers.ModelSerializer) to support ?fields= and ?expand=
+class SparseFieldsMixin:
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        selected = get_sparse_fields(self.context.get("request"), self.__class__)
+        if selected is not None:
+            for field_name in set(self.fields) - selected:
+                self.fields.pop(field_name)
+
+
 class CollectionModelSerializer(serializers.ModelSerializer):
     class Meta:
         model = Collection
@@ -28,17 +81,38 @@ class CollectionModelSerializer(serializers.ModelSerializer):
     product_count = serializers.IntegerField(read_only=True)
 
 
+# The collection nested in a product. Leaves product_count out, it belongs to the collection
+# endpoints and would make every product payload change when another product is added or moved
+class ProductCollectionModelSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Collection
+        fields = ["pk", "title"]
+
+
 class ProductImageModelSerializer(serializers.ModelSerializer):
     class Meta:
         model = ProductImage
-        fields = ["pk", "image"]
+        fields = ["pk", "image", "sizes"]
+
+    # the resized copies, {"thumbnail": {"webp": url, "jpeg": url}, ...}. Empty until they have been
+    # generated (see tasks.generate_image_sizes), clients fall back to image
+    sizes = serializers.SerializerMethodField(method_name="get_sizes")
+
+    def get_sizes(self, image: ProductImage):
+        request = self.context.get("request")
+        storage = image.image.storage
+        if request is None:
+            return get_size_urls(image.sizes, storage.url)
+        return get_size_urls(
+            image.sizes, lambda name: request.build_absolute_uri(storage.url(name))
+        )
 
     def create(self, validated_data):
         product_pk = self.context["product_pk"]
         return ProductImage.objects.create(product_id=product_pk, **validated_data)
 
 
-class ProductModelSerializer(serializers.ModelSerializer):
+class ProductModelSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     class Meta:
         model = Product
         fields = [
@@ -53,9 +127,9 @@ class ProductModelSerializer(serializers.ModelSerializer):
             "productimage_set",
             "collection_str",
             "collection_object",
-            "collection_str",
             "collection_link",
         ]
+        expandable_fields = ["productimage_set", "collection_object", "collection_link"]
 
     # when creating an object set fields that should not be part of the object as read_only=True
     price_with_tax = serializers.SerializerMethodField(
@@ -67,7 +141,7 @@ class ProductModelSerializer(serializers.ModelSerializer):
     )
     # by default the collection included above in meta class gives us by primary key
     collection_str = serializers.StringRelatedField(source="collection", read_only=True)
-    collection_object = CollectionModelSerializer(
+    collection_object = ProductCollectionModelSerializer(
         source="collection",
         read_only=True,
     )
@@ -78,7 +152,7 @@ class ProductModelSerializer(serializers.ModelSerializer):
     )
 
     def get_price_with_tax(self, product: Product) -> Decimal:
-        return product.unit_price * Decimal(1.1)
+        return product.unit_price * TAX_RATE
 
     # customize how a product is created
     # def create(self, validated_data):
@@ -96,6 +170,274 @@ class ProductModelSerializer(serializers.ModelSerializer):
     #     return instance
 
 
+# Read only fast path for listing products. Renders exactly the same json as ProductModelSerializer,
+# but from .values() rows instead of model instances:
+# - no model instances and no serializer field objects are created per row
+# - the collection comes from a join instead of select_related and is read straight off the row
+# - collection_link is built from a url template resolved once instead of calling reverse() per row
+# - images are fetched with one query for the whole page, like prefetch_related would
+# Only use it for reads. Writes still go through ProductModelSerializer.
+class ProductValuesSerializer:
+    # what we always select. last_update and the other columns used for ordering are selected even
+    # when not rendered because cursor pagination reads the position off the last row
+    values_fields = [
+        "pk",
+        "title",
+        "description",
+        "slug",
+        "inventory",
+        "unit_price",
+        "last_update",
+        "collection_id",
+    ]
+    pk_placeholder = "__pk__"
+
+    def __init__(self, context, fields=None):
+        self.request = context["request"]
+        # resolve the hyperlink once with a placeholder and split it around the placeholder
+        collection_link = reverse(
+            "store:collections-detail",
+            kwargs={"pk": self.pk_placeholder},
+            request=self.request,
+        )
+        self.collection_link_prefix, self.collection_link_suffix = (
+            collection_link.split(self.pk_placeholder)
+        )
+        self.image_storage = ProductImage._meta.get_field("image").storage
+        # field name -> function that computes the field from a row, in the same order as
+        # ProductModelSerializer.Meta.fields. Built once, then applied to every row
+        accessors = [
+            ("pk", itemgetter("pk")),
+            ("title", itemgetter("title")),
+            ("description", itemgetter("description")),
+            ("slug", itemgetter("slug")),
+            ("inventory", itemgetter("inventory")),
+            ("unit_price", itemgetter("unit_price")),
+            ("price_with_tax", lambda row: row["unit_price"] * TAX_RATE),
+            ("collection", itemgetter("collection_id")),
+            ("productimage_set", itemgetter("productimage_set")),
+            ("collection_str", itemgetter("collection__title")),
+            (
+                "collection_object",
+                lambda row: {
+                    "pk": row["collection_id"],
+                    "title": row["collection__title"],
+                },
+            ),
+            (
+                "collection_link",
+                lambda row: f"{self.collection_link_prefix}{row['collection_id']}{self.collection_link_suffix}",
+            ),
+        ]
+        # fields works like get_sparse_fields, None renders every field
+        if fields is not None:
+            accessors = [(name, field) for name, field in accessors if name in fields]
+        self.accessors = accessors
+        self.field_names = [name for name, _ in accessors]
+        field_names = set(self.field_names)
+        self.with_collection = bool(
+            field_names & {"collection_str", "collection_object"}
+        )
+        self.with_images = "productimage_set" in field_names
+
+    def get_queryset(self, queryset):
+        values_fields = list(self.values_fields)
+        if self.with_collection:
+            values_fields.append("collection__title")
+        # prefetch_related(None) drops the image prefetch, images are fetched in to_representation
+        return queryset.prefetch_related(None).values(*values_fields)
+
+    def get_image_url(self, name):
+        if not name:
+            return None
+        return self.request.build_absolute_uri(self.image_storage.url(name))
+
+    def get_images(self, product_pks) -> dict:
+        images = {pk: [] for pk in product_pks}
+        for product_pk, image_pk, image, sizes in ProductImage.objects.filter(
+            product_id__in=product_pks
+        ).values_list("product_id", "pk", "image", "sizes"):
+            images[product_pk].append(
+                {
+                    "pk": image_pk,
+                    "image": self.get_image_url(image),
+                    "sizes": get_size_urls(sizes, self.get_image_url),
+                }
+            )
+        return images
+
+    def to_representation(self, rows) -> list:
+        rows = list(rows)
+        if self.with_images:
+            images = self.get_images([row["pk"] for row in rows])
+            for row in rows:
+                row["productimage_set"] = images[row["pk"]]
+        return [{name: field(row) for name, field in self.accessors} for row in rows]
+
+
+# Bulk upsert of products, see BulkProductListSerializer
+class BulkProductListSerializer(serializers.ListSerializer):
+    # fields a product needs before it can be created
+    required_for_create = ["title", "slug", "unit_price", "inventory", "collection_id"]
+
+    # Unlike ListSerializer a bad row does not fail the whole batch. Invalid rows are left out of
+    # validated_data (None in their place) and their errors are kept in row_errors by index
+    def to_internal_value(self, data):
+        if not isinstance(data, list):
+            raise serializers.ValidationError(
+                {"non_field_errors": ["Expected a list of products."]}
+            )
+        if self.max_length is not None and len(data) > self.max_length:
+            raise serializers.ValidationError(
+                {
+                    "non_field_errors": [
+                        f"Ensure this list has no more than {self.max_length} products."
+                    ]
+                }
+            )
+
+        self.row_errors = {}
+        rows = []
+        for index, item in enumerate(data):
+            try:
+                rows.append(self.run_child_validation(item))
+            except serializers.ValidationError as exc:
+                self.row_errors[index] = exc.detail
+                rows.append(None)
+        return rows
+
+    # Rows are keyed by pk, or by slug when there is no pk. Keys and collections are checked with
+    # one query each for the whole batch instead of one per row
+    def validate(self, rows):
+        pks = {row["pk"] for row in rows if row is not None and "pk" in row}
+        slugs = {
+            row["slug"] for row in rows if row is not None and "pk" not in row
+        }
+        self.existing = {}
+        self.inventories = {}
+        products_by_slug = {}
+        for pk, slug, collection_id, inventory in Product.objects.filter(
+            Q(pk__in=pks) | Q(slug__in=slugs)
+        ).values_list("pk", "slug", "collection_id", "inventory"):
+            self.existing[pk] = collection_id
+            self.inventories[pk] = inventory
+            products_by_slug.setdefault(slug, []).append(pk)
+        collection_ids = set(
+            Collection.objects.filter(
+                pk__in={
+                    row["collection_id"]
+                    for row in rows
+                    if row is not None and "collection_id" in row
+                }
+            ).values_list("pk", flat=True)
+        )
+
+        for index, row in enumerate(rows):
+            if row is None:
+                continue
+            errors = {}
+            if "pk" not in row:
+                matches = products_by_slug.get(row["slug"], [])
+                if len(matches) > 1:
+                    errors["slug"] = [
+                        "More than one product has this slug, send its pk instead."
+                    ]
+                elif matches:
+                    row["pk"] = matches[0]
+                else:
+                    for field in self.required_for_create:
+                        if field not in row:
+                            errors[field] = ["This field is required."]
+            elif row["pk"] not in self.existing:
+                errors["pk"] = ["No product with the given ID was found."]
+            if "collection_id" in row and row["collection_id"] not in collection_ids:
+                errors["collection_id"] = ["No collection with the given ID was found."]
+            if errors:
+                self.row_errors[index] = errors
+                rows[index] = None
+        return rows
+
+    # creates the new rows with one bulk_create and updates the existing ones with one bulk_update
+    # per set of fields sent, all in one transaction. Signals do not run for bulk writes so we do
+    # what the product handlers would: fix the collection counts, restock, reindex and bump the
+    # catalog.
+    def save(self, **kwargs):
+        rows = [row for row in self.validated_data if row is not None]
+        now = timezone.now()
+        to_create = [Product(**row) for row in rows if "pk" not in row]
+        to_update = {}
+        for row in rows:
+            if "pk" in row:
+                fields = tuple(sorted(set(row) - {"pk"}))
+                to_update.setdefault(fields, []).append(
+                    Product(last_update=now, **row)
+                )
+
+        with transaction.atomic():
+            created = Product.objects.bulk_create(to_create)
+            count_changes = Counter(product.collection_id for product in created)
+            levels = {product.pk: product.inventory for product in created}
+            inventory_changes = {}
+            updated = []
+            for fields, products in to_update.items():
+                Product.objects.bulk_update(
+                    products, [*fields, "last_update"], batch_size=1000
+                )
+                updated += products
+                if "inventory" in fields:
+                    inventory_changes.update(
+                        (product.pk, (self.inventories[product.pk], product.inventory))
+                        for product in products
+                    )
+                if "collection_id" in fields:
+                    for product in products:
+                        count_changes[self.existing[product.pk]] -= 1
+                        count_changes[product.collection_id] += 1
+            for collection_id, delta in count_changes.items():
+                if delta:
+                    add_to_product_count(collection_id, delta)
+            restock(levels)
+            add_stock(inventory_changes)
+
+            index_products([product.pk for product in created + updated])
+            transaction.on_commit(bump_catalog_version)
+
+        return {
+            "created": [product.pk for product in created],
+            "updated": [product.pk for product in updated],
+            "errors": [
+                {"index": index, "errors": errors}
+                for index, errors in sorted(self.row_errors.items())
+            ],
+        }
+
+
+# One row of a bulk upsert. collection_id is a plain integer, the collections of the whole batch
+# are checked at once by BulkProductListSerializer.validate
+class BulkProductModelSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Product
+        fields = [
+            "pk",
+            "title",
+            "slug",
+            "description",
+            "unit_price",
+            "inventory",
+            "collection_id",
+        ]
+        list_serializer_class = BulkProductListSerializer
+
+    pk = serializers.IntegerField(required=False)
+    slug = serializers.SlugField(required=False)
+    collection_id = serializers.IntegerField(required=False)
+
+    def validate(self, data):
+        if "pk" not in data and "slug" not in data:
+            raise serializers.ValidationError("Either pk or slug is required.")
+        return data
+
+
 class ReviewModelSerializer(serializers.ModelSerializer):
     class Meta:
         model = Review
@@ -127,6 +469,8 @@ class AddCartItemModelSerializer(serializers.ModelSerializer):
 
     # note that product_id above is an auto generated at run time so we cannot reference it unless we define it in the serailizer
     product_id = serializers.IntegerField()
+    # the range of CartItem.quantity, whatever the db
+    quantity = serializers.IntegerField(min_value=1, max_value=MAX_QUANTITY)
 
     def save(self, **kwargs):
         # We need to override the save method to meet our business requirements which are if a
@@ -141,31 +485,84 @@ class AddCartItemModelSerializer(serializers.ModelSerializer):
         # when overring  its methods. That means we have to set self.instance to our upated or created cart item
         # same as in the save method of the BaseSerializer to ensure all the plumbing is similar. The take away is
         # that you really need to look at the methods you are overriding and try to mimick what they do
-        cart_item = CartItem.objects.filter(
-            cart__pk=cart_pk, product__pk=product_pk
-        ).first()
-        if cart_item is not None:
-            cart_item.quantity += quantity
-            cart_item.save()
-            self.instance = cart_item
-        else:
-            self.instance = CartItem.objects.create(
-                cart_id=cart_pk, **self.validated_data
+        # The cart store (see carts.py) adds to the quantity of a product that is already in the cart.
+        # It also checks that the product exists, in the same statement as the insert with the db store,
+        # which is why there is no validate_product_id field validator here
+        try:
+            self.instance = get_cart_store().add_item(cart_pk, product_pk, quantity)
+        except Product.DoesNotExist:
+            raise serializers.ValidationError(
+                {"product_id": ["No product with the given ID was found."]}
             )
+        except QuantityTooLarge:
+            raise serializers.ValidationError(
+                {
+                    "quantity": [
+                        f"The quantity of this product in the cart would go over "
+                        f"{MAX_QUANTITY}."
+                    ]
+                }
+            )
+        if self.instance is None:
+            raise NotFound("No Cart matches the given query.")
 
         return self.instance
 
-    # We need to validate the product_id in the save method to prevent us saving a nonexistant product
-    # which will throw an exception
-    # !!!NOTE!!! this function is specially named so that it is used automatially by django
-    # this is a field level validator. It has a pattern of validate_<field_name>
-    # When serializer.is_valid is called in a view it will auto invoke any field validators.
-    # if the cart_id is invalid that is does not exist in this case an error is raised, else
-    # return the field being validated.
-    def validate_product_id(self, value):
-        if not Product.objects.filter(pk=value).exists():
-            raise serializers.ValidationError("No product with the given ID was found.")
-        return value
+
+class CartItemLineSerializer(serializers.Serializer):
+    product_id = serializers.IntegerField()
+    # the range of CartItem.quantity
+    quantity = serializers.IntegerField(min_value=1, max_value=MAX_QUANTITY)
+
+
+# Many lines added to a cart in one request, eg. a reorder or a bundle. Lines for the same product are
+# added together. With replace the cart ends up with exactly these items, otherwise they are added
+# to what is already in the cart. Saving returns the cart (see CartItemViewSet.batch)
+class BatchCartItemsSerializer(serializers.Serializer):
+    max_lines = 100
+
+    items = CartItemLineSerializer(many=True, allow_empty=False, max_length=max_lines)
+    replace = serializers.BooleanField(default=False)
+
+    # all the products are checked with one query
+    def validate_items(self, items):
+        product_ids = {item["product_id"] for item in items}
+        found = set(
+            Product.objects.filter(pk__in=product_ids).values_list("pk", flat=True)
+        )
+        missing = sorted(product_ids - found)
+        if missing:
+            raise serializers.ValidationError(
+                f"No products with the IDs {', '.join(map(str, missing))} were found."
+            )
+        return items
+
+    # each line fits in a CartItem, the store checks the sums of the lines for a product and what
+    # is already in the cart, and writes nothing when one would not fit
+    def save(self, **kwargs):
+        quantities = {}
+        for item in self.validated_data["items"]:
+            product_id = item["product_id"]
+            quantities[product_id] = quantities.get(product_id, 0) + item["quantity"]
+        try:
+            self.instance = get_cart_store().add_items(
+                self.context["cart_pk"],
+                quantities,
+                replace=self.validated_data["replace"],
+            )
+        except QuantityTooLarge as exc:
+            raise serializers.ValidationError(
+                {
+                    "items": [
+                        f"The quantity of the products with the IDs "
+                        f"{', '.join(map(str, exc.product_ids))} would go over "
+                        f"{MAX_QUANTITY}."
+                    ]
+                }
+            )
+        if self.instance is None:
+            raise NotFound("No Cart matches the given query.")
+        return self.instance
 
 
 class UpdateCartItemModelSerializer(serializers.ModelSerializer):
@@ -174,6 +571,9 @@ class UpdateCartItemModelSerializer(serializers.ModelSerializer):
         # note pk is missing because this will be for updates only
         fields = ["quantity"]
 
+    # the range of CartItem.quantity, whatever the db
+    quantity = serializers.IntegerField(min_value=1, max_value=MAX_QUANTITY)
+
 
 class CartItemModelSerializer(serializers.ModelSerializer):
     class Meta:
@@ -181,16 +581,17 @@ class CartItemModelSerializer(serializers.ModelSerializer):
         fields = ["pk", "product", "quantity", "total_price"]
 
     product = SimpleProductModelSerializer()
-    total_price = serializers.SerializerMethodField("get_total_price")
-
-    def get_total_price(self, cart_item: CartItem) -> Decimal:
-        return Decimal(cart_item.quantity) * cart_item.product.unit_price
+    # quantity * unit price, annotated by the cart store (see carts.py)
+    total_price = serializers.DecimalField(
+        max_digits=12, decimal_places=2, read_only=True
+    )
 
 
-class CartModelSerializer(serializers.ModelSerializer):
+class CartModelSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     class Meta:
         model = Cart
         fields = ["pk", "item_count", "items", "total_price"]
+        expandable_fields = ["items"]
 
     # in this case when creating a cart we do not want to send the id
     pk = serializers.UUIDField(read_only=True)
@@ -199,16 +600,11 @@ class CartModelSerializer(serializers.ModelSerializer):
         read_only=True,
         many=True,
     )
+    # both annotated by the cart store (see carts.py)
     item_count = serializers.IntegerField(read_only=True)
-    total_price = serializers.SerializerMethodField("get_total_price")
-
-    def get_total_price(self, cart: Cart) -> Decimal:
-        return sum(
-            [
-                Decimal(item.quantity) * item.product.unit_price
-                for item in cart.cartitem_set.all()
-            ]
-        )
+    total_price = serializers.DecimalField(
+        max_digits=12, decimal_places=2, read_only=True
+    )
 
 
 class CustomerModelSerializer(serializers.ModelSerializer):
@@ -238,56 +634,14 @@ class CreateOrderModelSerializer(serializers.Serializer):
     # i.e cart_id
     cart_id = serializers.UUIDField()
 
-    # this is a field level validator. It has a pattern of validate_<field_name>
-    # When serializer.is_valid is called in a view it will auto invoke any field validators.
-    # if the cart_id is invalid that is does not exist in this case an error is raised, else
-    # return the field being validated.
-    def validate_cart_id(self, value):
-        if not Cart.objects.filter(pk=value).exists():
-            raise serializers.ValidationError("No cart with the given Id was found.")
-        if CartItem.objects.filter(cart__pk=value).count() == 0:
-            raise serializers.ValidationError("The cart is empty.")
-        return value
-
-    # we have specific requirements for saving an order so override save method so must be implemented by hand
+    # The cart is checked by the checkout itself (see checkout.py), while its rows are locked, so
+    # there is no validate_cart_id field validator running its own queries beforehand.
+    # Raises a ValidationError when the cart is missing or empty, or a product is out of stock
     def save(self, **kwargs):
-        # make sure to use a transaction so that if any part of updating the db fails we roll back
-        # and nothing is done
-        with transaction.atomic():
-            # 1. Create Order
-            customer = Customer.objects.filter(user__pk=self.context["user_id"]).first()
-            order = Order.objects.create(customer=customer)
-
-            # 2. Get cart
-            # 3. Get items in cart
-            cart_items = CartItem.objects.select_related("product").filter(
-                cart__pk=self.validated_data["cart_id"]
-            )
-
-            # 4. Convert cart Items to Order items
-            order_items = [
-                OrderItem(
-                    order=order,
-                    product=item.product,
-                    unit_price=item.product.unit_price,
-                    quantity=item.quantity,
-                )
-                for item in cart_items
-            ]
-
-            # 5. Save order items to db
-            # bulk insert orderitems
-            OrderItem.objects.bulk_create(order_items)
-
-            # remove Cart and cart items (deleted by cascade)
-            Cart.objects.filter(pk=self.validated_data["cart_id"]).delete()
-
-            # fire signal. parameters are the class firing the signal and some kwargs.
-            # we can get current class via the self.__class__ keyword, and we will pass
-            # order as a kwargs
-            order_created.send_robust(self.__class__, order=order)
-
-            return order
+        self.instance = place_order(
+            self.validated_data["cart_id"], self.context["user_id"]
+        )
+        return self.instance
 
 
 class UpdateOrderModelSerializer(serializers.ModelSerializer):
@@ -296,10 +650,11 @@ class UpdateOrderModelSerializer(serializers.ModelSerializer):
         fields = ["payment_status"]
 
 
-class OrderModelSerializer(serializers.ModelSerializer):
+class OrderModelSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     class Meta:
         model = Order
         fields = ["pk", "customer", "placed_at", "payment_status", "orderitem_set"]
+        expandable_fields = ["orderitem_set"]
 
     orderitem_set = OrderItemModelSerializer(many=True, read_only=True)
 
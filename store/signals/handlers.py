@@ -1,7 +1,13 @@
-from django.db.models.signals import post_save
+from django.db import transaction
+from django.db.models.signals import pre_save, post_save, post_delete, m2m_changed
 from django.dispatch import receiver
 from django.conf import settings
-from store.models import Customer
+from store.cache import bump_catalog_version
+from store.counters import add_to_product_count, move_product
+from store.inventory import add_stock, restock
+from store.search import index_products, remove_products
+from store.models import Customer, Collection, Product, ProductImage, Promotion
+from store.tasks import generate_image_sizes
 
 
 # To register this signal handler in store app, in apps.py overrid the ready method
@@ -11,3 +17,121 @@ def create_customer_for_new_user(sender, **kwargs):
     if kwargs["created"]:
         # kwargs["instance"] holds model instance
         Customer.objects.create(user=kwargs["instance"])
+
+
+# Every model that is rendered as part of a product invalidates the catalog cache (see cache.py).
+# !!!NOTE!!! we bump the version on commit. Bumping it inside the transaction would let a concurrent
+# request read the new version, query the db before we commit, and cache the old rows under it.
+@receiver([post_save, post_delete], sender=Product)
+@receiver([post_save, post_delete], sender=Collection)
+@receiver([post_save, post_delete], sender=ProductImage)
+@receiver([post_save, post_delete], sender=Promotion)
+@receiver(m2m_changed, sender=Product.promotions.through)
+def invalidate_catalog_cache(sender, **kwargs):
+    transaction.on_commit(bump_catalog_version)
+
+
+# keep the full text index (see search.py) in sync with the products. Raw saves come from loading
+# fixtures where the related rows may not exist yet, run "manage.py rebuild_search_index" after those
+@receiver(post_save, sender=Product)
+def index_saved_product(sender, **kwargs):
+    if not kwargs["raw"]:
+        index_products([kwargs["instance"].pk])
+
+
+@receiver(post_delete, sender=Product)
+def remove_deleted_product(sender, **kwargs):
+    remove_products([kwargs["instance"].pk])
+
+
+# the collection title is indexed with each product, so renaming a collection reindexes its products
+@receiver(post_save, sender=Collection)
+def reindex_collection_products(sender, **kwargs):
+    update_fields = kwargs["update_fields"]
+    if kwargs["raw"] or kwargs["created"]:
+        return
+    if update_fields is not None and "title" not in update_fields:
+        return
+    index_products(
+        Product.objects.filter(collection=kwargs["instance"]).values_list(
+            "pk", flat=True
+        )
+    )
+
+
+# keep Collection.product_count (see counters.py) in step with the products.
+# Products loaded from the db remember their collection (see Product.from_db). One that was not, eg.
+# Product(pk=1, ...).save(), has its current collection looked up before it is overwritten.
+def _saves_collection(kwargs) -> bool:
+    update_fields = kwargs["update_fields"]
+    if kwargs["raw"]:
+        return False
+    return update_fields is None or bool({"collection", "collection_id"} & update_fields)
+
+
+@receiver(pre_save, sender=Product)
+def remember_product_collection(sender, **kwargs):
+    instance = kwargs["instance"]
+    if not _saves_collection(kwargs) or instance.pk is None:
+        return
+    if not hasattr(instance, "_loaded_collection_id"):
+        instance._loaded_collection_id = (
+            Product.objects.filter(pk=instance.pk)
+            .values_list("collection_id", flat=True)
+            .first()
+        )
+
+
+@receiver(post_save, sender=Product)
+def count_saved_product(sender, **kwargs):
+    instance = kwargs["instance"]
+    if not _saves_collection(kwargs):
+        return
+    if kwargs["created"]:
+        add_to_product_count(instance.collection_id, 1)
+    elif instance._loaded_collection_id != instance.collection_id:
+        move_product(instance._loaded_collection_id, instance.collection_id)
+    instance._loaded_collection_id = instance.collection_id
+
+
+@receiver(post_delete, sender=Product)
+def count_deleted_product(sender, **kwargs):
+    add_to_product_count(kwargs["instance"].collection_id, -1)
+
+
+# Product.inventory is a copy of the stock checkouts take from (see inventory.py), changing it
+# adds the difference to the stock. Products loaded from the db remember their inventory (see
+# Product.from_db), a new one or one that was not loaded is restocked to its inventory.
+@receiver(post_save, sender=Product)
+def restock_saved_product(sender, **kwargs):
+    instance = kwargs["instance"]
+    update_fields = kwargs["update_fields"]
+    if kwargs["raw"]:
+        return
+    if update_fields is not None and "inventory" not in update_fields:
+        return
+    loaded_inventory = getattr(instance, "_loaded_inventory", None)
+    if kwargs["created"] or loaded_inventory is None:
+        restock({instance.pk: instance.inventory})
+    else:
+        add_stock({instance.pk: (loaded_inventory, instance.inventory)})
+    instance._loaded_inventory = instance.inventory
+
+
+# resize new images in the background (see tasks.generate_image_sizes). An uploaded file that has
+# not been written yet is a new image, the sizes of the one it replaces no longer apply
+@receiver(pre_save, sender=ProductImage)
+def reset_image_sizes(sender, **kwargs):
+    instance = kwargs["instance"]
+    instance._image_changed = (
+        not kwargs["raw"] and bool(instance.image) and not instance.image._committed
+    )
+    if instance._image_changed:
+        instance.sizes = {}
+
+
+@receiver(post_save, sender=ProductImage)
+def queue_image_sizes(sender, **kwargs):
+    instance = kwargs["instance"]
+    if instance._image_changed or (kwargs["created"] and not kwargs["raw"]):
+        transaction.on_commit(lambda: generate_image_sizes.delay(instance.pk))
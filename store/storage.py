@@ -0,0 +1,65 @@
+import hashlib
+import os
+import re
+import tempfile
+from pathlib import PurePosixPath
+from django.core.files.storage import FileSystemStorage, storages
+from django.core.files.move import file_move_safe
+
+
+# Content addressed storage for uploaded product images.
+# Every file is stored once, under the sha256 of its bytes: store/images/dog.jpg is saved as
+# store/images/3f/3fa4...e9.jpg. Uploading the same bytes again returns the name of the file that is
+# already there, so the new ProductImage is just another reference to it.
+# A name always points to the same bytes, so its url can be cached forever (see is_immutable).
+# !!!NOTE!!! a file may be shared by many rows, never delete one without checking that no row
+# (ProductImage.image or ProductImage.sizes) still references it.
+class ContentAddressedStorage(FileSystemStorage):
+    # store/images/3f/3fa4...e9.jpg
+    name_pattern = re.compile(r"(^|/)([0-9a-f]{2})/\2[0-9a-f]{62}(\.[a-z0-9]+)?$")
+
+    def get_available_name(self, name, max_length=None):
+        # the name is replaced by the digest in _save, there is nothing to make unique
+        return name
+
+    def _save(self, name, content):
+        path = PurePosixPath(name)
+        parent = path.parent
+        # names derived from a stored name (eg. the resized copies, see images.py) are stored in
+        # the same directory as it, not one level down
+        if re.fullmatch("[0-9a-f]{2}", parent.name):
+            parent = parent.parent
+        directory = self.path(str(parent))
+        os.makedirs(directory, exist_ok=True)
+
+        # hash the upload while it is written to a temporary file next to where it will end up
+        digest = hashlib.sha256()
+        fd, temp_path = tempfile.mkstemp(dir=directory, suffix=".part")
+        try:
+            with os.fdopen(fd, "wb") as temp_file:
+                for chunk in content.chunks():
+                    digest.update(chunk)
+                    temp_file.write(chunk)
+
+            hexdigest = digest.hexdigest()
+            name = str(parent / hexdigest[:2] / f"{hexdigest}{path.suffix.lower()}")
+            full_path = self.path(name)
+            if os.path.exists(full_path):
+                # already stored, the upload becomes a reference to it
+                return name
+            os.makedirs(os.path.dirname(full_path), exist_ok=True)
+            file_move_safe(temp_path, full_path, allow_overwrite=True)
+            if self.file_permissions_mode is not None:
+                os.chmod(full_path, self.file_permissions_mode)
+            return name
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def is_immutable(self, name) -> bool:
+        return bool(self.name_pattern.search(name))
+
+
+# ProductImage.image storage, the "product_images" entry of settings.STORAGES
+def select_product_image_storage():
+    return storages["product_images"]
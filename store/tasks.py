@@ -0,0 +1,58 @@
+import logging
+from datetime import timedelta
+from celery import shared_task
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from store.cache import bump_catalog_version
+from store.carts import delete_abandoned_carts, get_cart_store
+from store.images import make_derivatives
+from store.inventory import sync_product_inventory
+from store.models import Product, ProductImage
+
+logger = logging.getLogger(__name__)
+
+
+# Queued after a ProductImage with a new image is saved, see signals/handlers.py
+@shared_task
+def generate_image_sizes(image_pk):
+    image = ProductImage.objects.filter(pk=image_pk).first()
+    # deleted, or saved without a file, before the task ran
+    if image is None or not image.image:
+        return
+    sizes = make_derivatives(image.image)
+    with transaction.atomic():
+        # the image may have been replaced while we were resizing, its own task fills that one in
+        updated = ProductImage.objects.filter(
+            pk=image_pk, image=image.image.name
+        ).update(sizes=sizes)
+        if updated:
+            # the sizes are part of the product, a new last_update changes its etag (see views.py)
+            Product.objects.filter(pk=image.product_id).update(
+                last_update=timezone.now()
+            )
+            transaction.on_commit(bump_catalog_version)
+
+
+# Writes the carts changed in redis to the db, see RedisCartStore and CELERY_BEAT_SCHEDULE
+@shared_task
+def flush_carts():
+    return get_cart_store().flush()
+
+
+# Deletes the carts nobody checked out, see delete_abandoned_carts and CELERY_BEAT_SCHEDULE
+@shared_task
+def delete_abandoned_carts_task():
+    carts, items = delete_abandoned_carts(
+        timedelta(seconds=settings.ABANDONED_CART_AGE),
+        batch_size=settings.ABANDONED_CART_BATCH_SIZE,
+    )
+    logger.info("Deleted %s abandoned carts with %s items", carts, items)
+    return {"carts": carts, "items": items}
+
+
+# Copies the stock checkouts take from into Product.inventory, see inventory.py and
+# CELERY_BEAT_SCHEDULE
+@shared_task
+def sync_product_inventory_task():
+    return sync_product_inventory()
@@ -0,0 +1,23 @@
+from django.core.cache import cache
+import pytest
+
+
+# the dev settings point the cache at redis, the tests run against an in-process cache instead
+@pytest.fixture(autouse=True)
+def locmem_cache(settings):
+    settings.CACHES = {
+        "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}
+    }
+    cache.clear()
+    yield
+    cache.clear()
+
+
+# silk records every request in the db, which gets in the way of counting queries
+@pytest.fixture(autouse=True)
+def without_silk(settings):
+    settings.MIDDLEWARE = [
+        middleware
+        for middleware in settings.MIDDLEWARE
+        if middleware != "silk.middleware.SilkyMiddleware"
+    ]
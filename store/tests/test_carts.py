@@ -0,0 +1,549 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from decimal import Decimal
+from uuid import uuid4
+from django.db import OperationalError, connection
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from redis import Redis
+from redis.exceptions import ConnectionError
+from store.carts import (
+    DatabaseCartStore,
+    QuantityTooLarge,
+    RedisCartStore,
+    delete_abandoned_carts,
+    get_cart_store,
+)
+from store.models import Cart, CartItem, Collection, Product
+from store.tasks import delete_abandoned_carts_task
+from rest_framework.test import APIClient
+from rest_framework import status
+import pytest
+
+TEST_REDIS_URL = "redis://localhost:6379/15"
+
+
+# the redis store against its own db, skipped when there is no redis server to talk to
+@pytest.fixture
+def redis_cart_store(settings):
+    redis = Redis.from_url(TEST_REDIS_URL)
+    try:
+        redis.ping()
+    except ConnectionError:
+        pytest.skip("redis is not running")
+    settings.CART_STORE = "store.carts.RedisCartStore"
+    settings.CART_REDIS_URL = TEST_REDIS_URL
+    RedisCartStore._redis = redis
+    redis.flushdb()
+    yield get_cart_store()
+    redis.flushdb()
+    RedisCartStore._redis = None
+
+
+# the api tests run against both stores
+@pytest.fixture(params=["database", "redis"])
+def cart_store(request, settings):
+    if request.param == "redis":
+        return request.getfixturevalue("redis_cart_store")
+    settings.CART_STORE = "store.carts.DatabaseCartStore"
+    return get_cart_store()
+
+
+@pytest.fixture
+def product():
+    collection = Collection.objects.create(title="a")
+    return Product.objects.create(
+        title="a", slug="a", unit_price=2, inventory=10, collection=collection
+    )
+
+
+@pytest.mark.django_db
+class TestCartApi:
+    def create_cart(self, api_client):
+        response = api_client.post("/store/carts/")
+        assert response.status_code == status.HTTP_201_CREATED
+        return response.data["pk"]
+
+    def test_new_cart_is_empty(self, cart_store):
+        api_client = APIClient()
+        cart_pk = self.create_cart(api_client)
+
+        response = api_client.get(f"/store/carts/{cart_pk}/")
+
+        assert response.status_code == status.HTTP_200_OK
+        assert response.data["item_count"] == 0
+        assert response.data["items"] == []
+        assert response.data["total_price"] == 0
+
+    def test_adding_a_product_twice_adds_to_its_quantity(self, cart_store, product):
+        api_client = APIClient()
+        cart_pk = self.create_cart(api_client)
+        url = f"/store/carts/{cart_pk}/items/"
+
+        api_client.post(url, {"product_id": product.pk, "quantity": 1})
+        response = api_client.post(url, {"product_id": product.pk, "quantity": 2})
+
+        assert response.status_code == status.HTTP_201_CREATED
+        assert response.data["quantity"] == 3
+        response = api_client.get(f"/store/carts/{cart_pk}/")
+        assert response.data["item_count"] == 1
+        assert response.data["items"][0]["product"]["pk"] == product.pk
+        assert response.data["total_price"] == 6
+
+    def test_update_and_remove_item(self, cart_store, product):
+        api_client = APIClient()
+        cart_pk = self.create_cart(api_client)
+        url = f"/store/carts/{cart_pk}/items/"
+        item_pk = api_client.post(url, {"product_id": product.pk, "quantity": 1}).data[
+            "pk"
+        ]
+
+        response = api_client.patch(f"{url}{item_pk}/", {"quantity": 5})
+
+        assert response.status_code == status.HTTP_200_OK
+        assert api_client.get(f"{url}{item_pk}/").data["quantity"] == 5
+        response = api_client.delete(f"{url}{item_pk}/")
+        assert response.status_code == status.HTTP_204_NO_CONTENT
+        assert api_client.get(url).data == []
+
+    def test_missing_cart_or_item_returns_404(self, cart_store):
+        api_client = APIClient()
+        cart_pk = self.create_cart(api_client)
+
+        assert (
+            api_client.get("/store/carts/a/").status_code == status.HTTP_404_NOT_FOUND
+        )
+        assert (
+            api_client.get(f"/store/carts/{cart_pk}/items/1/").status_code
+            == status.HTTP_404_NOT_FOUND
+        )
+        response = api_client.delete(f"/store/carts/{cart_pk}/")
+        assert response.status_code == status.HTTP_204_NO_CONTENT
+        response = api_client.get(f"/store/carts/{cart_pk}/")
+        assert response.status_code == status.HTTP_404_NOT_FOUND
+
+    def test_persist_writes_the_cart_to_the_db(self, cart_store, product):
+        api_client = APIClient()
+        cart_pk = self.create_cart(api_client)
+        api_client.post(
+            f"/store/carts/{cart_pk}/items/", {"product_id": product.pk, "quantity": 4}
+        )
+
+        cart_store.persist(cart_pk)
+
+        assert Cart.objects.filter(pk=cart_pk).exists()
+        item = CartItem.objects.get(cart_id=cart_pk)
+        assert (item.product_id, item.quantity) == (product.pk, 4)
+
+
+@pytest.mark.django_db
+class TestCartTotals:
+    def create_cart(self, product):
+        other = Product.objects.create(
+            title="b",
+            slug="b",
+            unit_price="0.35",
+            inventory=10,
+            collection=product.collection,
+        )
+        cart = Cart.objects.create()
+        CartItem.objects.create(cart=cart, product=product, quantity=3)
+        CartItem.objects.create(cart=cart, product=other, quantity=3)
+        return cart
+
+    def test_totals_are_computed_by_the_db(self, django_assert_num_queries, product):
+        cart = self.create_cart(product)
+        api_client = APIClient()
+
+        # the cart with its count and total, then its items with their totals
+        with django_assert_num_queries(2):
+            response = api_client.get(f"/store/carts/{cart.pk}/")
+
+        assert response.data["item_count"] == 2
+        assert response.data["total_price"] == Decimal("7.05")
+        assert [item["total_price"] for item in response.data["items"]] == [
+            Decimal("6.00"),
+            Decimal("1.05"),
+        ]
+
+    def test_items_have_their_totals(self, cart_store, product):
+        cart = self.create_cart(product)
+        api_client = APIClient()
+
+        response = api_client.get(f"/store/carts/{cart.pk}/items/")
+
+        assert [item["total_price"] for item in response.data] == [
+            Decimal("6.00"),
+            Decimal("1.05"),
+        ]
+
+    def test_total_alone_is_one_query(self, django_assert_num_queries, product):
+        cart = self.create_cart(product)
+        api_client = APIClient()
+
+        with django_assert_num_queries(1):
+            response = api_client.get(
+                f"/store/carts/{cart.pk}/", {"fields": "pk,total_price"}
+            )
+
+        assert response.data["total_price"] == Decimal("7.05")
+
+    def test_redis_store_sets_the_same_totals(self, redis_cart_store, product):
+        cart = self.create_cart(product)
+
+        cart = redis_cart_store.get_cart(cart.pk)
+
+        assert cart.total_price == Decimal("7.05")
+        assert [item.total_price for item in cart.cartitem_set.all()] == [
+            Decimal("6.00"),
+            Decimal("1.05"),
+        ]
+
+
+@pytest.mark.django_db
+class TestBatchCartItems:
+    def create_products(self, product, count):
+        return [product] + [
+            Product.objects.create(
+                title=f"p{index}",
+                slug=f"p{index}",
+                unit_price=1,
+                inventory=10,
+                collection=product.collection,
+            )
+            for index in range(count - 1)
+        ]
+
+    def test_adds_to_the_items_in_the_cart(self, cart_store, product):
+        first, second = self.create_products(product, 2)
+        api_client = APIClient()
+        cart_pk = api_client.post("/store/carts/").data["pk"]
+        api_client.post(
+            f"/store/carts/{cart_pk}/items/", {"product_id": first.pk, "quantity": 1}
+        )
+
+        response = api_client.post(
+            f"/store/carts/{cart_pk}/items/batch/",
+            {
+                "items": [
+                    {"product_id": first.pk, "quantity": 2},
+                    {"product_id": second.pk, "quantity": 1},
+                    {"product_id": second.pk, "quantity": 1},
+                ]
+            },
+            format="json",
+        )
+
+        assert response.status_code == status.HTTP_200_OK
+        quantities = {
+            item["product"]["pk"]: item["quantity"] for item in response.data["items"]
+        }
+        assert quantities == {first.pk: 3, second.pk: 2}
+        assert response.data["total_price"] == 8
+
+    def test_replace_sets_the_cart_to_the_items(self, cart_store, product):
+        first, second = self.create_products(product, 2)
+        api_client = APIClient()
+        cart_pk = api_client.post("/store/carts/").data["pk"]
+        api_client.post(
+            f"/store/carts/{cart_pk}/items/", {"product_id": first.pk, "quantity": 1}
+        )
+
+        response = api_client.post(
+            f"/store/carts/{cart_pk}/items/batch/",
+            {"items": [{"product_id": second.pk, "quantity": 4}], "replace": True},
+            format="json",
+        )
+
+        assert response.status_code == status.HTTP_200_OK
+        assert [
+            (item["product"]["pk"], item["quantity"]) for item in response.data["items"]
+        ] == [(second.pk, 4)]
+
+    def test_unknown_product_rejects_the_whole_batch(self, cart_store, product):
+        api_client = APIClient()
+        cart_pk = api_client.post("/store/carts/").data["pk"]
+
+        response = api_client.post(
+            f"/store/carts/{cart_pk}/items/batch/",
+            {
+                "items": [
+                    {"product_id": product.pk, "quantity": 1},
+                    {"product_id": 0, "quantity": 1},
+                ]
+            },
+            format="json",
+        )
+
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+        assert response.data["items"] is not None
+        assert api_client.get(f"/store/carts/{cart_pk}/").data["items"] == []
+
+    def test_quantities_over_the_limit_reject_the_whole_batch(
+        self, cart_store, product
+    ):
+        first, second = self.create_products(product, 2)
+        api_client = APIClient()
+        cart_pk = api_client.post("/store/carts/").data["pk"]
+        api_client.post(
+            f"/store/carts/{cart_pk}/items/",
+            {"product_id": first.pk, "quantity": 32000},
+        )
+
+        # each line fits, but not once added to the cart or to the other lines
+        for items in [
+            [{"product_id": first.pk, "quantity": 800}],
+            [
+                {"product_id": second.pk, "quantity": 20000},
+                {"product_id": second.pk, "quantity": 20000},
+            ],
+        ]:
+            response = api_client.post(
+                f"/store/carts/{cart_pk}/items/batch/",
+                {"items": items},
+                format="json",
+            )
+            assert response.status_code == status.HTTP_400_BAD_REQUEST
+            assert "32767" in response.data["items"][0]
+
+        assert [
+            (item["product"]["pk"], item["quantity"])
+            for item in api_client.get(f"/store/carts/{cart_pk}/").data["items"]
+        ] == [(first.pk, 32000)]
+
+    def test_query_count_does_not_grow_with_the_lines(
+        self, django_assert_num_queries, product
+    ):
+        products = self.create_products(product, 30)
+        cart = Cart.objects.create()
+        api_client = APIClient()
+
+        # validate the products, lock the cart, read the items in it, upsert, then render the
+        # cart and its items. Plus the savepoint of the transaction and its release
+        with django_assert_num_queries(8):
+            response = api_client.post(
+                f"/store/carts/{cart.pk}/items/batch/",
+                {
+                    "items": [
+                        {"product_id": product.pk, "quantity": 1}
+                        for product in products
+                    ]
+                },
+                format="json",
+            )
+
+        assert response.data["item_count"] == 30
+
+
+@pytest.mark.django_db
+class TestLazyCartCreation:
+    @pytest.fixture(autouse=True)
+    def lazy_carts(self, settings):
+        settings.CART_LAZY_CREATE = True
+
+    def test_unknown_cart_reads_as_empty_without_writing(self, cart_store):
+        api_client = APIClient()
+        cart_pk = uuid4()
+
+        response = api_client.get(f"/store/carts/{cart_pk}/")
+
+        assert response.status_code == status.HTTP_200_OK
+        assert response.data["item_count"] == 0
+        assert response.data["items"] == []
+        assert not Cart.objects.filter(pk=cart_pk).exists()
+
+    def test_first_add_creates_the_cart(self, cart_store, product):
+        api_client = APIClient()
+        cart_pk = uuid4()
+
+        response = api_client.post(
+            f"/store/carts/{cart_pk}/items/", {"product_id": product.pk, "quantity": 2}
+        )
+
+        assert response.status_code == status.HTTP_201_CREATED
+        response = api_client.get(f"/store/carts/{cart_pk}/")
+        assert response.data["pk"] == str(cart_pk)
+        assert response.data["item_count"] == 1
+
+    def test_failed_add_does_not_create_the_cart(self, cart_store):
+        api_client = APIClient()
+        cart_pk = uuid4()
+
+        response = api_client.post(
+            f"/store/carts/{cart_pk}/items/", {"product_id": 0, "quantity": 1}
+        )
+
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+        assert not Cart.objects.filter(pk=cart_pk).exists()
+
+    def test_db_store_creates_the_cart_with_the_item(self, product):
+        cart_pk = uuid4()
+
+        DatabaseCartStore().add_items(cart_pk, {product.pk: 1})
+
+        assert CartItem.objects.get(cart_id=cart_pk).quantity == 1
+
+    def test_invalid_id_returns_404(self, cart_store, product):
+        api_client = APIClient()
+
+        response = api_client.post(
+            "/store/carts/a/items/", {"product_id": product.pk, "quantity": 1}
+        )
+
+        assert response.status_code == status.HTTP_404_NOT_FOUND
+
+
+@pytest.mark.django_db
+class TestRedisCartStoreFlush:
+    def test_flush_writes_changed_carts_once(self, redis_cart_store, product):
+        cart = redis_cart_store.create_cart()
+        redis_cart_store.add_item(cart.pk, product.pk, 2)
+
+        assert redis_cart_store.flush() == 1
+        assert redis_cart_store.flush() == 0
+        assert CartItem.objects.get(cart_id=cart.pk).quantity == 2
+
+
+@pytest.mark.django_db
+class TestAddCartItem:
+    def test_adding_over_the_limit_returns_400(self, cart_store, product):
+        api_client = APIClient()
+        cart_pk = api_client.post("/store/carts/").data["pk"]
+        url = f"/store/carts/{cart_pk}/items/"
+        api_client.post(url, {"product_id": product.pk, "quantity": 32000})
+
+        too_much = api_client.post(url, {"product_id": product.pk, "quantity": 800})
+        too_much_at_once = api_client.post(
+            url, {"product_id": product.pk, "quantity": 40000}
+        )
+        up_to_the_limit = api_client.post(
+            url, {"product_id": product.pk, "quantity": 767}
+        )
+
+        assert too_much.status_code == status.HTTP_400_BAD_REQUEST
+        assert "32767" in too_much.data["quantity"][0]
+        assert too_much_at_once.status_code == status.HTTP_400_BAD_REQUEST
+        assert up_to_the_limit.status_code == status.HTTP_201_CREATED
+        assert up_to_the_limit.data["quantity"] == 32767
+
+    def test_adding_over_the_limit_without_upsert_raises(self, product):
+        store = DatabaseCartStore()
+        cart = Cart.objects.create()
+        store.add_item_without_upsert(cart.pk, product.pk, 32000)
+
+        with pytest.raises(QuantityTooLarge):
+            store.add_item_without_upsert(cart.pk, product.pk, 800)
+        assert store.add_item_without_upsert(cart.pk, product.pk, 767).quantity == 32767
+
+    def test_unknown_product_returns_400(self, cart_store):
+        api_client = APIClient()
+        cart_pk = api_client.post("/store/carts/").data["pk"]
+
+        response = api_client.post(
+            f"/store/carts/{cart_pk}/items/", {"product_id": 0, "quantity": 1}
+        )
+
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+        assert response.data["product_id"] is not None
+
+    def test_unknown_cart_returns_404(self, cart_store, product):
+        api_client = APIClient()
+
+        response = api_client.post(
+            f"/store/carts/{uuid4()}/items/", {"product_id": product.pk, "quantity": 1}
+        )
+
+        assert response.status_code == status.HTTP_404_NOT_FOUND
+
+    def test_adding_is_one_query(self, django_assert_num_queries, product):
+        cart = Cart.objects.create()
+        CartItem.objects.create(cart=cart, product=product, quantity=1)
+        store = DatabaseCartStore()
+
+        with django_assert_num_queries(1):
+            item = store.add_item(cart.pk, product.pk, 2)
+
+        assert item.quantity == 3
+
+
+@pytest.mark.django_db(transaction=True)
+class TestConcurrentAddCartItem:
+    def test_parallel_adds_are_all_counted(self, product):
+        cart = Cart.objects.create()
+        store = DatabaseCartStore()
+
+        def add(_):
+            try:
+                # the in-memory sqlite test db refuses a statement while another connection
+                # writes the table instead of waiting for it. Nothing was written, try again
+                while True:
+                    try:
+                        return store.add_item(cart.pk, product.pk, 1)
+                    except OperationalError as error:
+                        if "locked" not in str(error):
+                            raise
+            finally:
+                connection.close()
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            list(executor.map(add, range(40)))
+
+        assert CartItem.objects.get(cart=cart, product=product).quantity == 40
+
+
+@pytest.mark.django_db
+class TestDeleteAbandonedCarts:
+    def test_deletes_old_carts_and_their_items_in_batches(self, settings, product):
+        settings.ABANDONED_CART_AGE = 24 * 60 * 60
+        settings.ABANDONED_CART_BATCH_SIZE = 2
+        old_carts = [Cart.objects.create() for _ in range(5)]
+        for cart in old_carts:
+            CartItem.objects.create(cart=cart, product=product, quantity=1)
+        Cart.objects.update(created_at=timezone.now() - timedelta(days=2))
+        CartItem.objects.update(updated_at=timezone.now() - timedelta(days=2))
+        recent = Cart.objects.create()
+        CartItem.objects.create(cart=recent, product=product, quantity=1)
+
+        result = delete_abandoned_carts_task()
+
+        assert result == {"carts": 5, "items": 5}
+        assert list(Cart.objects.values_list("pk", flat=True)) == [recent.pk]
+        assert CartItem.objects.count() == 1
+
+    def test_keeps_old_carts_changed_recently(self, settings, product):
+        settings.ABANDONED_CART_AGE = 24 * 60 * 60
+        old_cart = Cart.objects.create()
+        CartItem.objects.create(cart=old_cart, product=product, quantity=1)
+        Cart.objects.update(created_at=timezone.now() - timedelta(days=2))
+        CartItem.objects.update(updated_at=timezone.now() - timedelta(days=2))
+        other = Product.objects.create(
+            title="b",
+            slug="b",
+            unit_price=1,
+            inventory=1,
+            collection=product.collection,
+        )
+
+        DatabaseCartStore().add_item(old_cart.pk, other.pk, 1)
+
+        assert delete_abandoned_carts_task() == {"carts": 0, "items": 0}
+        assert CartItem.objects.filter(cart=old_cart).count() == 2
+
+    def test_deletes_a_batch_with_three_statements(self, product):
+        carts = [Cart.objects.create() for _ in range(3)]
+        for cart in carts:
+            CartItem.objects.create(cart=cart, product=product, quantity=1)
+        Cart.objects.update(created_at=timezone.now() - timedelta(days=2))
+        CartItem.objects.update(updated_at=timezone.now() - timedelta(days=2))
+
+        with CaptureQueriesContext(connection) as queries:
+            assert delete_abandoned_carts(timedelta(days=1)) == (3, 3)
+
+        # the transaction of the batch (savepoints here) aside: one select to find the batch, one
+        # select and two deletes, one select to find nothing more
+        statements = [
+            query["sql"].split()[0]
+            for query in queries.captured_queries
+            if not query["sql"].startswith(("SAVEPOINT", "RELEASE"))
+        ]
+        assert statements == ["SELECT", "SELECT", "DELETE", "DELETE", "SELECT"]
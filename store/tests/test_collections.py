@@ -1,4 +1,5 @@
-from store.models import Collection
+from store.counters import reconcile_product_counts
+from store.models import Collection, Product
 from django.contrib.auth.models import User
 from rest_framework.test import APIClient
 from rest_framework import status
@@ -79,3 +80,38 @@ class TestRetrieveCollection:
             "title": collection.title,
             "product_count": 0,
         }
+
+
+@pytest.mark.django_db
+class TestCollectionProductCount:
+    def create_product(self, collection):
+        return Product.objects.create(
+            title="a", slug="a", unit_price=1, inventory=1, collection=collection
+        )
+
+    def test_follows_products_being_added_moved_and_deleted(self):
+        first = Collection.objects.create(title="a")
+        second = Collection.objects.create(title="b")
+        product = self.create_product(first)
+        self.create_product(first)
+
+        product = Product.objects.get(pk=product.pk)
+        product.collection = second
+        product.save()
+        Product.objects.filter(collection=first).delete()
+
+        first.refresh_from_db()
+        second.refresh_from_db()
+        assert first.product_count == 0
+        assert second.product_count == 1
+
+    def test_reconcile_repairs_drift(self):
+        collection = Collection.objects.create(title="a")
+        self.create_product(collection)
+        Collection.objects.update(product_count=5)
+
+        repaired = reconcile_product_counts()
+
+        collection.refresh_from_db()
+        assert repaired == 1
+        assert collection.product_count == 1
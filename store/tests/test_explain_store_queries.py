@@ -0,0 +1,42 @@
+from io import StringIO
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from store.models import Collection, Product
+import pytest
+
+
+@pytest.mark.django_db
+class TestExplainStoreQueries:
+    def create_products(self):
+        collection = Collection.objects.create(title="a")
+        for i in range(3):
+            Product.objects.create(
+                title=f"p{i}",
+                slug=f"p{i}",
+                unit_price=1,
+                inventory=1,
+                collection=collection,
+            )
+        return collection
+
+    def test_explains_every_viewset_query(self):
+        collection = self.create_products()
+        out = StringIO()
+
+        call_command("explain_store_queries", "--plans", stdout=out)
+
+        output = out.getvalue()
+        assert "products {'collection_id': %d}" % collection.pk in output
+        assert "items of a cart" in output
+        assert "queries flagged." in output
+
+    def test_fail_raises_when_a_query_is_flagged(self):
+        self.create_products()
+
+        # collections are listed in full, so there is always a scan to flag
+        with pytest.raises(CommandError):
+            call_command("explain_store_queries", "--fail", stdout=StringIO())
+
+    def test_needs_products(self):
+        with pytest.raises(CommandError):
+            call_command("explain_store_queries", stdout=StringIO())
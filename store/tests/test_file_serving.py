@@ -0,0 +1,85 @@
+from rest_framework.test import APIClient
+from rest_framework import status
+import pytest
+
+
+@pytest.fixture
+def media_file(settings, tmp_path):
+    settings.MEDIA_ROOT = tmp_path
+    (tmp_path / "dog.jpg").write_bytes(bytes(range(256)) * 4)
+    return tmp_path / "dog.jpg"
+
+
+def read(response):
+    return b"".join(response.streaming_content)
+
+
+class TestSendfileMode:
+    @pytest.fixture(autouse=True)
+    def sendfile_mode(self, settings):
+        settings.FILE_SERVE_MODE = "sendfile"
+
+    def test_serves_the_whole_file(self, media_file):
+        response = APIClient().get("/media/dog.jpg")
+
+        assert response.status_code == status.HTTP_200_OK
+        assert read(response) == media_file.read_bytes()
+        assert response["Content-Type"] == "image/jpeg"
+        assert response["Accept-Ranges"] == "bytes"
+
+    @pytest.mark.parametrize(
+        "header, start, end",
+        [("bytes=0-9", 0, 9), ("bytes=1000-", 1000, 1023), ("bytes=-4", 1020, 1023)],
+    )
+    def test_serves_a_range(self, media_file, header, start, end):
+        response = APIClient().get("/media/dog.jpg", HTTP_RANGE=header)
+
+        assert response.status_code == status.HTTP_206_PARTIAL_CONTENT
+        assert read(response) == media_file.read_bytes()[start : end + 1]
+        assert response["Content-Range"] == f"bytes {start}-{end}/1024"
+        assert response["Content-Length"] == str(end - start + 1)
+
+    def test_range_outside_the_file(self, media_file):
+        response = APIClient().get("/media/dog.jpg", HTTP_RANGE="bytes=2000-")
+
+        assert response.status_code == status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE
+        assert response["Content-Range"] == "bytes */1024"
+
+    def test_stale_if_range_gets_the_whole_file(self, media_file):
+        response = APIClient().get(
+            "/media/dog.jpg", HTTP_RANGE="bytes=0-9", HTTP_IF_RANGE='"old"'
+        )
+
+        assert response.status_code == status.HTTP_200_OK
+
+    def test_not_modified(self, media_file):
+        client = APIClient()
+        etag = client.get("/media/dog.jpg")["ETag"]
+
+        response = client.get("/media/dog.jpg", HTTP_IF_NONE_MATCH=etag)
+
+        assert response.status_code == status.HTTP_304_NOT_MODIFIED
+
+    def test_stays_inside_the_root(self, media_file):
+        response = APIClient().get("/media/../settings.py")
+
+        assert response.status_code == status.HTTP_404_NOT_FOUND
+
+
+class TestProxyModes:
+    def test_x_accel_redirect(self, settings, media_file):
+        settings.FILE_SERVE_MODE = "x-accel-redirect"
+
+        response = APIClient().get("/media/dog.jpg")
+
+        assert response["X-Accel-Redirect"] == "/protected/media/dog.jpg"
+        assert response["Content-Type"] == "image/jpeg"
+        assert response.content == b""
+
+    def test_x_sendfile(self, settings, media_file):
+        settings.FILE_SERVE_MODE = "x-sendfile"
+
+        response = APIClient().get("/media/dog.jpg")
+
+        assert response["X-Sendfile"] == str(media_file)
+        assert response.content == b""
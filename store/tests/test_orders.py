@@ -0,0 +1,188 @@
+from django.contrib.auth import get_user_model
+from django.db.models import Sum
+from store.cache import get_catalog_version
+from store.inventory import shard_stock, sync_product_inventory
+from store.models import (
+    Cart,
+    CartItem,
+    Collection,
+    Order,
+    Product,
+    ProductStock,
+    StockBucket,
+)
+from rest_framework.test import APIClient
+from rest_framework import status
+import pytest
+
+
+@pytest.mark.django_db
+class TestCreateOrder:
+    @pytest.fixture
+    def api_client(self):
+        # a Customer is created with the user, see signals/handlers.py
+        user = get_user_model().objects.create_user("a", "a@home.test", "x")
+        api_client = APIClient()
+        api_client.force_authenticate(user=user)
+        return api_client
+
+    def create_cart(self, count, inventory=10, quantity=2):
+        collection = Collection.objects.create(title="a")
+        cart = Cart.objects.create()
+        for index in range(count):
+            product = Product.objects.create(
+                title=f"p{index}",
+                slug=f"p{index}",
+                unit_price=1,
+                inventory=inventory,
+                collection=collection,
+            )
+            CartItem.objects.create(cart=cart, product=product, quantity=quantity)
+        return cart
+
+    def get_stock(self):
+        return list(
+            ProductStock.objects.order_by("pk").values_list("available", flat=True)
+        )
+
+    def test_takes_the_items_off_the_inventory(self, api_client):
+        cart = self.create_cart(2)
+
+        response = api_client.post("/store/orders/", {"cart_id": cart.pk})
+
+        assert response.status_code == status.HTTP_200_OK
+        assert len(response.data["orderitem_set"]) == 2
+        assert self.get_stock() == [8, 8]
+        assert not Cart.objects.filter(pk=cart.pk).exists()
+        # the catalog copy is left alone until the next sync
+        assert list(Product.objects.values_list("inventory", flat=True)) == [10, 10]
+        assert sync_product_inventory() == 2
+        assert list(Product.objects.values_list("inventory", flat=True)) == [8, 8]
+
+    def test_sync_bumps_the_catalog_version(
+        self, api_client, django_capture_on_commit_callbacks
+    ):
+        cart = self.create_cart(1)
+        api_client.post("/store/orders/", {"cart_id": cart.pk})
+        version = get_catalog_version()
+
+        with django_capture_on_commit_callbacks(execute=True):
+            assert sync_product_inventory() == 1
+
+        assert get_catalog_version() == version + 1
+
+    def test_sync_only_reads_the_stock_changed_since_the_last_run(self):
+        self.create_cart(2)
+        assert sync_product_inventory() == 0
+        assert not ProductStock.objects.filter(changed=True).exists()
+        Product.objects.update(inventory=0)
+        ProductStock.objects.filter(product__title="p0").update(changed=True)
+
+        assert sync_product_inventory() == 1
+        # the other product was not read, its inventory is not put back
+        assert list(Product.objects.values_list("inventory", flat=True)) == [10, 0]
+        assert sync_product_inventory() == 0
+
+    def test_oversell_writes_nothing_and_returns_400(self, api_client):
+        cart = self.create_cart(2)
+        ProductStock.objects.filter(product__title="p1").update(available=1)
+
+        response = api_client.post("/store/orders/", {"cart_id": cart.pk})
+
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+        assert "p1" in response.data["cart_id"][0]
+        assert self.get_stock() == [10, 1]
+        assert Order.objects.count() == 0
+        assert CartItem.objects.filter(cart=cart).count() == 2
+
+    def test_empty_or_missing_cart_returns_400(self, api_client):
+        cart = Cart.objects.create()
+
+        response = api_client.post("/store/orders/", {"cart_id": cart.pk})
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+        cart_pk = cart.pk
+        cart.delete()
+        response = api_client.post("/store/orders/", {"cart_id": cart_pk})
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+
+    @pytest.mark.parametrize("count", [1, 20])
+    def test_query_count_does_not_grow_with_the_cart(
+        self, api_client, django_assert_num_queries, count
+    ):
+        cart = self.create_cart(count)
+
+        # customer, savepoint, items with their products and stock, locked stock, stock UPDATE,
+        # order, order items, the cart read by the delete collector, cart items and cart deletes,
+        # savepoint release. The response needs no query
+        with django_assert_num_queries(11):
+            response = api_client.post("/store/orders/", {"cart_id": cart.pk})
+
+        assert response.status_code == status.HTTP_200_OK
+
+    def test_sharded_product_sells_its_whole_stock_from_buckets(
+        self, api_client, settings
+    ):
+        settings.STOCK_BUCKET_REFILL = 2
+        cart = self.create_cart(1, inventory=11)
+        product = Product.objects.get()
+        shard_stock(product.pk, 4)
+        assert StockBucket.objects.filter(product=product).count() == 4
+        assert self.get_stock() == [3]
+
+        # the buckets run out before the stock row, the last checkout gathers what is left in them
+        for _ in range(5):
+            response = api_client.post("/store/orders/", {"cart_id": cart.pk})
+            assert response.status_code == status.HTTP_200_OK
+            cart = Cart.objects.create()
+            CartItem.objects.create(cart=cart, product=product, quantity=2)
+        response = api_client.post("/store/orders/", {"cart_id": cart.pk})
+
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+        assert "p0" in response.data["cart_id"][0]
+        assert Order.objects.count() == 5
+        sync_product_inventory()
+        product.refresh_from_db()
+        assert product.inventory == 1
+
+    def test_lowering_the_inventory_takes_from_the_buckets_too(self, settings):
+        settings.STOCK_BUCKET_REFILL = 2
+        self.create_cart(1)
+        product = Product.objects.get()
+        shard_stock(product.pk, 2)
+
+        product.title = "renamed"
+        product.save()
+        assert self.get_stock() == [6]
+        product.inventory = 5
+        product.save()
+
+        assert self.get_stock() == [5]
+        assert StockBucket.objects.aggregate(total=Sum("available"))["total"] == 0
+
+    def test_editing_a_stale_inventory_adds_the_difference(self, api_client):
+        cart = self.create_cart(1)
+        api_client.post("/store/orders/", {"cart_id": cart.pk})
+        product = Product.objects.get()
+        admin_client = APIClient()
+        admin_client.force_authenticate(user=get_user_model()(is_staff=True))
+        # the inventory has not been synced yet, the client still sees 10
+        data = admin_client.get(f"/store/products/{product.pk}/").data
+        assert data["inventory"] == 10
+
+        # saving what was read sells nothing twice
+        data["title"] = "renamed"
+        admin_client.put(f"/store/products/{product.pk}/", data, format="json")
+        assert self.get_stock() == [8]
+        data["inventory"] = 15
+        admin_client.put(f"/store/products/{product.pk}/", data, format="json")
+        assert self.get_stock() == [13]
+
+    def test_lowering_the_inventory_below_the_stock_leaves_none(self):
+        self.create_cart(1)
+        ProductStock.objects.update(available=3)
+        product = Product.objects.get()
+
+        product.inventory = 2
+        product.save()
+
+        assert self.get_stock() == [0]
@@ -0,0 +1,235 @@
+import hashlib
+from decimal import Decimal
+from io import BytesIO, StringIO
+from django.conf import settings
+from django.core.files.storage import FileSystemStorage
+from django.core.management import call_command
+from django.core.files.uploadedfile import SimpleUploadedFile
+from PIL import Image
+from store.images import IMAGE_FORMATS, IMAGE_SIZES
+from store.models import Collection, Product, ProductImage
+from store.tasks import generate_image_sizes
+from store.uploads import ImageUploadHandler
+from store.validators import MAX_IMAGE_DIMENSION
+from rest_framework import status
+from rest_framework.exceptions import ValidationError
+from rest_framework.test import APIClient
+import pytest
+
+
+@pytest.fixture
+def media_root(settings, tmp_path):
+    settings.MEDIA_ROOT = tmp_path
+    return tmp_path
+
+
+@pytest.fixture
+def product():
+    collection = Collection.objects.create(title="a")
+    return Product.objects.create(
+        title="a",
+        slug="a",
+        unit_price=Decimal("10.00"),
+        inventory=10,
+        collection=collection,
+    )
+
+
+def make_upload(width, height, format="PNG"):
+    content = BytesIO()
+    Image.new("RGBA", (width, height), (200, 100, 50, 255)).save(content, format)
+    return SimpleUploadedFile(
+        f"dog.{format.lower()}", content.getvalue(), f"image/{format.lower()}"
+    )
+
+
+@pytest.mark.django_db
+class TestGenerateImageSizes:
+    def test_writes_every_size_and_format(self, media_root, product):
+        image = ProductImage.objects.create(
+            product=product, image=make_upload(1000, 500)
+        )
+
+        generate_image_sizes(image.pk)
+
+        image.refresh_from_db()
+        assert set(image.sizes) == set(IMAGE_SIZES)
+        for size, formats in image.sizes.items():
+            assert set(formats) == set(IMAGE_FORMATS)
+            for format, name in formats.items():
+                with Image.open(media_root / name) as resized:
+                    assert resized.format.lower() == format
+                    # never scaled up past the original
+                    assert resized.size[0] == min(IMAGE_SIZES[size], 1000)
+                    assert resized.size[1] == resized.size[0] // 2
+
+    def test_marks_the_product_as_updated(self, media_root, product):
+        image = ProductImage.objects.create(product=product, image=make_upload(10, 10))
+        last_update = Product.objects.get(pk=product.pk).last_update
+
+        generate_image_sizes(image.pk)
+
+        assert Product.objects.get(pk=product.pk).last_update > last_update
+
+    def test_ignores_deleted_images(self, media_root, product):
+        image = ProductImage.objects.create(product=product, image=make_upload(10, 10))
+        pk = image.pk
+        image.delete()
+
+        generate_image_sizes(pk)
+
+    def test_new_image_is_queued_on_commit(
+        self, media_root, product, monkeypatch, django_capture_on_commit_callbacks
+    ):
+        queued = []
+        monkeypatch.setattr(generate_image_sizes, "delay", queued.append)
+
+        with django_capture_on_commit_callbacks(execute=True):
+            image = ProductImage.objects.create(
+                product=product, image=make_upload(10, 10)
+            )
+        with django_capture_on_commit_callbacks(execute=True):
+            image.save()
+
+        # saving without a new file does not resize again
+        assert queued == [image.pk]
+
+    def test_new_file_resets_the_sizes(self, media_root, product, monkeypatch):
+        monkeypatch.setattr(generate_image_sizes, "delay", lambda pk: None)
+        image = ProductImage.objects.create(product=product, image=make_upload(10, 10))
+        generate_image_sizes(image.pk)
+        image.refresh_from_db()
+
+        image.image = make_upload(20, 20)
+        image.save()
+
+        image.refresh_from_db()
+        assert image.sizes == {}
+
+    def test_api_returns_the_size_urls(self, media_root, product):
+        image = ProductImage.objects.create(product=product, image=make_upload(10, 10))
+        generate_image_sizes(image.pk)
+
+        response = APIClient().get(f"/store/products/{product.pk}/images/")
+
+        sizes = response.data[0]["sizes"]
+        assert set(sizes) == set(IMAGE_SIZES)
+        assert sizes["thumbnail"]["webp"].startswith(
+            "http://testserver/media/store/images/"
+        )
+        assert sizes["thumbnail"]["webp"].endswith(".webp")
+
+
+@pytest.mark.django_db
+class TestContentAddressedStorage:
+    def test_same_bytes_are_stored_once(self, media_root, product):
+        first = ProductImage.objects.create(product=product, image=make_upload(10, 10))
+        second = ProductImage.objects.create(product=product, image=make_upload(10, 10))
+        other = ProductImage.objects.create(product=product, image=make_upload(20, 10))
+
+        assert first.image.name == second.image.name
+        assert other.image.name != first.image.name
+        assert len(list((media_root / "store/images").glob("*/*.png"))) == 2
+        assert not list(media_root.rglob("*.part"))
+
+    def test_name_is_the_digest_of_the_content(self, media_root, product):
+        upload = make_upload(10, 10)
+        digest = hashlib.sha256(upload.read()).hexdigest()
+
+        image = ProductImage.objects.create(product=product, image=upload)
+
+        assert image.image.name == f"store/images/{digest[:2]}/{digest}.png"
+
+    def test_content_addressed_files_are_cached_forever(self, media_root, product):
+        image = ProductImage.objects.create(product=product, image=make_upload(10, 10))
+        (media_root / "old.png").write_bytes(b"x")
+        client = APIClient()
+
+        response = client.get(f"/media/{image.image.name}")
+        old_response = client.get("/media/old.png")
+
+        assert response["Cache-Control"] == settings.IMMUTABLE_CACHE_CONTROL
+        assert "Cache-Control" not in old_response
+
+    def test_dedupe_moves_existing_copies_into_one_file(self, media_root, product):
+        storage = FileSystemStorage()
+        for name in ["dog.png", "dog_EL1Rfw0.png"]:
+            storage.save(f"store/images/{name}", make_upload(10, 10))
+            ProductImage.objects.create(product=product, image=f"store/images/{name}")
+
+        call_command("dedupe_product_images", stdout=StringIO())
+
+        names = set(ProductImage.objects.values_list("image", flat=True))
+        assert len(names) == 1
+        assert (media_root / names.pop()).exists()
+        assert not (media_root / "store/images/dog.png").exists()
+
+    def test_dedupe_changes_the_cached_product(
+        self, media_root, product, django_capture_on_commit_callbacks
+    ):
+        FileSystemStorage().save("store/images/dog.png", make_upload(10, 10))
+        ProductImage.objects.create(product=product, image="store/images/dog.png")
+        client = APIClient()
+        response = client.get(f"/store/products/{product.pk}/")
+
+        with django_capture_on_commit_callbacks(execute=True):
+            call_command("dedupe_product_images", stdout=StringIO())
+        deduped = client.get(
+            f"/store/products/{product.pk}/", HTTP_IF_NONE_MATCH=response["ETag"]
+        )
+
+        assert deduped.status_code == status.HTTP_200_OK
+        assert b"store/images/dog.png" in response.content
+        assert b"store/images/dog.png" not in deduped.content
+
+
+@pytest.mark.django_db
+class TestImageUploadHandler:
+    def post(self, product, upload):
+        return APIClient().post(
+            f"/store/products/{product.pk}/images/",
+            {"image": upload},
+            format="multipart",
+        )
+
+    def test_accepts_an_image(self, media_root, product, monkeypatch):
+        monkeypatch.setattr(generate_image_sizes, "delay", lambda pk: None)
+
+        response = self.post(product, make_upload(10, 10))
+
+        assert response.status_code == status.HTTP_201_CREATED
+
+    def test_rejects_files_over_the_limit_before_reading_them(
+        self, media_root, product
+    ):
+        upload = SimpleUploadedFile("dog.png", b"\x89PNG\r\n\x1a\n" + b"0" * 600 * 1024)
+
+        response = self.post(product, upload)
+
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+        assert "500KB" in response.data["image"][0]
+        assert not ProductImage.objects.exists()
+
+    def test_counts_the_bytes_of_each_chunk(self, rf):
+        handler = ImageUploadHandler(rf.post("/"), max_size=100 * 1024)
+        handler.new_file("image", "dog.png", "image/png", None)
+        png = make_upload(10, 10).read()
+        handler.receive_data_chunk(png, 0)
+
+        with pytest.raises(ValidationError):
+            handler.receive_data_chunk(b"0" * 100 * 1024, len(png))
+
+    def test_rejects_files_that_are_not_images(self, media_root, product):
+        upload = SimpleUploadedFile("dog.png", b"<?php echo 1; ?>", "image/png")
+
+        response = self.post(product, upload)
+
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+        assert "valid image" in response.data["image"][0]
+
+    def test_rejects_images_over_the_dimensions(self, media_root, product):
+        # a solid png compresses well, the file is small but the image is not
+        response = self.post(product, make_upload(MAX_IMAGE_DIMENSION + 1, 10))
+
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+        assert "pixels" in response.data["image"][0]
@@ -0,0 +1,412 @@
+import csv
+import json
+import time
+from decimal import Decimal
+from django.contrib.auth.models import User
+from django.utils.http import http_date
+from store.inventory import sync_product_inventory
+from store.models import Collection, Product, ProductImage, ProductStock
+from store.serializers import ProductModelSerializer, ProductValuesSerializer
+from rest_framework.renderers import JSONRenderer
+from rest_framework.request import Request
+from rest_framework.test import APIClient, APIRequestFactory
+from rest_framework import status
+import pytest
+
+
+def create_product(collection, **kwargs):
+    fields = {
+        "title": "a",
+        "slug": "a",
+        "unit_price": Decimal("10.00"),
+        "inventory": 10,
+        "collection": collection,
+    }
+    fields.update(kwargs)
+    return Product.objects.create(**fields)
+
+
+@pytest.mark.django_db
+class TestProductCache:
+    def test_second_list_is_served_from_cache(self, django_assert_num_queries):
+        collection = Collection.objects.create(title="a")
+        create_product(collection)
+        api_client = APIClient()
+
+        first = api_client.get("/store/products/")
+        with django_assert_num_queries(0):
+            second = api_client.get("/store/products/")
+
+        assert first.status_code == status.HTTP_200_OK
+        assert second.data == first.data
+
+    def test_product_change_invalidates_cache(self, django_capture_on_commit_callbacks):
+        collection = Collection.objects.create(title="a")
+        product = create_product(collection)
+        api_client = APIClient()
+        api_client.get(f"/store/products/{product.pk}/")
+
+        with django_capture_on_commit_callbacks(execute=True):
+            product.title = "b"
+            product.save()
+        response = api_client.get(f"/store/products/{product.pk}/")
+
+        assert response.data["title"] == "b"
+
+
+@pytest.mark.django_db
+class TestProductCursorPagination:
+    def test_pages_through_every_product_once(self):
+        collection = Collection.objects.create(title="a")
+        # same price for every product so the order relies on the id tiebreaker
+        products = [create_product(collection, title=f"p{i}") for i in range(25)]
+        api_client = APIClient()
+
+        seen = []
+        url = "/store/products/?pagination=cursor&ordering=unit_price"
+        while url is not None:
+            response = api_client.get(url)
+            seen += [product["pk"] for product in response.data["results"]]
+            url = response.data["next"]
+
+        assert seen == [product.pk for product in products]
+
+    def test_count_is_only_returned_when_asked_for(self):
+        collection = Collection.objects.create(title="a")
+        create_product(collection)
+        api_client = APIClient()
+
+        without_count = api_client.get("/store/products/?pagination=cursor")
+        with_count = api_client.get("/store/products/?pagination=cursor&count=true")
+
+        assert "count" not in without_count.data
+        assert with_count.data["count"] == 1
+
+
+@pytest.mark.django_db
+class TestProductSearch:
+    def test_search_ranks_title_matches_first(self):
+        coffee = Collection.objects.create(title="Coffee")
+        bakery = Collection.objects.create(title="Bakery")
+        in_description = create_product(
+            bakery, title="Muffin", description="goes well with coffee"
+        )
+        in_title = create_product(bakery, title="Coffee cake")
+        in_collection = create_product(coffee, title="Beans")
+        create_product(bakery, title="Bread")
+        api_client = APIClient()
+
+        response = api_client.get("/store/products/?search=coff")
+
+        assert [product["pk"] for product in response.data["results"]] == [
+            in_title.pk,
+            in_collection.pk,
+            in_description.pk,
+        ]
+
+    def test_renaming_a_collection_reindexes_its_products(self):
+        collection = Collection.objects.create(title="Coffee")
+        product = create_product(collection, title="Beans")
+        collection.title = "Tea"
+        collection.save()
+        api_client = APIClient()
+
+        response = api_client.get("/store/products/?search=tea")
+
+        assert [product["pk"] for product in response.data["results"]] == [product.pk]
+
+
+@pytest.mark.django_db
+class TestProductValuesSerializer:
+    def test_renders_the_same_json_as_the_model_serializer(self):
+        collection = Collection.objects.create(title="a")
+        create_product(
+            collection, title="x", description="y", unit_price=Decimal("4.35")
+        )
+        product = create_product(collection, title="z", unit_price=Decimal("999.99"))
+        ProductImage.objects.create(
+            product=product,
+            image="store/images/dog.jpg",
+            sizes={"thumbnail": {"webp": "store/images/dog_thumbnail.webp"}},
+        )
+        ProductImage.objects.create(product=product, image="store/images/cat.jpg")
+        request = Request(APIRequestFactory().get("/store/products/"))
+        queryset = Product.objects.select_related("collection").prefetch_related(
+            "productimage_set"
+        )
+        context = {"request": request}
+
+        expected = ProductModelSerializer(queryset, many=True, context=context).data
+        serializer = ProductValuesSerializer(context=context)
+        actual = serializer.to_representation(serializer.get_queryset(queryset))
+
+        assert JSONRenderer().render(actual) == JSONRenderer().render(expected)
+
+
+@pytest.mark.django_db
+class TestProductSparseFields:
+    def test_only_returns_the_fields_asked_for(self, django_assert_num_queries):
+        collection = Collection.objects.create(title="a")
+        product = create_product(collection)
+        ProductImage.objects.create(product=product, image="store/images/dog.jpg")
+        api_client = APIClient()
+
+        # the etag query and the product, no image prefetch
+        with django_assert_num_queries(2):
+            response = api_client.get(
+                f"/store/products/{product.pk}/?fields=pk,title,unit_price"
+            )
+
+        assert set(response.data) == {"pk", "title", "unit_price"}
+
+    def test_expand_adds_expandable_fields(self):
+        collection = Collection.objects.create(title="a")
+        create_product(collection)
+        api_client = APIClient()
+
+        response = api_client.get("/store/products/?expand=productimage_set")
+
+        product = response.data["results"][0]
+        assert "productimage_set" in product
+        assert "collection_object" not in product
+        assert "collection_link" not in product
+        assert "title" in product
+
+    def test_nested_collection_has_no_product_count(self):
+        collection = Collection.objects.create(title="a")
+        product = create_product(collection)
+        api_client = APIClient()
+
+        listed = api_client.get("/store/products/").data["results"][0]
+        detail = api_client.get(f"/store/products/{product.pk}/").data
+
+        expected = {"pk": collection.pk, "title": "a"}
+        assert listed["collection_object"] == expected
+        assert detail["collection_object"] == expected
+
+
+@pytest.mark.django_db
+class TestProductConditionalGet:
+    def test_unchanged_product_returns_304(self, django_assert_num_queries):
+        collection = Collection.objects.create(title="a")
+        product = create_product(collection)
+        api_client = APIClient()
+        response = api_client.get(f"/store/products/{product.pk}/")
+
+        with django_assert_num_queries(1):
+            not_modified = api_client.get(
+                f"/store/products/{product.pk}/",
+                HTTP_IF_NONE_MATCH=response["ETag"],
+            )
+
+        assert not_modified.status_code == status.HTTP_304_NOT_MODIFIED
+        assert not_modified["ETag"] == response["ETag"]
+        assert "Last-Modified" not in response
+
+    def test_new_image_changes_the_etag(self):
+        collection = Collection.objects.create(title="a")
+        product = create_product(collection)
+        api_client = APIClient()
+        response = api_client.get(f"/store/products/{product.pk}/")
+
+        ProductImage.objects.create(product=product, image="store/images/dog.jpg")
+        modified = api_client.get(
+            f"/store/products/{product.pk}/", HTTP_IF_NONE_MATCH=response["ETag"]
+        )
+
+        assert modified.status_code == status.HTTP_200_OK
+        assert modified["ETag"] != response["ETag"]
+
+    # last_update does not change with the collection, so there is no Last-Modified to go stale
+    def test_renamed_collection_is_not_answered_with_304(
+        self, django_capture_on_commit_callbacks
+    ):
+        collection = Collection.objects.create(title="a")
+        product = create_product(collection)
+        api_client = APIClient()
+        api_client.get(f"/store/products/{product.pk}/")
+
+        with django_capture_on_commit_callbacks(execute=True):
+            collection.title = "b"
+            collection.save()
+        modified = api_client.get(
+            f"/store/products/{product.pk}/",
+            HTTP_IF_MODIFIED_SINCE=http_date(time.time() + 60),
+        )
+
+        assert modified.status_code == status.HTTP_200_OK
+        assert modified.data["collection_object"]["title"] == "b"
+
+    def test_synced_inventory_changes_the_etag(
+        self, django_capture_on_commit_callbacks
+    ):
+        product = create_product(Collection.objects.create(title="a"))
+        api_client = APIClient()
+        response = api_client.get(f"/store/products/{product.pk}/")
+
+        ProductStock.objects.filter(pk=product.pk).update(available=3, changed=True)
+        with django_capture_on_commit_callbacks(execute=True):
+            sync_product_inventory()
+        modified = api_client.get(
+            f"/store/products/{product.pk}/", HTTP_IF_NONE_MATCH=response["ETag"]
+        )
+
+        assert modified.status_code == status.HTTP_200_OK
+        assert modified.data["inventory"] == 3
+
+
+@pytest.mark.django_db
+class TestProductExport:
+    def test_if_user_is_not_admin_returns_403(self):
+        api_client = APIClient()
+        api_client.force_authenticate(user=User())
+
+        response = api_client.get("/store/products/export/")
+
+        assert response.status_code == status.HTTP_403_FORBIDDEN
+
+    def test_streams_filtered_products_as_ndjson(self):
+        collection = Collection.objects.create(title="a")
+        other = Collection.objects.create(title="b")
+        product = create_product(collection)
+        create_product(other)
+        api_client = APIClient()
+        api_client.force_authenticate(user=User(is_staff=True))
+
+        response = api_client.get(
+            f"/store/products/export/?collection_id={collection.pk}"
+        )
+        lines = b"".join(response.streaming_content).decode().splitlines()
+
+        assert [json.loads(line)["pk"] for line in lines] == [product.pk]
+
+    def test_streams_csv(self):
+        collection = Collection.objects.create(title="a")
+        create_product(collection, title="x")
+        api_client = APIClient()
+        api_client.force_authenticate(user=User(is_staff=True))
+
+        response = api_client.get(
+            "/store/products/export/?export_format=csv&fields=pk,title"
+        )
+        rows = list(csv.reader(b"".join(response.streaming_content).decode().splitlines()))
+
+        assert rows[0] == ["pk", "title"]
+        assert rows[1][1] == "x"
+
+
+@pytest.mark.django_db
+class TestProductBulkUpsert:
+    def test_updates_creates_and_reports_bad_rows(
+        self, django_capture_on_commit_callbacks
+    ):
+        collection = Collection.objects.create(title="a")
+        by_pk = create_product(collection, slug="by-pk")
+        by_slug = create_product(collection, slug="by-slug")
+        api_client = APIClient()
+        api_client.force_authenticate(user=User(is_staff=True))
+
+        with django_capture_on_commit_callbacks(execute=True):
+            response = api_client.post(
+                "/store/products/bulk/",
+                [
+                    {"pk": by_pk.pk, "inventory": 1},
+                    {"slug": "by-slug", "inventory": 2},
+                    {
+                        "slug": "new",
+                        "title": "new",
+                        "unit_price": "5.00",
+                        "inventory": 3,
+                        "collection_id": collection.pk,
+                    },
+                    {"slug": "new-bad", "title": "x", "collection_id": 999},
+                    {"pk": 999, "inventory": 1},
+                ],
+                format="json",
+            )
+
+        by_pk.refresh_from_db()
+        by_slug.refresh_from_db()
+        collection.refresh_from_db()
+        assert response.status_code == status.HTTP_200_OK
+        assert response.data["updated"] == [by_pk.pk, by_slug.pk]
+        assert len(response.data["created"]) == 1
+        assert [error["index"] for error in response.data["errors"]] == [3, 4]
+        assert (by_pk.inventory, by_slug.inventory) == (1, 2)
+        assert collection.product_count == 3
+
+    def test_inventory_updates_are_added_to_the_stock(self):
+        product = create_product(Collection.objects.create(title="a"))
+        # 6 were sold since the inventory was last synced
+        ProductStock.objects.filter(pk=product.pk).update(available=4)
+        api_client = APIClient()
+        api_client.force_authenticate(user=User(is_staff=True))
+
+        response = api_client.post(
+            "/store/products/bulk/",
+            [{"pk": product.pk, "inventory": 12}],
+            format="json",
+        )
+
+        assert response.status_code == status.HTTP_200_OK
+        assert ProductStock.objects.get(pk=product.pk).available == 6
+
+
+@pytest.mark.django_db
+class TestProductFacets:
+    def test_counts_collections_and_price_buckets_in_one_query(
+        self, django_assert_num_queries
+    ):
+        coffee = Collection.objects.create(title="Coffee")
+        tea = Collection.objects.create(title="Tea")
+        create_product(coffee, unit_price=Decimal("5.00"))
+        create_product(coffee, unit_price=Decimal("15.00"))
+        create_product(tea, unit_price=Decimal("7.50"))
+        create_product(tea, unit_price=Decimal("50.00"))
+        api_client = APIClient()
+
+        with django_assert_num_queries(1):
+            response = api_client.get("/store/products/facets/?unit_price__lt=20")
+
+        assert response.data["count"] == 3
+        assert [
+            (collection["title"], collection["count"])
+            for collection in response.data["collections"]
+        ] == [("Coffee", 2), ("Tea", 1)]
+        assert [
+            (bucket["min"], bucket["count"]) for bucket in response.data["unit_price"]
+        ] == [(0, 2), (10, 1)]
+
+    def test_applies_search(self):
+        collection = Collection.objects.create(title="a")
+        create_product(collection, title="Coffee cake")
+        create_product(collection, title="Bread")
+        api_client = APIClient()
+
+        response = api_client.get("/store/products/facets/?search=coffee")
+
+        assert response.data["count"] == 1
+
+    @pytest.mark.parametrize(
+        "price_bucket", ["1e400", "0.0000001", "0", "-5", "nan", "inf", "x"]
+    )
+    def test_bad_price_bucket_returns_400(self, price_bucket):
+        create_product(Collection.objects.create(title="a"))
+        api_client = APIClient()
+
+        response = api_client.get(
+            f"/store/products/facets/?price_bucket={price_bucket}"
+        )
+
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+
+    def test_price_bucket_of_a_cent(self):
+        create_product(Collection.objects.create(title="a"), unit_price=Decimal("5.25"))
+        api_client = APIClient()
+
+        response = api_client.get("/store/products/facets/?price_bucket=0.01")
+
+        assert response.status_code == status.HTTP_200_OK
+        assert response.data["unit_price"] == [
+            {"min": Decimal("5.25"), "max": Decimal("5.26"), "count": 1}
+        ]
@@ -0,0 +1,55 @@
+from io import StringIO
+from django.core.management import call_command
+from django.db.models import F
+from store.models import Collection, Customer, Order, OrderItem, Product
+import pytest
+
+
+@pytest.mark.django_db
+class TestSeedDb:
+    def seed(self, **kwargs):
+        options = {
+            "collections": 2,
+            "products": 20,
+            "customers": 5,
+            "carts": 5,
+            "orders": 10,
+            "reviews": 10,
+            "tags": 2,
+            "tagged_items": 10,
+            "likes": 10,
+            "batch_size": 7,
+        }
+        options.update(kwargs)
+        call_command("seed_db", stdout=StringIO(), **options)
+
+    def test_creates_the_rows_asked_for(self):
+        self.seed()
+
+        assert Product.objects.count() == 20
+        assert Customer.objects.count() == 5
+        assert Order.objects.count() == 10
+        assert sum(Collection.objects.values_list("product_count", flat=True)) == 20
+        # checkouts take from the stock rows, each starts at the inventory of its product
+        assert not Product.objects.filter(stock__isnull=True).exists()
+        assert not Product.objects.exclude(stock__available=F("inventory")).exists()
+        # order items copy the price of their product
+        item = OrderItem.objects.select_related("product").first()
+        assert item.unit_price == item.product.unit_price
+
+    def test_same_seed_creates_the_same_rows(self):
+        products_only = {
+            "customers": 0,
+            "carts": 0,
+            "orders": 0,
+            "reviews": 0,
+            "tagged_items": 0,
+            "likes": 0,
+        }
+        self.seed(seed=3, **products_only)
+        first = list(Product.objects.order_by("pk").values_list("title", "unit_price"))
+        Product.objects.all().delete()
+        self.seed(seed=3, **products_only)
+        second = list(Product.objects.order_by("pk").values_list("title", "unit_price"))
+
+        assert first == second
@@ -0,0 +1,87 @@
+from io import BytesIO
+from django.core.files.uploadhandler import FileUploadHandler
+from PIL import Image
+from rest_framework.exceptions import ValidationError
+from store.validators import MAX_IMAGE_DIMENSION, MAX_IMAGE_SIZE_KB
+
+# room for the multipart boundaries, headers and the other form fields of an upload
+MULTIPART_OVERHEAD = 64 * 1024
+
+# first bytes of the formats we accept
+IMAGE_SIGNATURES = [
+    b"\xff\xd8\xff",  # jpeg
+    b"\x89PNG\r\n\x1a\n",
+    b"GIF87a",
+    b"GIF89a",
+]
+
+
+def is_image_signature(data) -> bool:
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return True
+    return any(data.startswith(signature) for signature in IMAGE_SIGNATURES)
+
+
+# Checks image uploads while they arrive instead of after the whole body has been read
+# (validate_file_size only runs once the file is in memory or in a temporary file):
+# - a request whose Content-Length is over the limit is rejected before its body is read
+# - the bytes of each file are counted as the chunks arrive, and it is rejected once it is too big
+# - the first chunk must start like an image, and once the header is in its dimensions are checked
+# Rejecting raises a ValidationError, so the client gets a 400 as with the validators.
+# Runs before the default handlers, which store what it passes on. See ProductImageViewSet.
+class ImageUploadHandler(FileUploadHandler):
+    chunk_size = 64 * 1024
+
+    def __init__(self, request=None, max_size=None, max_dimension=None):
+        super().__init__(request)
+        self.max_size = max_size or MAX_IMAGE_SIZE_KB * 1024
+        self.max_dimension = max_dimension or MAX_IMAGE_DIMENSION
+
+    def reject(self, message):
+        raise ValidationError({getattr(self, "field_name", None) or "image": [message]})
+
+    def handle_raw_input(
+        self, input_data, META, content_length, boundary, encoding=None
+    ):
+        if content_length > self.max_size + MULTIPART_OVERHEAD:
+            self.reject(f"Files cannot be larger than {self.max_size // 1024}KB!")
+
+    def new_file(self, field_name, *args, **kwargs):
+        super().new_file(field_name, *args, **kwargs)
+        self.size = 0
+        # the bytes read so far, until they hold the whole header. Most headers fit in the first
+        # chunk, a jpeg with a lot of exif data can take a few more.
+        self.header = b""
+
+    def receive_data_chunk(self, raw_data, start):
+        self.size += len(raw_data)
+        if self.size > self.max_size:
+            self.reject(f"Files cannot be larger than {self.max_size // 1024}KB!")
+        if start == 0 and not is_image_signature(raw_data):
+            self.reject("Upload a valid image (jpeg, png, gif or webp).")
+        if self.header is not None:
+            self.check_dimensions(raw_data)
+        return raw_data
+
+    def check_dimensions(self, raw_data):
+        self.header += raw_data
+        limit = self.max_dimension
+        too_large = f"Images cannot be larger than {limit}x{limit} pixels!"
+        try:
+            # only parses the header, the pixels are not decoded
+            with Image.open(BytesIO(self.header)) as image:
+                width, height = image.size
+        except Image.DecompressionBombError:
+            self.reject(too_large)
+        except (OSError, SyntaxError):
+            # the header is cut off, wait for the next chunk
+            return
+        self.header = None
+        if max(width, height) > self.max_dimension:
+            self.reject(too_large)
+
+    def file_complete(self, file_size):
+        if self.header is not None:
+            self.reject("Upload a valid image. The file is corrupted.")
+        # the following handlers build the file
+        return None
@@ -1,8 +1,12 @@
 from django.core.exceptions import ValidationError
 
+MAX_IMAGE_SIZE_KB = 500
+# longest side in pixels, checked while images are uploaded (see uploads.py)
+MAX_IMAGE_DIMENSION = 4000
+
 
 def validate_file_size(file):
-    max_size_kb = 500
+    max_size_kb = MAX_IMAGE_SIZE_KB
 
     if file.size > max_size_kb * 1024:
         raise ValidationError(f"Files cannot be larger than {max_size_kb}KB!")
@@ -1,6 +1,10 @@
+from decimal import Decimal
+from uuid import UUID
+from django.conf import settings
+from django.core.cache import cache
 from django.shortcuts import render, get_object_or_404
-from django.http import HttpResponse
-from django.db.models.aggregates import Count
+from django.http import Http404, HttpResponse, StreamingHttpResponse
+from django.db.models.aggregates import Count, Max
 from django_filters.rest_framework import DjangoFilterBackend  # add generic filtering
 from rest_framework.filters import (
     SearchFilter,
@@ -17,7 +21,7 @@ from rest_framework.mixins import (
 from rest_framework.viewsets import ModelViewSet, GenericViewSet
 from rest_framework.generics import ListCreateAPIView, RetrieveUpdateDestroyAPIView
 from rest_framework.response import Response
-from rest_framework import status
+from rest_framework import serializers, status
 from rest_framework.decorators import action
 from rest_framework.permissions import (
     IsAuthenticated,
@@ -34,7 +38,16 @@ from .permissions import (
     ViewCustomerHistoryPermission,
 )
 
-from .pagination import DefaultPagePagination
+from .cache import (
+    CatalogCacheMixin,
+    build_catalog_cache_key,
+    get_catalog_cache_stats,
+)
+from .carts import annotate_cart_items, get_cart_store
+from .conditional import ConditionalGetMixin, make_etag
+from .export import iter_csv, iter_ndjson, iter_products
+from .facets import get_product_facets
+from .pagination import DefaultPagePagination, ProductCursorPagination
 from .models import (
     Cart,
     CartItem,
@@ -48,6 +61,8 @@ from .models import (
 )
 from .serializers import (
     AddCartItemModelSerializer,
+    BatchCartItemsSerializer,
+    BulkProductModelSerializer,
     CartItemModelSerializer,
     CartModelSerializer,
     CollectionModelSerializer,
@@ -56,11 +71,15 @@ from .serializers import (
     OrderModelSerializer,
     ProductImageModelSerializer,
     ProductModelSerializer,
+    ProductValuesSerializer,
     ReviewModelSerializer,
     UpdateCartItemModelSerializer,
     UpdateOrderModelSerializer,
+    get_sparse_fields,
 )
 from .filters import ProductFilterSet
+from .search import ProductSearchFilter
+from .uploads import ImageUploadHandler
 
 
 # Create your views here.
@@ -68,7 +87,9 @@ from .filters import ProductFilterSet
 
 ### Genercic ViewSets
 # Note that for scenarios where our ViewSet should only List or retrive a single object we have "ReadOnlyModelViewSet"
-class ProductViewSet(ModelViewSet):
+# CatalogCacheMixin serves list and retrieve from a versioned cache, see cache.py
+# ConditionalGetMixin answers 304 when the client already has the current version, see conditional.py
+class ProductViewSet(ConditionalGetMixin, CatalogCacheMixin, ModelViewSet):
     # add generic filtering, no need to manually set up filtering for each param we want to filter by
     ## for more info https://django-filter.readthedocs.io/en/stable
     ## We will do a more complex filter on unit_price where we want to filter by a range
@@ -78,8 +99,10 @@ class ProductViewSet(ModelViewSet):
 
     # add searching by adding SearchFilter to filter_backends, and set up search_fields=[] to the fields we want to search by
     # add ordering by adding OrderingFilter to filter_backends, and set up ordering_fields=[] to the fields we want to search by
+    # ProductSearchFilter replaces SearchFilter with a ranked full text search (see search.py), search_fields
+    # are still used by it on databases that have no full text index
 
-    filter_backends = [DjangoFilterBackend, SearchFilter, OrderingFilter]
+    filter_backends = [DjangoFilterBackend, ProductSearchFilter, OrderingFilter]
     filterset_class = ProductFilterSet
     # filterset_fields = ["collection_id"]
     search_fields = ["title", "description", "collection__title"]
@@ -92,12 +115,53 @@ class ProductViewSet(ModelViewSet):
     ## 1. create pagination.py in store app and set up Pagination classes as needed that you can cusomize. They will be derived from PageNumberPagination
     pagination_class = DefaultPagePagination
 
+    # clients can opt in to cursor pagination with pagination=cursor (see pagination.py).
+    # page pagination stays the default so existing clients keep working
+    @property
+    def paginator(self):
+        if not hasattr(self, "_paginator"):
+            if self.request.query_params.get("pagination") == "cursor":
+                self._paginator = ProductCursorPagination()
+            else:
+                self._paginator = self.pagination_class()
+        return self._paginator
+
+    # model columns behind each field of ProductModelSerializer, so ?fields= only loads what it renders
+    sparse_field_columns = {
+        "pk": ["pk"],
+        "title": ["title"],
+        "description": ["description"],
+        "slug": ["slug"],
+        "inventory": ["inventory"],
+        "unit_price": ["unit_price"],
+        "price_with_tax": ["unit_price"],
+        "collection": ["collection"],
+        "productimage_set": [],
+        "collection_str": ["collection", "collection__title"],
+        "collection_object": ["collection", "collection__title"],
+        "collection_link": ["collection"],
+    }
+
     def get_queryset(self):
-        return (
-            Product.objects.select_related("collection")
-            .prefetch_related("productimage_set")
-            .all()
-        )
+        # with ?fields=/?expand= (see serializers.get_sparse_fields) we only join, prefetch and load
+        # the columns of the fields that are rendered
+        fields = get_sparse_fields(self.request, ProductModelSerializer)
+        if fields is None:
+            return (
+                Product.objects.select_related("collection")
+                .prefetch_related("productimage_set")
+                .all()
+            )
+
+        queryset = Product.objects.all()
+        if fields & {"collection_str", "collection_object"}:
+            queryset = queryset.select_related("collection")
+        if "productimage_set" in fields:
+            queryset = queryset.prefetch_related("productimage_set")
+        columns = {"pk"}
+        for field in fields:
+            columns.update(self.sparse_field_columns[field])
+        return queryset.only(*columns)
 
         ## !!!NOTE!!! Old way of maunally setting up filtering we now use generic filtering above
         # query_set = Product.objects.select_related("collection").all()
@@ -116,6 +180,54 @@ class ProductViewSet(ModelViewSet):
     def get_serializer_context(self):
         return {"request": self.request}
 
+    # listing uses the read only fast path (see ProductValuesSerializer) and the versioned cache
+    def list(self, request, *args, **kwargs):
+        return self.conditional_response(
+            self.get_list_validators, self.cached_list, request, *args, **kwargs
+        )
+
+    def cached_list(self, request, *args, **kwargs):
+        return self.cached_response("list", self.list_values, request, *args, **kwargs)
+
+    # every catalog write bumps the catalog version, so it tags the listing without a query.
+    # lists get no Last-Modified, deleting a product would not make it any newer
+    def get_list_validators(self, request, *args, **kwargs):
+        return make_etag(request, build_catalog_cache_key(request, "products:list")), None
+
+    # one query for everything a product renders: its row, its collection and its images.
+    # No Last-Modified: renaming the collection or deleting an image changes the product without
+    # changing its last_update, a client revalidating with If-Modified-Since alone would get a 304
+    def get_detail_validators(self, request, *args, **kwargs):
+        product = (
+            Product.objects.filter(pk=kwargs["pk"])
+            .annotate(
+                image_max=Max("productimage__pk"), image_count=Count("productimage")
+            )
+            .values(
+                "last_update",
+                # copied from the stock without touching last_update, see sync_product_inventory
+                "inventory",
+                "collection__title",
+                "image_max",
+                "image_count",
+            )
+            .first()
+        )
+        if product is None:
+            return None, None
+        return make_etag(request, *product.values()), None
+
+    def list_values(self, request, *args, **kwargs):
+        serializer = ProductValuesSerializer(
+            context=self.get_serializer_context(),
+            fields=get_sparse_fields(request, ProductModelSerializer),
+        )
+        queryset = serializer.get_queryset(self.filter_queryset(self.get_queryset()))
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            return self.get_paginated_response(serializer.to_representation(page))
+        return Response(serializer.to_representation(queryset))
+
     # we overried the delecte function as we needed to do custom logic not available in the default delete
     # here we are checking that no orders are attached to ths product before deleting
     def destroy(self, request, *args, **kwargs):
@@ -129,8 +241,133 @@ class ProductViewSet(ModelViewSet):
 
         return super().destroy(request, *args, **kwargs)
 
+    # staff only export of the whole catalog, streamed as ndjson (default) or csv with
+    # ?export_format=csv. The same filters, search and ordering as the list apply, see export.py
+    # !!!NOTE!!! not "format", DRF uses that param to pick a renderer
+    export_chunk_size = 2000
+
+    @action(
+        detail=False,
+        methods=["GET"],
+        permission_classes=[IsAdminUser],
+    )
+    def export(self, request):
+        export_format = request.query_params.get("export_format", "ndjson")
+        if export_format not in ["ndjson", "csv"]:
+            return Response(
+                {"error": "export_format must be ndjson or csv"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        serializer = ProductValuesSerializer(
+            context=self.get_serializer_context(),
+            fields=get_sparse_fields(request, ProductModelSerializer),
+        )
+        queryset = serializer.get_queryset(self.filter_queryset(self.get_queryset()))
+        products = iter_products(serializer, queryset, self.export_chunk_size)
+        if export_format == "csv":
+            response = StreamingHttpResponse(
+                iter_csv(products, serializer.field_names), content_type="text/csv"
+            )
+        else:
+            response = StreamingHttpResponse(
+                iter_ndjson(products), content_type="application/x-ndjson"
+            )
+        response["Content-Disposition"] = (
+            f'attachment; filename="products.{export_format}"'
+        )
+        return response
+
+    # bulk upsert for inventory syncs. Takes a list of products keyed by pk or slug, existing ones
+    # are updated with the fields sent (eg. just inventory) and new ones are created. Rows that do
+    # not validate are reported by index and the rest of the batch is still applied.
+    # see BulkProductListSerializer
+    bulk_max_batch_size = 10_000
+
+    @action(
+        detail=False,
+        methods=["POST"],
+        permission_classes=[IsAdminUser],
+    )
+    def bulk(self, request):
+        serializer = BulkProductModelSerializer(
+            data=request.data,
+            many=True,
+            partial=True,
+            max_length=self.bulk_max_batch_size,
+        )
+        if serializer.is_valid():
+            return Response(serializer.save())
+        else:
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+    # per collection counts and a unit_price histogram of the products matching the same filters
+    # and search as the list, from one aggregate query (see facets.py). ?price_bucket=xx sets the
+    # width of the histogram buckets. Cached per filter set until the catalog changes
+    default_price_bucket = Decimal(10)
+    # a width the unit prices could have (see Product.unit_price): the bounds of the buckets render
+    # as numbers, and a bucket holds at least one cent of prices
+    price_bucket_field = serializers.DecimalField(
+        max_digits=6, decimal_places=2, min_value=Decimal("0.01")
+    )
+    # params that do not change the set of products the facets are computed over
+    facets_non_filter_query_params = [
+        "page",
+        "cursor",
+        "pagination",
+        "ordering",
+        "count",
+        "format",
+        "fields",
+        "expand",
+    ]
+
+    @action(detail=False, methods=["GET"])
+    def facets(self, request):
+        try:
+            bucket_size = self.price_bucket_field.run_validation(
+                request.query_params.get("price_bucket", self.default_price_bucket)
+            )
+        except serializers.ValidationError:
+            return Response(
+                {
+                    "error": "price_bucket must be a number from 0.01 to 9999.99 with at most 2 "
+                    "decimal places"
+                },
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        cache_key = build_catalog_cache_key(
+            request, "products:facets", exclude=self.facets_non_filter_query_params
+        )
+        facets = cache.get(cache_key)
+        if facets is None:
+            queryset = self.filter_queryset(Product.objects.all())
+            facets = get_product_facets(queryset, bucket_size)
+            cache.set(cache_key, facets, timeout=settings.CATALOG_CACHE_TIMEOUT)
+        return Response(facets)
+
+    # hit/miss counters of the catalog cache. Only admins need to see these
+    @action(
+        detail=False,
+        methods=["GET"],
+        url_path="cache-stats",
+        permission_classes=[IsAdminUser],
+    )
+    def cache_stats(self, request):
+        return Response(get_catalog_cache_stats())
+
 
 class ProductImageViewSet(ModelViewSet):
+    # check uploads as they arrive (see uploads.py). !!!NOTE!!! this has to happen before anything
+    # reads the body, middleware that reads request.body or request.POST bypasses it
+    def initialize_request(self, request, *args, **kwargs):
+        request.upload_handlers = [
+            ImageUploadHandler(request),
+            *request.upload_handlers,
+        ]
+        return super().initialize_request(request, *args, **kwargs)
+
     def get_queryset(self):
         return ProductImage.objects.filter(product__pk=self.kwargs["product_pk"])
 
@@ -141,13 +378,27 @@ class ProductImageViewSet(ModelViewSet):
         return {"request": self.request, "product_pk": self.kwargs["product_pk"]}
 
 
-class CollectionViewSet(ModelViewSet):
+class CollectionViewSet(ConditionalGetMixin, ModelViewSet):
     permission_classes = [
         IsAdminOrReadOnly,
     ]
 
+    # collection writes and product writes (which change product_count) bump the catalog version
+    def get_list_validators(self, request, *args, **kwargs):
+        return make_etag(request, build_catalog_cache_key(request, "collections:list")), None
+
+    def get_detail_validators(self, request, *args, **kwargs):
+        collection = (
+            Collection.objects.filter(pk=kwargs["pk"])
+            .values_list("title", "product_count")
+            .first()
+        )
+        if collection is None:
+            return None, None
+        return make_etag(request, *collection), None
+
     def get_queryset(self):
-        return Collection.objects.annotate(product_count=Count("product"))
+        return Collection.objects.all()
 
     def get_serializer_class(self):
         return CollectionModelSerializer
@@ -167,7 +418,24 @@ class CollectionViewSet(ModelViewSet):
         return super().destroy(request, *args, **kwargs)
 
 
-class ReviewViewSet(ModelViewSet):
+class ReviewViewSet(ConditionalGetMixin, ModelViewSet):
+    # the newest last_update and the number of reviews change on every add, edit and delete
+    def get_list_validators(self, request, *args, **kwargs):
+        reviews = Review.objects.filter(product__pk=kwargs["product_pk"]).aggregate(
+            last_update=Max("last_update"), count=Count("pk")
+        )
+        return make_etag(request, reviews["last_update"], reviews["count"]), None
+
+    def get_detail_validators(self, request, *args, **kwargs):
+        last_update = (
+            Review.objects.filter(product__pk=kwargs["product_pk"], pk=kwargs["pk"])
+            .values_list("last_update", flat=True)
+            .first()
+        )
+        if last_update is None:
+            return None, None
+        return make_etag(request, last_update), last_update
+
     def get_queryset(self):
         # recall that self.kwargs contains the route params
         return Review.objects.select_related("product").filter(
@@ -183,17 +451,41 @@ class ReviewViewSet(ModelViewSet):
         return {"request": self.request, "product_pk": self.kwargs["product_pk"]}
 
 
-# !!!NOTE!!! We do not need update or list operations, only create, retrieve and delete. So we need to customized this ViewSet
-# we only inherit from the classes we need that ModelViewSet itself inherits from
-class CartViewSet(
-    CreateModelMixin, RetrieveModelMixin, DestroyModelMixin, GenericViewSet
-):
-    def get_queryset(self):
-        # "cartitem_set". What this does is preload each cartitem using "cartitem_set",
-        # and for each item preload its related product with "__product". This is new knowledge
-        return Cart.objects.prefetch_related("cartitem_set__product").annotate(
-            item_count=Count("cartitem")
+def parse_cart_id(value):
+    try:
+        return UUID(str(value))
+    except ValueError:
+        raise Http404("No Cart matches the given query.")
+
+
+def parse_item_id(value):
+    try:
+        return int(value)
+    except ValueError:
+        raise Http404("No CartItem matches the given query.")
+
+
+# !!!NOTE!!! We do not need update or list operations, only create, retrieve and delete.
+# The cart and its items are kept by the cart store (see carts.py), these views only talk to it
+class CartViewSet(GenericViewSet):
+    def create(self, request, *args, **kwargs):
+        cart = get_cart_store().create_cart()
+        serializer = self.get_serializer(cart)
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
+
+    def retrieve(self, request, pk, *args, **kwargs):
+        # with ?fields=/?expand= the store skips the items and the count when they are not rendered
+        cart = get_cart_store().get_cart(
+            parse_cart_id(pk), fields=get_sparse_fields(request, CartModelSerializer)
         )
+        if cart is None:
+            raise Http404("No Cart matches the given query.")
+        return Response(self.get_serializer(cart).data)
+
+    def destroy(self, request, pk, *args, **kwargs):
+        if not get_cart_store().delete_cart(parse_cart_id(pk)):
+            raise Http404("No Cart matches the given query.")
+        return Response(status=status.HTTP_204_NO_CONTENT)
 
     def get_serializer_class(self):
         return CartModelSerializer
@@ -202,20 +494,70 @@ class CartViewSet(
         return {"request": self.request}
 
 
-class CartItemViewSet(ModelViewSet):
+class CartItemViewSet(GenericViewSet):
     # constrain the methods that this ViewSet will service
     #!!!NOTE!!! the array value of methods is CASE-SENSITIVE. MUST BE LOWERCASE
     http_method_names = ["get", "post", "patch", "delete"]
 
+    def list(self, request, cart_pk, *args, **kwargs):
+        items = get_cart_store().get_items(parse_cart_id(cart_pk))
+        return Response(self.get_serializer(items, many=True).data)
+
+    def retrieve(self, request, cart_pk, pk, *args, **kwargs):
+        return Response(self.get_serializer(self.get_item(cart_pk, pk)).data)
+
+    def create(self, request, cart_pk, *args, **kwargs):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        serializer.save()
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
+
+    def partial_update(self, request, cart_pk, pk, *args, **kwargs):
+        serializer = self.get_serializer(data=request.data, partial=True)
+        serializer.is_valid(raise_exception=True)
+        quantity = serializer.validated_data.get("quantity")
+        if quantity is None:
+            item = self.get_item(cart_pk, pk)
+        else:
+            item = get_cart_store().update_item(
+                parse_cart_id(cart_pk), parse_item_id(pk), quantity
+            )
+            if item is None:
+                raise Http404("No CartItem matches the given query.")
+        return Response(self.get_serializer(item).data)
+
+    def destroy(self, request, cart_pk, pk, *args, **kwargs):
+        if not get_cart_store().remove_item(parse_cart_id(cart_pk), parse_item_id(pk)):
+            raise Http404("No CartItem matches the given query.")
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+    # Adds (or with "replace": true sets) many items in one request and returns the cart, eg.
+    # POST {"items": [{"product_id": 1, "quantity": 2}, ...]}. see BatchCartItemsSerializer
+    @action(detail=False, methods=["POST"])
+    def batch(self, request, cart_pk):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        cart = serializer.save()
+        return Response(CartModelSerializer(cart, context={"request": request}).data)
+
+    def get_item(self, cart_pk, pk):
+        item = get_cart_store().get_item(parse_cart_id(cart_pk), parse_item_id(pk))
+        if item is None:
+            raise Http404("No CartItem matches the given query.")
+        return item
+
+    # only used by the browsable api and explain_store_queries, the views above use the store
     def get_queryset(self):
         # recall that self.kwargs contains the route params
-        return CartItem.objects.select_related("product").filter(
-            cart__pk=self.kwargs["cart_pk"]
+        return annotate_cart_items(
+            CartItem.objects.filter(cart__pk=self.kwargs["cart_pk"])
         )
 
     # customize this to return a serializer based on method
     def get_serializer_class(self):
-        if self.request.method == "POST":
+        if self.action == "batch":
+            return BatchCartItemsSerializer
+        elif self.request.method == "POST":
             return AddCartItemModelSerializer
         elif self.request.method == "PATCH":
             return UpdateCartItemModelSerializer
@@ -224,7 +566,10 @@ class CartItemViewSet(ModelViewSet):
     def get_serializer_context(self):
         # Access route parameters via kwargs, get the product id from it and pass it to the serializer via context
         # recall we use a context to pass additional data to a serializer
-        return {"request": self.request, "cart_pk": self.kwargs["cart_pk"]}
+        return {
+            "request": self.request,
+            "cart_pk": parse_cart_id(self.kwargs["cart_pk"]),
+        }
 
 
 # originally we wante to only allow create, update, retrieve from endpoint (Admin UI can list and delete)
@@ -326,10 +671,18 @@ class OrderViewSet(ModelViewSet):
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
     def get_queryset(self):
+        queryset = Order.objects.all()
+        # order items (and their products) are only loaded when they are rendered, see ?fields=/?expand=
+        fields = get_sparse_fields(self.request, OrderModelSerializer)
+        if fields is None or "orderitem_set" in fields:
+            queryset = queryset.prefetch_related("orderitem_set__product")
+        if fields is not None:
+            queryset = queryset.only("pk", *(fields - {"orderitem_set"}))
+
         if self.request.user.is_staff:
-            return Order.objects.all()
+            return queryset
         customer = Customer.objects.filter(user__pk=self.request.user.pk).first()
-        return Order.objects.filter(customer__pk=customer.pk)
+        return queryset.filter(customer__pk=customer.pk)
 
     def get_serializer_class(self):
         if self.request.method == "POST":
@@ -405,7 +758,7 @@ class ProductDetailRetrieveUpdateDestroy(RetrieveUpdateDestroyAPIView):
 
 class CollectionListCreate(ListCreateAPIView):
     def get_queryset(self):
-        return Collection.objects.annotate(product_count=Count("product"))
+        return Collection.objects.all()
 
     def get_serializer_class(self):
         return CollectionModelSerializer
@@ -416,7 +769,7 @@ class CollectionListCreate(ListCreateAPIView):
 
 class CollectionDetailRetrieveUpdateDestroy(RetrieveUpdateDestroyAPIView):
     def get_queryset(self):
-        return Collection.objects.annotate(product_count=Count("product"))
+        return Collection.objects.all()
 
     def get_serializer_class(self):
         return CollectionModelSerializer
@@ -425,11 +778,7 @@ class CollectionDetailRetrieveUpdateDestroy(RetrieveUpdateDestroyAPIView):
         return {"request": self.request}
 
     def delete(self, request, pk: int) -> Response:
-        collection = (
-            Collection.objects.annotate(product_count=Count("product"))
-            .filter(pk=pk)
-            .first()
-        )
+        collection = Collection.objects.filter(pk=pk).first()
         if collection is not None:
             # check that product is not in any active orders. if it is do not delete, send appropriate error
             if collection.product_set.count() > 0:
@@ -579,7 +928,7 @@ def product_detail(request, pk: int) -> Response:
 @api_view(["GET", "POST"])
 def collection_list(request):
     if request.method == "GET":
-        queryset = Collection.objects.annotate(product_count=Count("product"))
+        queryset = Collection.objects.all()
         serializer = CollectionModelSerializer(
             queryset, many=True, context={"request": request}
         )
@@ -600,11 +949,7 @@ def collection_list(request):
 @api_view(["GET", "PUT", "DELETE"])
 def collection_detail(request, pk: int) -> Response:
 
-    collection = (
-        Collection.objects.annotate(product_count=Count("product"))
-        .filter(pk=pk)
-        .first()
-    )
+    collection = Collection.objects.filter(pk=pk).first()
     if collection is not None:
         if request.method == "GET":
             serializer = CollectionModelSerializer(
@@ -43,5 +43,9 @@ class TaggedItem(models.Model):
     object_id = models.PositiveIntegerField()
     content_object = GenericForeignKey()
 
+    class Meta:
+        # generic relations are looked up by both columns, see TaggedItemManager.get_tags_for
+        indexes = [models.Index(fields=["content_type", "object_id"])]
+
     def __str__(self) -> str:
         return f"{self.tag} -> {self.content_object}"